@@ -0,0 +1,475 @@
+import glob
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import configargparse
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from model.dataset import MidiDataset
+from model.distributed import barrier, destroy_distributed, init_distributed
+from model.execution import InferenceModel, inference_modes, precisions
+from model.model import GRUNet
+from model.sampler import WindowBatchSampler
+from model.shards import ShardedMidiDataset, build_shards
+from model.trainer import Trainer
+from utils.generate_midi import generate_midi_batch
+from utils.seed import set_seed
+from utils.write_notes import write_notes, write_tokens
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator benchmarks.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument('--out', type=str, required=True, help='Path of the JSON file with results.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='JSON file with results of another run. Results which are worse than there by more than '
+                             '--tolerance are reported and the exit code is 1.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative tolerance of the comparison.')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=['load', 'batch', 'train', 'generate', 'write'],
+                        choices=['load', 'batch', 'shards', 'train', 'distributed', 'generate', 'write'],
+                        help='Benchmarks to run. "distributed" trains with several processes on CPU, "shards" builds '
+                             'shards of corpora and gathers batches from their memory maps.')
+
+    parser.add_argument('--data_prefix', type=str, default='../data/', help='Prefix of bundled *.mid files.')
+    parser.add_argument('--synthetic_files', type=int, default=100,
+                        help='Number of files in the synthetic corpus, it is not used if 0.')
+    parser.add_argument('--synthetic_notes', type=int, default=1000, help='Number of notes in a synthetic file.')
+    parser.add_argument('--load_backends', type=str, nargs='+', default=['smf'], choices=MidiDataset.backends,
+                        help='Backends which are used to load files. Note that music21 is slow.')
+
+    parser.add_argument('--shard_size', type=int, default=1 << 16,
+                        help='Number of notes in a shard, small shards give several shards of small corpora.')
+
+    parser.add_argument('--seq_len', type=int, default=256, help='Length of training windows.')
+    parser.add_argument('--samplings', type=str, nargs='+', default=['uniform'], choices=WindowBatchSampler.modes,
+                        help='Sampling modes of training windows.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128], help='Training batch sizes.')
+    parser.add_argument('--hidden_dims', type=int, nargs='+', default=[128, 256], help='Model hidden sizes.')
+    parser.add_argument('--n_layers', type=int, nargs='+', default=[2], help='Numbers of GRU layers.')
+    parser.add_argument('--n_batches', type=int, default=50, help='Number of batches in a measurement.')
+    parser.add_argument('--n_jobs', type=int, default=0, help='Number of workers in the training data loader.')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32'], choices=precisions,
+                        help='Training precisions.')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of processes of data-parallel training. Every process trains on --n_batches '
+                             'batches with threads / processes torch threads.')
+
+    parser.add_argument('--gen_seq_len', type=int, default=256, help='Length of generated sequences.')
+    parser.add_argument('--gen_num_samples', type=int, nargs='+', default=[1, 16],
+                        help='Numbers of sequences which are generated together.')
+    parser.add_argument('--execution_modes', type=str, nargs='+', default=['eager'], choices=inference_modes,
+                        help='Execution modes of generation steps.')
+
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repeats, the best result is taken.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch threads.')
+    parser.add_argument('--gpu', action='store_true', help='Run model benchmarks on gpu.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+
+    return parser
+
+
+class _NullWriter:
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _distributed_train(rank, world_size, port, dataset, config, queue):
+    """
+    Trains an epoch in a process of the gloo group, the main process puts (seconds, batches per process) to `queue`.
+    """
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    init_distributed('gloo')
+    torch.set_num_threads(config['threads'])
+    set_seed(config['seed'])
+
+    model = GRUNet(num_embeddings=len(dataset.vocab), hidden_dim=config['hidden_dim'], n_layers=config['n_layers'],
+                   drop_prob=0.2)
+    trainer = Trainer(model, dataset.vocab, dataset, _NullWriter(),
+                      device=torch.device('cpu'),
+                      train_batch_size=config['batch_size'],
+                      n_jobs=0,
+                      n_epochs=1)
+
+    # the first epoch is a warm up
+    trainer._train(1)
+
+    barrier()
+    start = time.perf_counter()
+    trainer._train(1)
+    barrier()
+    seconds = time.perf_counter() - start
+
+    if rank == 0:
+        queue.put((seconds, len(trainer.train_dataloader)))
+
+    destroy_distributed()
+
+
+class Benchmark:
+    """
+    Runs benchmarks and collects results as records:
+    {"benchmark": str, "config": dict, "metric": str, "value": float, "higher_is_better": bool}.
+    """
+
+    def __init__(self, params, device):
+        self.params = params
+        self.device = device
+        self.results = []
+
+    def _add(self, benchmark, config, metric, value, higher_is_better):
+        self.results.append({'benchmark': benchmark,
+                             'config': config,
+                             'metric': metric,
+                             'value': value,
+                             'higher_is_better': higher_is_better})
+        logger.info(f'{benchmark} {config}: {metric} = {value:.4g}')
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _best_time(self, func, repeat=None):
+        """
+        Returns the best time of `repeat` calls of `func`, the first call is a warm up.
+        """
+        func()
+
+        times = []
+        for _ in range(self.params.repeat if repeat is None else repeat):
+            self._sync()
+            start = time.perf_counter()
+            func()
+            self._sync()
+            times.append(time.perf_counter() - start)
+
+        return min(times)
+
+    def corpora(self, tmp_dir):
+        """
+        Returns {corpus name: data prefix}. The synthetic corpus has random notes from the vocabulary of bundled files.
+        """
+        corpora = {}
+        if glob.glob(self.params.data_prefix + '*.mid'):
+            corpora['data'] = self.params.data_prefix
+
+        if self.params.synthetic_files > 0:
+            rng = random.Random(self.params.seed)
+            tokens = ['C4', 'E-4', 'G4', 'B-3', 'F#5', '0.4.7', '2.5.9', '11.2.5', '4.7.11', '9.0.4']
+
+            for i in range(self.params.synthetic_files):
+                note_seq = [rng.choice(tokens) for _ in range(self.params.synthetic_notes)]
+                offset_seq = [rng.choice([0, 0.25, 0.5, 1 / 3, 1]) for _ in note_seq]
+                with open(os.path.join(tmp_dir, f'synthetic_{i}.mid'), 'wb') as f:
+                    write_tokens(f, note_seq, offset_seq)
+
+            corpora['synthetic'] = os.path.join(tmp_dir, 'synthetic_')
+
+        return corpora
+
+    def load(self, corpora):
+        datasets = {}
+        for corpus, prefix in corpora.items():
+            n_files = len(glob.glob(prefix + '*.mid'))
+            for backend in self.params.load_backends:
+                start = time.perf_counter()
+                dataset = MidiDataset(data_prefix=prefix, seq_len=self.params.seq_len, expand_coef=1, backend=backend)
+                seconds = time.perf_counter() - start
+
+                config = {'corpus': corpus, 'backend': backend, 'files': n_files, 'notes': len(dataset.notes)}
+                self._add('load', config, 'files/s', n_files / seconds, True)
+
+                datasets[corpus] = dataset
+
+        return datasets
+
+    def batch(self, datasets):
+        for corpus, dataset in datasets.items():
+            for batch_size, sampling in itertools.product(self.params.batch_sizes, self.params.samplings):
+                sampler = WindowBatchSampler(dataset, batch_size=batch_size, n_batches=self.params.n_batches,
+                                             mode=sampling)
+                n_tokens = []
+
+                def run():
+                    n_tokens.clear()
+                    for starts in sampler:
+                        prevs, *_, lengths = dataset.get_batch(starts)
+                        n_tokens.append((int(lengths.sum()), prevs.numel()))
+
+                seconds = self._best_time(run)
+                config = {'corpus': corpus, 'batch_size': batch_size, 'seq_len': self.params.seq_len,
+                          'sampling': sampling}
+                self._add('batch', config, 'batches/s', self.params.n_batches / seconds, True)
+                # share of real tokens in padded batches
+                self._add('batch', config, 'fill', sum(n for n, _ in n_tokens) / sum(m for _, m in n_tokens), True)
+
+    def shards(self, corpora, tmp_dir):
+        """
+        Measures writing of shards (files are parsed before) and gathering of batches from memory maps,
+        batches/s are comparable to the batch benchmark.
+        """
+        for corpus, prefix in corpora.items():
+            encoded = list(MidiDataset.iter_files(prefix, backend=self.params.load_backends[0]))
+            n_notes = sum(len(note_seq) for note_seq, _ in encoded)
+            shard_dir = os.path.join(tmp_dir, f'shards_{corpus}')
+
+            seconds = self._best_time(lambda: build_shards(encoded, shard_dir, shard_size=self.params.shard_size),
+                                      repeat=1)
+            config = {'corpus': corpus, 'shard_size': self.params.shard_size}
+            self._add('shards', config, 'notes/s', n_notes / seconds, True)
+
+            dataset = ShardedMidiDataset(shard_dir, seq_len=self.params.seq_len, expand_coef=1)
+            for batch_size, sampling in itertools.product(self.params.batch_sizes, self.params.samplings):
+                sampler = WindowBatchSampler(dataset, batch_size=batch_size, n_batches=self.params.n_batches,
+                                             mode=sampling)
+
+                def run():
+                    for starts in sampler:
+                        dataset.get_batch(starts)
+
+                seconds = self._best_time(run)
+                config = {'corpus': corpus, 'batch_size': batch_size, 'seq_len': self.params.seq_len,
+                          'sampling': sampling, 'shard_size': self.params.shard_size}
+                self._add('shards', config, 'batches/s', self.params.n_batches / seconds, True)
+
+    def train(self, dataset):
+        for hidden_dim in self.params.hidden_dims:
+            for n_layers in self.params.n_layers:
+                for batch_size, sampling, precision in itertools.product(self.params.batch_sizes,
+                                                                         self.params.samplings,
+                                                                         self.params.precisions):
+                    model = GRUNet(num_embeddings=len(dataset.vocab), hidden_dim=hidden_dim, n_layers=n_layers,
+                                   drop_prob=0.2)
+
+                    # an epoch of the trainer is exactly `n_batches` batches
+                    dataset.expand_coef = -(-self.params.n_batches * batch_size // dataset.n_files)
+                    trainer = Trainer(model, dataset.vocab, dataset, _NullWriter(),
+                                      device=self.device,
+                                      train_batch_size=batch_size,
+                                      n_jobs=self.params.n_jobs,
+                                      n_epochs=1,
+                                      sampling=sampling,
+                                      precision=precision,
+                                      valid_dataset=dataset,
+                                      valid_max_windows=self.params.n_batches * batch_size)
+                    n_batches = len(trainer.train_dataloader)
+                    n_windows = trainer.valid_dataloader.sampler.n_windows
+
+                    seconds = self._best_time(lambda: trainer._train(1), repeat=1)
+                    eval_seconds = self._best_time(trainer.evaluate)
+
+                    config = {'hidden_dim': hidden_dim, 'n_layers': n_layers, 'batch_size': batch_size,
+                              'seq_len': self.params.seq_len, 'n_jobs': self.params.n_jobs, 'sampling': sampling,
+                              'precision': precision}
+                    # the epoch includes an evaluation of `n_windows` windows
+                    self._add('train', config, 'ms/step', 1000 * (seconds - eval_seconds) / n_batches, False)
+                    # windows of the training batch size, comparable to ms/step
+                    self._add('train', config, 'eval ms/batch', 1000 * eval_seconds / n_windows * batch_size, False)
+
+    def distributed(self, dataset):
+        """
+        Measures throughput of data-parallel training on CPU. Efficiency is the throughput divided by
+        the throughput of one process and the number of processes.
+        """
+        ctx = mp.get_context('spawn')
+        threads = self.params.threads if self.params.threads is not None else torch.get_num_threads()
+
+        for hidden_dim, n_layers, batch_size in itertools.product(self.params.hidden_dims, self.params.n_layers,
+                                                                  self.params.batch_sizes):
+            samples_per_s = {}
+            for world_size in self.params.world_sizes:
+                # every process trains on `n_batches` batches
+                dataset.expand_coef = -(-self.params.n_batches * batch_size * world_size // dataset.n_files)
+
+                config = {'hidden_dim': hidden_dim, 'n_layers': n_layers, 'batch_size': batch_size,
+                          'seq_len': self.params.seq_len, 'world_size': world_size}
+                queue = ctx.SimpleQueue()
+                mp.start_processes(_distributed_train,
+                                   args=(world_size, _free_port(), dataset,
+                                         {**config, 'threads': max(1, threads // world_size),
+                                          'seed': self.params.seed},
+                                         queue),
+                                   nprocs=world_size, start_method='spawn')
+                seconds, n_batches = queue.get()
+
+                samples_per_s[world_size] = world_size * n_batches * batch_size / seconds
+                self._add('distributed', config, 'samples/s', samples_per_s[world_size], True)
+                if 1 in samples_per_s:
+                    self._add('distributed', config, 'efficiency',
+                              samples_per_s[world_size] / samples_per_s[1] / world_size, True)
+
+    def generate(self, vocab):
+        seq_len = self.params.gen_seq_len
+        for hidden_dim in self.params.hidden_dims:
+            for n_layers in self.params.n_layers:
+                model = GRUNet(num_embeddings=len(vocab), hidden_dim=hidden_dim, n_layers=n_layers).to(self.device)
+
+                for mode, num_samples in itertools.product(self.params.execution_modes, self.params.gen_num_samples):
+                    inference_model = model if mode == 'eager' else InferenceModel(model, mode)
+                    seconds = self._best_time(lambda: generate_midi_batch(inference_model, vocab,
+                                                                          num_samples=num_samples,
+                                                                          seq_len=seq_len,
+                                                                          device=self.device,
+                                                                          seeds=list(range(num_samples)),
+                                                                          progress=False))
+
+                    config = {'hidden_dim': hidden_dim, 'n_layers': n_layers, 'num_samples': num_samples,
+                              'seq_len': seq_len, 'execution_mode': mode}
+                    self._add('generate', config, 'ms/token', 1000 * seconds / seq_len / num_samples, False)
+
+    def write(self, vocab, tmp_dir):
+        rng = random.Random(self.params.seed)
+        # generated ids are written as generate.py does, with the pitch table of the vocab
+        note_seq = [vocab.note2id[rng.choice(vocab.unique_notes)] for _ in range(self.params.gen_seq_len)]
+        offset_seq = [rng.random() for _ in note_seq]
+
+        out_path = os.path.join(tmp_dir, 'out.mid')
+
+        def write_music21():
+            write_notes(out_path, MidiDataset.decode_notes(note_seq, offset_seq, vocab=vocab))
+
+        def write_smf():
+            with open(out_path, 'wb') as f:
+                write_tokens(f, note_seq, offset_seq, vocab=vocab)
+
+        for backend, func in (('music21', write_music21), ('smf', write_smf)):
+            seconds = self._best_time(func)
+            config = {'backend': backend, 'notes': len(note_seq)}
+            self._add('write', config, 'ms/file', 1000 * seconds, False)
+
+    def run(self):
+        benchmarks = self.params.benchmarks
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            corpora = self.corpora(tmp_dir)
+            datasets = self.load(corpora)
+            assert datasets, 'There are no files to benchmark.'
+
+            # model benchmarks use the largest corpus
+            dataset = max(datasets.values(), key=lambda d: len(d.notes))
+
+            if 'batch' in benchmarks:
+                self.batch(datasets)
+            if 'shards' in benchmarks:
+                self.shards(corpora, tmp_dir)
+            if 'train' in benchmarks:
+                self.train(dataset)
+            if 'distributed' in benchmarks:
+                self.distributed(dataset)
+            if 'generate' in benchmarks:
+                self.generate(dataset.vocab)
+            if 'write' in benchmarks:
+                self.write(dataset.vocab, tmp_dir)
+
+        if 'load' not in benchmarks:
+            self.results = [r for r in self.results if r['benchmark'] != 'load']
+
+        return self.results
+
+
+def _environment(device):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+            'device': str(device)}
+
+
+def _key(record):
+    return record['benchmark'], record['metric'], json.dumps(record['config'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns records which are worse than the same records of the baseline by more than `tolerance`.
+    Records with zero baseline values have no relative change and are not compared.
+    """
+    baseline = {_key(r): r for r in baseline}
+
+    regressions = []
+    for record in results:
+        base = baseline.get(_key(record))
+        if base is None:
+            continue
+
+        if base['value'] == 0:
+            logger.info(f'{record["benchmark"]} {record["config"]}: {record["metric"]} '
+                        f'{base["value"]:.4g} -> {record["value"]:.4g} (not compared, the baseline is 0)')
+            continue
+
+        ratio = record['value'] / base['value']
+        change = ratio - 1 if record['higher_is_better'] else 1 - ratio
+        logger.info(f'{record["benchmark"]} {record["config"]}: {record["metric"]} '
+                    f'{base["value"]:.4g} -> {record["value"]:.4g} ({100 * change:+.1f}%)')
+
+        if change < -tolerance:
+            regressions.append(record)
+
+    return regressions
+
+
+def main():
+    params = get_parser().parse_args()
+    set_seed(params.seed)
+
+    if params.threads is not None:
+        torch.set_num_threads(params.threads)
+
+    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
+
+    results = Benchmark(params, device).run()
+
+    report = {'environment': _environment(device),
+              'params': vars(params),
+              'results': results}
+    with open(params.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Results were saved to {params.out}.')
+
+    if params.compare is not None:
+        with open(params.compare) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, params.tolerance)
+        for record in regressions:
+            logger.warning(f'Regression: {record["benchmark"]} {record["config"]}: {record["metric"]}')
+
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
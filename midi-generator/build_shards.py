@@ -0,0 +1,60 @@
+import logging
+
+import configargparse
+
+from model.dataset import MidiDataset
+from model.shards import build_shards
+from utils.load_model import load_model
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator conversion of *.mid files to '
+                                                       'memory-mapped shards.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument('--data_prefix', type=str, required=True, help='Prefix of *.mid files.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Directory of shards and the manifest.')
+    parser.add_argument('--shard_size', type=int, default=1 << 24,
+                        help='Number of notes in a shard, a shard takes 8 bytes per note.')
+
+    parser.add_argument('--data_dedup', action='store_true',
+                        help='Skip files with the same notes and offsets as another file.')
+    parser.add_argument('--data_valid_ratio', type=float, default=0,
+                        help='Share of files which are written to shards of the validation split.')
+    parser.add_argument('--init_checkpoint', type=str, default=None,
+                        help='Checkpoint which will be fine-tuned on shards. Its vocab is kept and new notes '
+                             'of the data are appended.')
+
+    parser.add_argument('--ingest_workers', type=int, default=0,
+                        help='Number of processes which parse *.mid files. Files are parsed in the main process if 0.')
+    parser.add_argument('--data_cache', type=str, default=None,
+                        help='Path to the cache of encoded *.mid files. Only new or changed files are parsed '
+                             'if the cache exists, files which do not match the prefix are dropped from it.')
+    parser.add_argument('--data_backend', type=str, default='music21', choices=MidiDataset.backends,
+                        help='Backend which parses *.mid files. "smf" reads MIDI events directly and gives the same '
+                             'notes as "music21" much faster.')
+
+    return parser
+
+
+def main():
+    params = get_parser().parse_args()
+
+    vocab = load_model(params.init_checkpoint)[1] if params.init_checkpoint is not None else None
+
+    encoded_files = MidiDataset.iter_files(params.data_prefix, cache_path=params.data_cache,
+                                           ingest_workers=params.ingest_workers, backend=params.data_backend)
+    build_shards(encoded_files, params.out_dir,
+                 shard_size=params.shard_size,
+                 vocab=vocab,
+                 deduplicate=params.data_dedup,
+                 valid_ratio=params.data_valid_ratio)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
@@ -0,0 +1,416 @@
+import copy
+import glob
+import logging
+import sys
+import time
+
+import configargparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import smf
+from model.dataset import MidiDataset
+from model.execution import InferenceModel, autocast, inference_modes, precisions
+from model.loss import LabelSmoothingLossWithLogits
+from model.model import GRUNet, pack_tokens
+from model.quantization import quantized_tensors
+from model.sampler import WindowBatchSampler
+from utils.generate_midi import generate_midi_batch
+from utils.load_model import load_model
+from utils.write_notes import notes_to_bytes, tokens_to_bytes
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator parity checks.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    subparsers = parser.add_subparsers(dest='check')
+    subparsers.required = True
+
+    backend_parser = subparsers.add_parser('backend', help='Compare smf backend with music21 on *.mid files.')
+    backend_parser.add_argument('--data_prefix', type=str, required=True, help='Prefix of *.mid files.')
+    backend_parser.add_argument('--offset_tol', type=float, default=1e-6, help='Tolerance of offsets.')
+    backend_parser.add_argument('--max_reports', type=int, default=10,
+                                help='Max number of reported files with mismatches.')
+
+    execution_parser = subparsers.add_parser('execution', help='Compare precisions of training and inference modes '
+                                                               'with eager fp32.')
+    execution_parser.add_argument('--checkpoint_path', type=str, default=None,
+                                  help='Model checkpoint path, a random model is used if it is not set.')
+    execution_parser.add_argument('--hidden_dim', type=int, default=256, help='Hidden size of the random model.')
+    execution_parser.add_argument('--n_layers', type=int, default=2, help='Number of GRU layers of the random model.')
+    execution_parser.add_argument('--vocab_size', type=int, default=400, help='Vocabulary size of the random model.')
+    execution_parser.add_argument('--batch_size', type=int, default=16, help='Number of sequences.')
+    execution_parser.add_argument('--seq_len', type=int, default=128, help='Length of sequences.')
+    execution_parser.add_argument('--precisions', type=str, nargs='+', default=['bf16'],
+                                  choices=[p for p in precisions if p != 'fp32'], help='Training precisions to check.')
+    execution_parser.add_argument('--modes', type=str, nargs='+', default=['script', 'compile'],
+                                  choices=[m for m in inference_modes if m != 'eager'],
+                                  help='Inference modes to check.')
+    execution_parser.add_argument('--loss_rtol', type=float, default=1e-2, help='Relative tolerance of losses.')
+    execution_parser.add_argument('--min_grad_cos', type=float, default=0.99,
+                                  help='Min cosine similarity of gradients.')
+    execution_parser.add_argument('--atol', type=float, default=1e-4,
+                                  help='Absolute tolerance of logits, offsets and hidden states in inference modes.')
+    execution_parser.add_argument('--gpu', action='store_true', help='Run checks on gpu.')
+    execution_parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
+
+    quantization_parser = subparsers.add_parser('quantization', help='Compare the int8 quantized model with fp32.')
+    quantization_parser.add_argument('--checkpoint_path', type=str, required=True, help='fp32 model checkpoint path.')
+    quantization_parser.add_argument('--quantized_path', type=str, default=None,
+                                     help='Quantized checkpoint path (see quantize.py), the fp32 model is quantized '
+                                          'if it is not set.')
+    quantization_parser.add_argument('--data_prefix', type=str, required=True, help='Prefix of held-out *.mid files.')
+    quantization_parser.add_argument('--backend', type=str, default='smf', choices=MidiDataset.backends,
+                                     help='Backend which parses *.mid files.')
+    quantization_parser.add_argument('--seq_len', type=int, default=256, help='Number of compared tokens per file.')
+    quantization_parser.add_argument('--max_files', type=int, default=32, help='Max number of compared files.')
+    quantization_parser.add_argument('--top_k', type=int, default=5, help='Size of compared top-k sets of tokens.')
+    quantization_parser.add_argument('--max_kl', type=float, default=0.02,
+                                     help='Max mean KL divergence of next token distributions.')
+    quantization_parser.add_argument('--min_top1', type=float, default=0.95,
+                                     help='Min agreement of the most probable next tokens.')
+    quantization_parser.add_argument('--gen_seq_len', type=int, default=256,
+                                     help='Length of generated sequences to measure ms/token.')
+
+    sampling_parser = subparsers.add_parser('sampling', help='Check start positions of windows of sampling modes.')
+    sampling_parser.add_argument('--data_prefix', type=str, required=True, help='Prefix of *.mid files.')
+    sampling_parser.add_argument('--backend', type=str, default='smf', choices=MidiDataset.backends,
+                                 help='Backend which parses *.mid files.')
+    sampling_parser.add_argument('--seq_len', type=int, default=64, help='Length of windows.')
+    sampling_parser.add_argument('--batch_size', type=int, default=64, help='Number of windows in a batch.')
+    sampling_parser.add_argument('--n_batches', type=int, default=100, help='Number of drawn batches per mode.')
+    sampling_parser.add_argument('--seed', type=int, default=0, help='Seed of samplers.')
+
+    return parser
+
+
+def _first_mismatch(expected, actual, offset_tol):
+    """
+    Returns index of the first token or offset which differs or None if sequences are the same.
+    """
+    (expected_notes, expected_offsets), (notes, offsets) = expected, actual
+
+    for i, (n1, o1, n2, o2) in enumerate(zip(expected_notes, expected_offsets, notes, offsets)):
+        if n1 != n2 or abs(o1 - o2) > offset_tol:
+            return i
+
+    if len(expected_notes) != len(notes):
+        return min(len(expected_notes), len(notes))
+
+    return None
+
+
+def _reread(data):
+    return smf.encode_tracks(*smf.read_midi(data))
+
+
+def check_backend(params):
+    """
+    Encodes every file with both backends and compares tokens and offsets. Decoded tokens are also written
+    with both writers and read back to check that the written notes are the same.
+    """
+    files = sorted(glob.glob(params.data_prefix + '*.mid'))
+    times = {backend: 0 for backend in MidiDataset.backends}
+
+    n_same, n_failed, n_written_same, reports = 0, 0, 0, []
+    for file_path in files:
+        results = {}
+        for backend in MidiDataset.backends:
+            start = time.perf_counter()
+            results[backend] = MidiDataset.parse_file(file_path, backend=backend)
+            times[backend] += time.perf_counter() - start
+
+        (expected, expected_error), (actual, actual_error) = results['music21'], results['smf']
+        if expected_error is not None or actual_error is not None:
+            if expected_error is None or actual_error is None:
+                reports.append(f'{file_path}: music21 error: {expected_error}, smf error: {actual_error}')
+            n_failed += 1
+            continue
+
+        mismatch = _first_mismatch(expected, actual, params.offset_tol)
+        if mismatch is None:
+            n_same += 1
+        else:
+            reports.append(f'{file_path}: first mismatch at {mismatch} of {len(expected[0])} music21 '
+                           f'and {len(actual[0])} smf tokens')
+
+        note_seq, offset_seq = expected
+        if not note_seq:
+            n_written_same += 1
+            continue
+
+        written = [_reread(notes_to_bytes(MidiDataset.decode_notes(note_seq, offset_seq))),
+                   _reread(tokens_to_bytes(note_seq, offset_seq))]
+        if _first_mismatch(*written, params.offset_tol) is None:
+            n_written_same += 1
+        else:
+            reports.append(f'{file_path}: written notes differ')
+
+    for report in reports[:params.max_reports]:
+        logger.warning(report)
+
+    n_compared = len(files) - n_failed
+    logger.info(f'{n_same} of {n_compared} files have the same tokens and offsets, '
+                f'{n_failed} files could not be parsed.')
+    logger.info(f'{n_written_same} of {n_compared} files are written with the same notes.')
+    logger.info(f'Parsing time: music21 {times["music21"]:.2f}s, smf {times["smf"]:.2f}s, '
+                f'speedup {times["music21"] / max(times["smf"], 1e-9):.1f}x.')
+
+    return not reports
+
+
+def _random_batch(vocab_size, batch_size, seq_len, device):
+    lengths = torch.randint(seq_len // 2, seq_len + 1, (batch_size,))
+    lengths[0] = seq_len
+
+    tokens = torch.randint(1, vocab_size, (batch_size, seq_len + 1))
+    offsets = torch.rand((batch_size, seq_len + 1))
+    padding = torch.arange(seq_len + 1) >= lengths.unsqueeze(-1) + 1
+    tokens[padding], offsets[padding] = 0, 0
+
+    prevs, nexts = tokens[:, :-1].to(device), tokens[:, 1:].to(device)
+    prev_offsets, next_offsets = offsets[:, :-1].to(device), offsets[:, 1:].to(device)
+
+    return prevs, nexts, prev_offsets, next_offsets, lengths
+
+
+def _loss_and_grads(model, batch, precision, device):
+    """
+    Returns the training loss (as in Trainer with default weights) and flat gradients of the model.
+    """
+    prevs, nexts, prev_offsets, next_offsets, lengths = batch
+    model.zero_grad()
+
+    with autocast(device, precision):
+        model_nexts, model_offsets, _ = model(prevs, prev_offsets, lengths=lengths)
+        nexts, next_offsets = (pack_tokens(t, lengths).data for t in (nexts, next_offsets))
+
+        class_loss = LabelSmoothingLossWithLogits(model.num_embeddings, ignore_index=0)(model_nexts, nexts)
+        offset_loss = nn.SmoothL1Loss()(model_offsets.squeeze(-1), next_offsets)
+        loss = class_loss + 10 * offset_loss
+
+    loss.backward()
+
+    return loss.item(), torch.cat([p.grad.flatten() for p in model.parameters()])
+
+
+def _steps(model, batch):
+    """
+    Returns logits, offsets and the last hidden state of generation steps with inputs of the batch.
+    """
+    prevs, _, prev_offsets, *_ = batch
+
+    h = model.init_hidden(prevs.size(0), prevs.device).detach()
+    logits, offsets = [], []
+    with torch.no_grad():
+        for i in range(prevs.size(1)):
+            step_logits, step_offsets = model.step(prevs[:, i], prev_offsets[:, i], h)
+            logits.append(step_logits)
+            offsets.append(step_offsets)
+
+    return torch.stack(logits), torch.stack(offsets), h
+
+
+def check_execution(params):
+    """
+    Compares the loss and gradients of training in lower precisions and outputs of generation steps
+    in inference modes with eager fp32.
+    """
+    torch.manual_seed(params.seed)
+    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
+
+    if params.checkpoint_path is not None:
+        model, _ = load_model(params.checkpoint_path, device=device)
+    else:
+        model = GRUNet(num_embeddings=params.vocab_size, hidden_dim=params.hidden_dim,
+                       n_layers=params.n_layers).to(device)
+
+    # dropout is disabled to compare deterministic outputs, the model stays in train mode for cuDNN backward
+    model.train()
+    model.gru.dropout = 0
+
+    batch = _random_batch(model.num_embeddings, params.batch_size, params.seq_len, device)
+
+    passed = True
+
+    expected_loss, expected_grads = _loss_and_grads(model, batch, 'fp32', device)
+    for precision in params.precisions:
+        if precision == 'fp16' and device.type != 'cuda':
+            logger.warning('fp16 is checked only on gpu.')
+            continue
+
+        loss, grads = _loss_and_grads(model, batch, precision, device)
+        loss_error = abs(loss - expected_loss) / abs(expected_loss)
+        grad_cos = nn.functional.cosine_similarity(grads, expected_grads, dim=0).item()
+
+        ok = loss_error <= params.loss_rtol and grad_cos >= params.min_grad_cos
+        passed &= ok
+        logger.log(logging.INFO if ok else logging.WARNING,
+                   f'Training in {precision}: relative loss error {loss_error:.2e}, '
+                   f'cosine similarity of gradients {grad_cos:.5f}.')
+
+    model.eval()
+    expected_logits, expected_offsets, expected_h = _steps(model, batch)
+    for mode in params.modes:
+        try:
+            inference_model = InferenceModel(copy.deepcopy(model), mode)
+            logits, offsets, h = _steps(inference_model, batch)
+        except Exception as e:
+            logger.warning(f'Inference in {mode} mode failed: {type(e).__name__}: {e}')
+            passed = False
+            continue
+
+        error = max((logits - expected_logits).abs().max().item(),
+                    (offsets - expected_offsets).abs().max().item(),
+                    (h - expected_h).abs().max().item())
+        top_agreement = torch.eq(logits.argmax(-1), expected_logits.argmax(-1)).float().mean().item()
+
+        ok = error <= params.atol
+        passed &= ok
+        logger.log(logging.INFO if ok else logging.WARNING,
+                   f'Inference in {mode} mode: max abs error {error:.2e}, agreement of top tokens {top_agreement:.4f}.')
+
+    return passed
+
+
+def _held_out_sequences(vocab, params):
+    """
+    Returns (tokens, offsets) of the first `seq_len` + 1 notes of files, files with notes which are not
+    in the vocab are skipped.
+    """
+    sequences, n_skipped = [], 0
+    for file_path in sorted(glob.glob(params.data_prefix + '*.mid'))[:params.max_files]:
+        result, _ = MidiDataset.parse_file(file_path, backend=params.backend)
+        if result is None or len(result[0]) < 2:
+            continue
+
+        note_seq, offset_seq = (seq[:params.seq_len + 1] for seq in result)
+        if not all(n in vocab.note2id for n in note_seq):
+            n_skipped += 1
+            continue
+
+        sequences.append((torch.LongTensor(vocab.encode(note_seq)).unsqueeze(0),
+                          torch.FloatTensor(offset_seq).unsqueeze(0)))
+
+    if n_skipped:
+        logger.info(f'{n_skipped} files have notes which are not in the vocab and were skipped.')
+
+    return sequences
+
+
+def _ms_per_token(model, vocab, seq_len, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        generate_midi_batch(model, vocab, seq_len=seq_len, seeds=[0], progress=False)
+        times.append(time.perf_counter() - start)
+
+    return 1000 * min(times) / seq_len
+
+
+def _weights_mb(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors) / 2 ** 20
+
+
+def check_quantization(params):
+    """
+    Compares next token distributions of the quantized and the fp32 model on held-out files with teacher forcing,
+    and reports ms/token of generation and sizes of weights.
+    """
+    model, vocab = load_model(params.checkpoint_path)
+    if params.quantized_path is not None:
+        quantized_model, quantized_vocab = load_model(params.quantized_path)
+        assert quantized_vocab.unique_notes == vocab.unique_notes, 'Models have different vocabs.'
+    else:
+        quantized_model = load_model(params.checkpoint_path, quantize=True)[0]
+
+    sequences = _held_out_sequences(vocab, params)
+    assert sequences, 'There are no files to compare.'
+
+    kls, top1, topk = [], [], []
+    with torch.no_grad():
+        for tokens, offsets in sequences:
+            inputs = (tokens[:, :-1], offsets[:, :-1])
+            log_probas = torch.log_softmax(model(*inputs)[0][0], dim=-1)
+            quantized_log_probas = torch.log_softmax(quantized_model(*inputs)[0][0], dim=-1)
+
+            kls.append((log_probas.exp() * (log_probas - quantized_log_probas)).sum(-1))
+            top1.append(torch.eq(log_probas.argmax(-1), quantized_log_probas.argmax(-1)).float())
+
+            top_k = min(params.top_k, log_probas.size(-1))
+            expected, actual = (torch.topk(p, top_k, dim=-1).indices for p in (log_probas, quantized_log_probas))
+            topk.append(torch.eq(expected.unsqueeze(-1), actual.unsqueeze(-2)).any(-1).float().mean(-1))
+
+    kl, top1, topk = (torch.cat(values) for values in (kls, top1, topk))
+    logger.info(f'{len(sequences)} files, {len(kl)} tokens: KL mean {kl.mean():.2e}, max {kl.max():.2e}, '
+                f'top-1 agreement {top1.mean():.4f}, top-{params.top_k} overlap {topk.mean():.4f}.')
+
+    fp32_ms, int8_ms = (_ms_per_token(m, vocab, params.gen_seq_len) for m in (model, quantized_model))
+    logger.info(f'Generation: fp32 {fp32_ms:.3f} ms/token, int8 {int8_ms:.3f} ms/token, '
+                f'speedup {fp32_ms / int8_ms:.2f}x.')
+
+    fp32_mb = _weights_mb(model.state_dict().values())
+    int8_mb = _weights_mb(quantized_tensors(quantized_model)[0].values())
+    logger.info(f'Weights: fp32 {fp32_mb:.2f} MB, int8 {int8_mb:.2f} MB.')
+
+    return kl.mean().item() <= params.max_kl and top1.mean().item() >= params.min_top1
+
+
+def check_sampling(params):
+    """
+    Checks that windows of all sampling modes are in files. For the 'full' mode, it checks that the index of start
+    positions of every file is exactly the set of starts of the longest windows of the file, so the last full
+    window (and the last note as a target) can be drawn, and that drawn windows are the longest ones.
+    """
+    dataset = MidiDataset(data_prefix=params.data_prefix, seq_len=params.seq_len, expand_coef=1,
+                          backend=params.backend)
+
+    passed = True
+    for mode in WindowBatchSampler.modes:
+        sampler = WindowBatchSampler(dataset, batch_size=params.batch_size, n_batches=params.n_batches, mode=mode)
+        sampler.seed = params.seed
+
+        starts = np.concatenate(list(sampler))
+        file_idxs = np.searchsorted(dataset.starts, starts, side='right') - 1
+        ends = dataset.starts[file_idxs + 1]
+        lengths = np.minimum(ends - 1 - starts, params.seq_len)
+
+        n_outside = int((lengths < 1).sum())
+        n_short = int((lengths < np.minimum(ends - dataset.starts[file_idxs] - 1, params.seq_len)).sum())
+        logger.info(f'{mode}: {len(starts)} windows, {n_outside} outside of files, {n_short} shorter than possible.')
+        passed &= n_outside == 0 and (mode != 'full' or n_short == 0)
+
+        if mode == 'full':
+            n_mismatched = 0
+            for file_start, n_positions, end in zip(sampler.file_starts, sampler.n_positions, sampler.file_ends):
+                file_starts = np.arange(file_start, end - 1)
+                window_lengths = np.minimum(end - 1 - file_starts, params.seq_len)
+                longest = file_starts[window_lengths == window_lengths.max()]
+                n_mismatched += not np.array_equal(longest, file_start + np.arange(n_positions))
+
+            logger.info(f'full: {n_mismatched} of {len(sampler.file_starts)} files have other start positions '
+                        f'than starts of the longest windows.')
+            passed &= n_mismatched == 0
+
+    return passed
+
+
+def main():
+    params = get_parser().parse_args()
+
+    checks = {'backend': check_backend, 'execution': check_execution, 'quantization': check_quantization,
+              'sampling': check_sampling}
+    passed = checks[params.check](params)
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
@@ -1,13 +1,18 @@
 import logging
+import os
+import sys
 
 import configargparse
 import torch
 
 from model.dataset import MidiDataset, Vocab
-from utils.generate_midi import generate_midi
+from model.execution import InferenceModel, inference_modes
+from utils.constraints import Constraints, key_pitch_classes
+from utils.generate_midi import beam_search_midi, generate_midi_batch, iter_generate_midi
 from utils.load_model import load_model
+from utils.midi_stream import StreamingMidiWriter
 from utils.seed import set_seed
-from utils.write_notes import write_notes
+from utils.write_notes import write_notes, write_tokens
 
 
 def get_parser() -> configargparse.ArgumentParser:
@@ -23,15 +28,67 @@ def get_parser() -> configargparse.ArgumentParser:
     parser.add_argument('--seq_len', type=int, default=256, help='Output sequence length.')
     parser.add_argument('--top_p', type=float, default=0.6, help='Nucleus sampling probability.')
     parser.add_argument('--temperature', type=float, default=1.0, help='Sampling temperature.')
+    parser.add_argument('--num_samples', type=int, default=1,
+                        help='Number of sequences which are generated together. Index of a sequence is added to '
+                             'the out file name if it is greater than 1.')
+
+    parser.add_argument('--beam_size', type=int, default=0,
+                        help='Generate with beam search of this number of beams instead of sampling. The most '
+                             'probable --num_samples beams are saved.')
+    parser.add_argument('--beam_groups', type=int, default=1,
+                        help='Number of groups of diverse beam search, tokens which are chosen by other groups '
+                             'are penalized by --diversity.')
+    parser.add_argument('--diversity', type=float, default=0.5, help='Diversity penalty of diverse beam search.')
+
+    parser.add_argument('--key', type=str, default=None,
+                        help='Only notes and chords of the scale of a key are generated, e.g. "C major", "F# minor".')
+    parser.add_argument('--pitch_range', type=int, nargs=2, default=None,
+                        help='Lowest and highest MIDI note numbers of generated notes, chords are in 60-71.')
+    parser.add_argument('--repetition_penalty', type=float, default=1.0,
+                        help='Penalty of tokens which are in the last 16 generated tokens, 1 disables it.')
+    parser.add_argument('--max_repeats', type=cast2(int), default=None,
+                        help='Maximal number of repeats of a token in a row.')
 
     parser.add_argument('--gpu', action='store_true', help='Use gpu to train model.')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Quantize GRU and output layers to int8 for CPU generation, see quantize.py.')
+    parser.add_argument('--execution_mode', type=str, default='eager', choices=inference_modes,
+                        help='Execution of generation steps: "script" traces and freezes them with TorchScript, '
+                             '"compile" compiles them with torch.compile.')
     parser.add_argument('--seed', type=cast2(int), default=None, help='Seed for random state.')
 
     parser.add_argument('--out', required=True, type=str, help='Out midi file path.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write notes to the out file as soon as they are sampled. Use "-" as out path to write '
+                             'to stdout. Only one sequence can be streamed, beam search can not be streamed.')
+    parser.add_argument('--backend', type=str, default='music21', choices=('music21', 'smf'),
+                        help='Backend which writes out files. "smf" writes MIDI events directly without music21.')
 
     return parser
 
 
+def stream_midi(model, vocab, params, device, constraints=None):
+    events = iter_generate_midi(model, vocab,
+                                seq_len=params.seq_len,
+                                top_p=params.top_p,
+                                temperature=params.temperature,
+                                device=device,
+                                seed=params.seed,
+                                constraints=constraints)
+
+    out_file = sys.stdout.buffer if params.out == '-' else open(params.out, 'wb')
+    try:
+        with StreamingMidiWriter(out_file) as writer:
+            for note_id, offset in events:
+                writer.write_pitches(vocab.id2pitches[note_id], offset)
+                writer.flush()
+    finally:
+        if out_file is not sys.stdout.buffer:
+            out_file.close()
+
+    logger.info(f'Result was streamed to {params.out}.')
+
+
 def main():
     params = get_parser().parse_args()
     if params.seed is not None:
@@ -40,18 +97,64 @@ def main():
     device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
     logger.info(f'Used device: {device}')
 
-    model, vocab = load_model(params.checkpoint_path, device=device)
-
-    note_seq, offset_seq = generate_midi(model, vocab,
-                                         seq_len=params.seq_len,
-                                         top_p=params.top_p,
-                                         temperature=params.temperature)
-    note_seq = vocab.decode(note_seq)
-    notes = MidiDataset.decode_notes(note_seq, offset_seq)
-
-    write_notes(params.out, notes)
-
-    logger.info(f'Result was saved to {params.out}.')
+    model, vocab = load_model(params.checkpoint_path, device=device, quantize=params.quantize)
+    if params.execution_mode != 'eager':
+        model = InferenceModel(model, params.execution_mode)
+
+    constraints = None
+    if (params.key is not None or params.pitch_range is not None or params.repetition_penalty > 1
+            or params.max_repeats is not None):
+        constraints = Constraints(vocab,
+                                  pitch_classes=None if params.key is None else key_pitch_classes(params.key),
+                                  pitch_range=params.pitch_range,
+                                  repetition_penalty=params.repetition_penalty,
+                                  max_repeats=params.max_repeats,
+                                  device=device)
+
+    if params.stream:
+        assert params.num_samples == 1, 'Only one sequence can be streamed.'
+        assert params.beam_size == 0, 'Beam search can not be streamed.'
+        stream_midi(model, vocab, params, device, constraints)
+        return
+
+    if params.beam_size > 0:
+        assert params.num_samples <= params.beam_size, 'Number of samples is greater than the number of beams.'
+
+        results = beam_search_midi(model, vocab,
+                                   seq_len=params.seq_len,
+                                   beam_size=params.beam_size,
+                                   num_groups=params.beam_groups,
+                                   diversity=params.diversity,
+                                   temperature=params.temperature,
+                                   device=device,
+                                   seed=params.seed,
+                                   constraints=constraints)[:params.num_samples]
+    else:
+        # every sequence has its own random generator, so a sequence does not depend on the number of samples
+        seeds = None if params.seed is None else [params.seed + i for i in range(params.num_samples)]
+
+        results = generate_midi_batch(model, vocab,
+                                      num_samples=params.num_samples,
+                                      seq_len=params.seq_len,
+                                      top_p=params.top_p,
+                                      temperature=params.temperature,
+                                      device=device,
+                                      seeds=seeds,
+                                      constraints=constraints)
+
+    for i, (note_seq, offset_seq) in enumerate(results):
+        out_path = params.out
+        if params.num_samples > 1:
+            root, ext = os.path.splitext(params.out)
+            out_path = f'{root}_{i}{ext}'
+
+        if params.backend == 'smf':
+            with open(out_path, 'wb') as out_file:
+                write_tokens(out_file, note_seq, offset_seq, vocab=vocab)
+        else:
+            write_notes(out_path, MidiDataset.decode_notes(note_seq, offset_seq, vocab=vocab))
+
+        logger.info(f'Result was saved to {out_path}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__file__)
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class CorpusCache(object):
+    """
+    On-disk cache of encoded note/offset sequences stored in a single `.npz` file.
+
+    Entries are keyed by file path and validated with file size, mtime and content hash, so only new or
+    changed files have to be parsed again. Token strings are stored once in a table, sequences are stored
+    as flat int32 token ids and float32 offsets. Sequences of different parsing backends are not mixed,
+    the cache is rebuilt if it was made by another backend. Files which could not be parsed are kept with
+    the error message and without sequences, so they are not parsed again until they are changed.
+    """
+    _version = 1
+
+    def __init__(self, path, backend='music21'):
+        self.path = path
+        self.backend = backend
+
+        self.tokens = []
+        self.token2id = {}
+        self.entries = {}
+
+        self._dirty = False
+
+        if os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.normpath(file_path)
+
+    def _load(self):
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if int(data['version']) != self._version:
+                    logger.info(f'Cache {self.path} has outdated version and will be rebuilt.')
+                    return
+
+                # caches without backend were made by music21
+                backend = str(data['backend']) if 'backend' in data else 'music21'
+                if backend != self.backend:
+                    logger.info(f'Cache {self.path} was made by {backend} backend and will be rebuilt.')
+                    return
+
+                tokens = data['tokens'].tolist()
+                paths = data['paths'].tolist()
+                sizes, mtimes, hashes = data['sizes'], data['mtimes'], data['hashes'].tolist()
+                starts, ids, offsets = data['starts'], data['ids'], data['offsets']
+                # caches without errors have no failed files
+                errors = data['errors'].tolist() if 'errors' in data else [''] * len(paths)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f'Cache {self.path} could not be read and will be rebuilt: {e}')
+            return
+
+        self.tokens = tokens
+        self.token2id = {t: i for i, t in enumerate(tokens)}
+
+        for i, path in enumerate(paths):
+            start, end = starts[i], starts[i + 1]
+            self.entries[path] = {'size': int(sizes[i]),
+                                  'mtime': int(mtimes[i]),
+                                  'hash': hashes[i],
+                                  'ids': ids[start:end],
+                                  'offsets': offsets[start:end],
+                                  'error': errors[i] or None}
+
+    def __contains__(self, file_path):
+        return self._entry(file_path) is not None
+
+    def get(self, file_path):
+        """
+        Returns cached (note_seq, offset_seq) for the file or None if the file is new or was changed.
+        """
+        entry = self._entry(file_path)
+        if entry is None:
+            return None
+
+        note_seq = [self.tokens[i] for i in entry['ids'].tolist()]
+        offset_seq = entry['offsets'].tolist()
+
+        return note_seq, offset_seq
+
+    def error(self, file_path):
+        """
+        Returns the error message if the cached file could not be parsed, otherwise None.
+        """
+        entry = self._entry(file_path)
+        return entry['error'] if entry is not None else None
+
+    def _entry(self, file_path):
+        entry = self.entries.get(self._key(file_path))
+        if entry is None:
+            return None
+
+        stat = os.stat(file_path)
+        if stat.st_size != entry['size']:
+            return None
+
+        if stat.st_mtime_ns != entry['mtime']:
+            if file_digest(file_path) != entry['hash']:
+                return None
+            # content is the same, only mtime was changed
+            entry['mtime'] = stat.st_mtime_ns
+            self._dirty = True
+
+        return entry
+
+    def put(self, file_path, note_seq, offset_seq, error=None):
+        """
+        :param error: error message of a file which could not be parsed, its sequences are empty
+        """
+        stat = os.stat(file_path)
+
+        for token in note_seq:
+            if token not in self.token2id:
+                self.token2id[token] = len(self.tokens)
+                self.tokens.append(token)
+
+        self.entries[self._key(file_path)] = {'size': stat.st_size,
+                                              'mtime': stat.st_mtime_ns,
+                                              'hash': file_digest(file_path),
+                                              'ids': np.array([self.token2id[t] for t in note_seq], dtype=np.int32),
+                                              'offsets': np.array(offset_seq, dtype=np.float32),
+                                              'error': error}
+        self._dirty = True
+
+    def prune(self, file_paths):
+        """
+        Drops entries of files which are not in `file_paths`, e.g. files which were deleted or moved.
+        """
+        keys = {self._key(p) for p in file_paths}
+        stale = [key for key in self.entries if key not in keys]
+        for key in stale:
+            del self.entries[key]
+
+        if stale:
+            self._dirty = True
+            logger.info(f'{len(stale)} files which were not found were dropped from cache {self.path}.')
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        paths = list(self.entries.keys())
+        entries = [self.entries[p] for p in paths]
+
+        starts = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum([len(e['ids']) for e in entries], out=starts[1:])
+
+        arrays = {'version': np.array(self._version),
+                  'backend': np.array(self.backend, dtype=np.str_),
+                  'tokens': np.array(self.tokens, dtype=np.str_),
+                  'paths': np.array(paths, dtype=np.str_),
+                  'sizes': np.array([e['size'] for e in entries], dtype=np.int64),
+                  'mtimes': np.array([e['mtime'] for e in entries], dtype=np.int64),
+                  'hashes': np.array([e['hash'] for e in entries], dtype=np.str_),
+                  'errors': np.array([e['error'] or '' for e in entries], dtype=np.str_),
+                  'starts': starts,
+                  'ids': np.concatenate([e['ids'] for e in entries] + [np.zeros(0, dtype=np.int32)]),
+                  'offsets': np.concatenate([e['offsets'] for e in entries] + [np.zeros(0, dtype=np.float32)])}
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+        self._dirty = False
+
+        logger.info(f'Corpus cache was saved to {self.path} ({len(entries)} files).')
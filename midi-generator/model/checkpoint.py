@@ -0,0 +1,116 @@
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+_magic = b'MIDIGEN\x00'
+_version = 1
+_alignment = 64
+
+_dtypes = {'float64': torch.float64, 'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16,
+           'int64': torch.int64, 'int32': torch.int32, 'int8': torch.int8, 'uint8': torch.uint8, 'bool': torch.bool}
+_dtype_names = {dtype: name for name, dtype in _dtypes.items()}
+
+
+class CheckpointFormatError(ValueError):
+    pass
+
+
+def _align(position):
+    return -(-position // _alignment) * _alignment
+
+
+def save_checkpoint(path, tensors, **meta):
+    """
+    Writes a checkpoint: magic, size of the JSON header (uint64), the header with `meta` and the table
+    of tensors, and tensor data where every tensor is aligned to 64 bytes, so it can be memory-mapped.
+    The file is written to a temporary path and then replaced.
+
+    :param tensors: {name: tensor}, e.g. a state dict
+    :param meta: JSON serializable values
+    """
+    table, offset = {}, 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        table[name] = {'dtype': _dtype_names[tensor.dtype], 'shape': list(tensor.shape),
+                       'offset': offset, 'nbytes': nbytes}
+        offset = _align(offset + nbytes)
+
+    header = json.dumps({'version': _version, 'meta': meta, 'tensors': table}).encode()
+    data_start = _align(len(_magic) + 8 + len(header))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_magic)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+
+        for name, tensor in tensors.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().data)
+
+        f.truncate(data_start + offset)
+
+    os.replace(tmp_path, path)
+
+
+def is_checkpoint(path):
+    with open(path, 'rb') as f:
+        return f.read(len(_magic)) == _magic
+
+
+def load_checkpoint(path):
+    """
+    Returns (meta, {name: tensor}). Tensors are views of the private memory map of the file, so nothing is read
+    until it is used, and processes which load the same file share its pages until tensors are changed.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_magic)) != _magic:
+            raise CheckpointFormatError(f'{path} is not a checkpoint.')
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode())
+
+    if header['version'] != _version:
+        raise CheckpointFormatError(f'{path} has unsupported version {header["version"]}.')
+
+    data_start = _align(len(_magic) + 8 + header_size)
+    data = torch.from_file(str(path), shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+
+    tensors = {}
+    for name, entry in header['tensors'].items():
+        start = data_start + entry['offset']
+        tensors[name] = data[start:start + entry['nbytes']].view(_dtypes[entry['dtype']]).view(entry['shape'])
+
+    return header['meta'], tensors
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread. Tensors are copied to CPU when a checkpoint is submitted,
+    so training can change them while the copies are written. Only one checkpoint is written at a time,
+    the next one waits for the previous one.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint-writer')
+        self._future = None
+
+    def write(self, path, tensors, **meta):
+        self.wait()
+
+        tensors = {name: tensor.detach().to('cpu', copy=True) for name, tensor in tensors.items()}
+        self._future = self._executor.submit(save_checkpoint, path, tensors, **meta)
+
+    def wait(self):
+        """
+        Waits for the current checkpoint, errors of writing are raised here.
+        """
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
@@ -1,17 +1,34 @@
 import copy
 import glob
+import hashlib
 import logging
 import os
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from itertools import cycle
 
+import numpy as np
+import torch
 from music21 import converter, instrument, note, chord
 from tqdm import tqdm
 
+from . import smf
+from .cache import CorpusCache
+
 logger = logging.getLogger(__file__)
 
 
 class Vocab(object):
+    """
+    Besides ids of tokens, the vocab keeps a table of their pitches which is built once, so tokens are decoded
+    and analysed by ids without parsing:
+    `id2pitches` - tuple of MIDI note numbers per id, `is_chord` - chords of pitch classes (see smf.is_chord_token),
+    `pitch_class_masks` - bitmask of pitch classes (bit i is pitch class i), `lowest_pitches`, `highest_pitches`.
+    The pad token (and tokens which could not be parsed) has no pitches.
+    """
     _pad_token = '<PAD>'
     _pad_index = 0
 
@@ -23,6 +40,31 @@ class Vocab(object):
 
         self.id2note = {i: n for n, i in self.note2id.items()}
 
+        self.__build_pitch_table()
+
+    def __build_pitch_table(self):
+        n_tokens = len(self.note2id)
+
+        self.id2pitches = [()] * n_tokens
+        self.is_chord = np.zeros(n_tokens, dtype=bool)
+        for i, token in enumerate(self.unique_notes, start=1):
+            try:
+                self.id2pitches[i] = tuple(smf.token_pitches(token))
+            except ValueError:
+                continue
+            self.is_chord[i] = smf.is_chord_token(token)
+
+        self.pitch_class_masks = np.array([sum(1 << pc for pc in {p % 12 for p in pitches})
+                                           for pitches in self.id2pitches], dtype=np.int16)
+        self.lowest_pitches = np.array([min(pitches, default=128) for pitches in self.id2pitches], dtype=np.int16)
+        self.highest_pitches = np.array([max(pitches, default=-1) for pitches in self.id2pitches], dtype=np.int16)
+
+    def pitch_class_matrix(self):
+        """
+        Returns a bool array (n_tokens, 12) of pitch classes of tokens.
+        """
+        return (self.pitch_class_masks[:, None] >> np.arange(12)) & 1 == 1
+
     def __len__(self):
         return len(self.note2id)
 
@@ -38,17 +80,52 @@ class Vocab(object):
 
 
 class MidiDataset(object):
-    def __init__(self, *, data_prefix, seq_len, expand_coef):
+    backends = ('music21', 'smf')
+
+    def __init__(self, *, data_prefix, seq_len, expand_coef, cache_path=None, ingest_workers=0, backend='music21',
+                 vocab=None, deduplicate=False, valid_ratio=0):
+        """
+        Files with less than 3 notes (which give no windows) are not stored, but their notes are in the vocab.
+
+        :param vocab: base Vocab, e.g. of a model which is fine-tuned. Ids of its notes are kept and new notes
+            of files are appended. The vocab is built from files if it is None.
+        :param deduplicate: drop files which have the same notes and offsets as another file, e.g. copies or files
+            which differ only in tempo, instruments or metadata
+        :param valid_ratio: share of files which are held out to `valid_dataset` (a MidiDataset with the same vocab).
+            Files are assigned by the hash of their content, so the split does not depend on the order of files
+            and files keep their split when the corpus grows. At least one file is held out if the ratio is not 0.
+        """
+        assert backend in self.backends, f'Unknown backend: {backend}'
+
         self.data_prefix = data_prefix
         self.seq_len = seq_len
-
-        self.__load_files()
-
-        self.vocab = Vocab(list(sorted(set(sum(self.note_seqs, [])))))
-        self.note_seqs = [self.vocab.encode(seq) for seq in self.note_seqs]
+        self.cache_path = cache_path
+        self.ingest_workers = ingest_workers
+        self.backend = backend
+        self.deduplicate = deduplicate
+        self.valid_ratio = valid_ratio
+
+        note_seqs, offset_seqs = self.__load_files()
+
+        unique_notes = set()
+        for seq in note_seqs:
+            unique_notes.update(seq)
+        if vocab is None:
+            self.vocab = Vocab(list(sorted(unique_notes)))
+        else:
+            self.vocab = Vocab(vocab.unique_notes + list(sorted(unique_notes - set(vocab.unique_notes))))
+
+        note_seqs, offset_seqs = self.__select_files(note_seqs, offset_seqs)
+        (note_seqs, offset_seqs), valid_seqs = self.__split_files(note_seqs, offset_seqs)
+        self.__build_store(note_seqs, offset_seqs)
 
         self.expand_coef = expand_coef
 
+        self.valid_dataset = None
+        if valid_seqs is not None:
+            self.valid_dataset = copy.copy(self)
+            self.valid_dataset.__build_store(*valid_seqs)
+
     @staticmethod
     def encode_notes(notes):
         note_seq = []
@@ -69,7 +146,11 @@ class MidiDataset(object):
         return note_seq, offset_seq
 
     @staticmethod
-    def decode_notes(note_seq, offset_seq=None):
+    def decode_notes(note_seq, offset_seq=None, vocab=None):
+        """
+        :param vocab: if it is given, `note_seq` are ids and chords are taken from the pitch table of the vocab
+            instead of parsing tokens
+        """
         total_offset = 0
         notes = []
 
@@ -78,11 +159,17 @@ class MidiDataset(object):
         for pattern, offset in zip(note_seq, offset_seq):
             total_offset += min(max(offset, 0), 1)
 
-            if ('.' in pattern) or pattern.isdigit():
-                notes_in_chord = pattern.split('.')
+            if vocab is not None:
+                # chords are placed in the 4th octave, see smf.token_pitches
+                pitch_classes = [p - 60 for p in vocab.id2pitches[pattern]] if vocab.is_chord[pattern] else None
+                pattern = vocab.id2note[pattern]
+            else:
+                pitch_classes = [int(pc) for pc in pattern.split('.')] if smf.is_chord_token(pattern) else None
+
+            if pitch_classes is not None:
                 chord_notes = []
-                for current_note in notes_in_chord:
-                    new_note = note.Note(int(current_note))
+                for current_note in pitch_classes:
+                    new_note = note.Note(current_note)
                     new_note.storedInstrument = instrument.Piano()
                     chord_notes.append(new_note)
 
@@ -105,46 +192,305 @@ class MidiDataset(object):
 
         return raw_notes
 
+    @staticmethod
+    def parse_file(file_path, backend='music21'):
+        """
+        Returns ((note_seq, offset_seq), None) or (None, error message) if the file could not be parsed.
+
+        :param backend: 'music21' or 'smf', the latter reads events of the file directly (see model.smf)
+        """
+        try:
+            if backend == 'smf':
+                return smf.encode_file(file_path), None
+
+            raw_notes = MidiDataset.load_raw_notes(file_path)
+            return MidiDataset.encode_notes(raw_notes), None
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    @staticmethod
+    def _parse_chunk(files, backend):
+        return [MidiDataset.parse_file(file, backend=backend) for file in files]
+
+    @staticmethod
+    def _parse_files(files, backend, ingest_workers):
+        """
+        Yields results of `parse_file` in the order of files. With `ingest_workers`, chunks of files are parsed
+        by a pool of processes. If a process dies (e.g. it is killed by the OOM killer or crashes in native code),
+        the pool is recreated and files of the chunk are parsed again one by one, so only the file which kills
+        a process fails.
+        """
+        if ingest_workers == 0 or not files:
+            yield from map(partial(MidiDataset.parse_file, backend=backend), files)
+            return
+
+        chunksize = max(1, len(files) // (4 * ingest_workers))
+        chunks = deque(files[i:i + chunksize] for i in range(0, len(files), chunksize))
+
+        def submit_chunks():
+            return deque(executor.submit(MidiDataset._parse_chunk, chunk, backend) for chunk in chunks)
+
+        executor = ProcessPoolExecutor(max_workers=ingest_workers)
+        futures = submit_chunks()
+        try:
+            while chunks:
+                chunk, future = chunks.popleft(), futures.popleft()
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    results = None
+
+                if results is not None:
+                    yield from results
+                    continue
+
+                # all futures of a broken pool fail, files of the chunk are parsed one at a time to find the file
+                # which kills a process
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=1)
+                for file in chunk:
+                    try:
+                        result = executor.submit(MidiDataset.parse_file, file, backend).result()
+                    except BrokenProcessPool:
+                        result = None, 'BrokenProcessPool: the process which parsed the file terminated abruptly'
+                        executor.shutdown()
+                        executor = ProcessPoolExecutor(max_workers=1)
+                    yield result
+
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=ingest_workers)
+                futures = submit_chunks()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def iter_files(data_prefix, *, cache_path=None, ingest_workers=0, backend='music21'):
+        """
+        Yields (note_seq, offset_seq) of *.mid files with the prefix in the order of files, one file at a time.
+        Only new or changed files are parsed if the cache exists, files which could not be parsed are skipped
+        and are recorded in the cache, so they are skipped without parsing until they are changed.
+        The cache is saved after the last file, entries of files which do not match the prefix are dropped.
+        """
+        cache = CorpusCache(cache_path, backend=backend) if cache_path is not None else None
+
+        files = glob.glob(data_prefix + '*.mid')
+        is_cached = [cache is not None and file in cache for file in files]
+        to_parse = [file for file, cached in zip(files, is_cached) if not cached]
+
+        results = iter(tqdm(MidiDataset._parse_files(to_parse, backend, ingest_workers), total=len(to_parse),
+                            desc=f'Loading files with prefix [{data_prefix}]'))
+
+        n_failed = 0
+        for file, cached in zip(files, is_cached):
+            # cached files are yielded between parsed ones, so the order of files is kept
+            if cached:
+                if cache.error(file) is not None:
+                    n_failed += 1
+                    continue
+                yield cache.get(file)
+                continue
+
+            result, error = next(results)
+            if error is not None:
+                logger.warning(f'File {file} was skipped: {error}')
+                if cache is not None:
+                    cache.put(file, [], [], error=error)
+                n_failed += 1
+                continue
+
+            if cache is not None:
+                cache.put(file, *result)
+            yield result
+
+        if cache is not None:
+            cache.prune(files)
+            cache.save()
+            logger.info(f'{len(files) - len(to_parse)} files were loaded from cache, '
+                        f'{len(to_parse)} files were parsed.')
+
+        if n_failed > 0:
+            logger.warning(f'{n_failed} files could not be parsed and were skipped.')
+
     def __load_files(self):
-        self.note_seqs = []
-        self.offset_seqs = []
+        encoded = list(self.iter_files(self.data_prefix, cache_path=self.cache_path,
+                                       ingest_workers=self.ingest_workers, backend=self.backend))
 
-        files = tqdm(glob.glob(self.data_prefix + '*.mid'), desc=f'Loading files with prefix [{self.data_prefix}]')
-        for file in files:
-            raw_notes = MidiDataset.load_raw_notes(file)
-            note_seq, offset_seq = MidiDataset.encode_notes(raw_notes)
+        return [e[0] for e in encoded], [e[1] for e in encoded]
 
-            self.note_seqs.append(note_seq)
-            self.offset_seqs.append(offset_seq)
+    @staticmethod
+    def _content_hash(note_seq, offset_seq):
+        content = hashlib.blake2b('\x00'.join(note_seq).encode(), digest_size=16)
+        content.update(np.asarray(offset_seq, dtype=np.float32).tobytes())
 
-    def __len__(self):
-        return self.expand_coef * len(self.note_seqs)
+        return content.digest()
 
-    def __getitem__(self, idx):
-        idx = idx % len(self.note_seqs)
+    @staticmethod
+    def _split_point(content_hash):
+        """
+        Returns a point in [0, 1) of the file, files with points below `valid_ratio` are held out.
+        The same files get the same point, so copies are not split.
+        """
+        return int.from_bytes(content_hash[:8], 'little') / 2 ** 64
+
+    def __select_files(self, note_seqs, offset_seqs):
+        """
+        Drops files which are too short to give a window and, if `deduplicate`, files which were already seen.
+        """
+        selected, seen = [], set()
+        n_short, n_duplicates = 0, 0
+        for i, (note_seq, offset_seq) in enumerate(zip(note_seqs, offset_seqs)):
+            if len(note_seq) < 3:
+                n_short += 1
+                continue
+
+            if self.deduplicate:
+                content_hash = self._content_hash(note_seq, offset_seq)
+                if content_hash in seen:
+                    n_duplicates += 1
+                    continue
+                seen.add(content_hash)
+
+            selected.append(i)
+
+        if n_short > 0:
+            logger.info(f'{n_short} files with less than 3 notes were skipped.')
+        if n_duplicates > 0:
+            logger.info(f'{n_duplicates} duplicate files were skipped.')
+
+        return [note_seqs[i] for i in selected], [offset_seqs[i] for i in selected]
+
+    def __split_files(self, note_seqs, offset_seqs):
+        """
+        Returns (train, valid) pairs of note and offset sequences, valid is None if `valid_ratio` is 0.
+        """
+        if self.valid_ratio == 0:
+            return (note_seqs, offset_seqs), None
+
+        assert 0 < self.valid_ratio < 1
+        assert len(note_seqs) > 1, 'At least two files are needed to hold out validation files.'
+
+        points = np.array([self._split_point(self._content_hash(*seqs)) for seqs in zip(note_seqs, offset_seqs)])
+        is_valid = points < self.valid_ratio
+        if not is_valid.any():
+            is_valid = points == points.min()
+        assert not is_valid.all(), 'All files were held out for validation.'
+
+        logger.info(f'{is_valid.sum()} of {len(note_seqs)} files were held out for validation.')
+
+        def select(seqs, mask):
+            return [seq for seq, m in zip(seqs, mask) if m]
+
+        return ((select(note_seqs, ~is_valid), select(offset_seqs, ~is_valid)),
+                (select(note_seqs, is_valid), select(offset_seqs, is_valid)))
+
+    def __build_store(self, note_seqs, offset_seqs):
+        """
+        Stores the whole corpus in two flat arrays, file `i` occupies `starts[i]:starts[i + 1]`.
+        """
+        self.starts = np.zeros(len(note_seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in note_seqs], out=self.starts[1:])
+
+        self.notes = np.empty(self.starts[-1], dtype=np.int32)
+        self.offsets = np.empty(self.starts[-1], dtype=np.float32)
+
+        for i, (note_seq, offset_seq) in enumerate(zip(note_seqs, offset_seqs)):
+            self.notes[self.starts[i]:self.starts[i + 1]] = self.vocab.encode(note_seq)
+            self.offsets[self.starts[i]:self.starts[i + 1]] = offset_seq
 
-        seq = self.note_seqs[idx]
-        offsets = self.offset_seqs[idx]
+    @property
+    def n_files(self):
+        return len(self.starts) - 1
+
+    def token_counts(self):
+        """
+        Returns counts of tokens (len(vocab),) in the dataset.
+        """
+        return np.bincount(self.notes, minlength=len(self.vocab))
+
+    def _arrays(self, position):
+        """
+        Returns (notes, offsets, position of their first item) of arrays which contain the position.
+        """
+        return self.notes, self.offsets, 0
+
+    def _gather(self, positions):
+        """
+        Returns notes and offsets at the positions, all positions of a row are in the same file.
+        """
+        return self.notes[positions], self.offsets[positions]
 
-        if len(seq) < 3:
-            # logger.info('Too short file was replaced with another one.')
-            return self.__getitem__(random.randint(0, len(self) - 1))
+    def __len__(self):
+        return self.expand_coef * self.n_files
+
+    def __getitem__(self, idx):
+        """
+        Returns views of the flat arrays, except prev offsets, which are copied to zero the first offset
+        without changing the flat arrays. Batches of `get_batch` are gathered without items.
+        """
+        idx = idx % self.n_files
 
-        start_idx = random.randint(0, len(seq) - 2)
+        # stored files have at least 3 notes
+        start, end = self.starts[idx], self.starts[idx + 1]
 
-        prevs = seq[start_idx:start_idx + self.seq_len]
-        nexts = seq[start_idx + 1:start_idx + self.seq_len + 1]
+        notes, offsets, base = self._arrays(start)
+        start_idx = start - base + random.randint(0, end - start - 2)
+        stop_idx = min(start_idx + self.seq_len, end - base - 1)
 
-        prev_offsets = offsets[start_idx:start_idx + self.seq_len]
-        next_offsets = offsets[start_idx + 1:start_idx + self.seq_len + 1]
+        prevs = notes[start_idx:stop_idx]
+        nexts = notes[start_idx + 1:stop_idx + 1]
 
-        if len(prevs) > len(nexts):
-            prevs = prevs[:-1]
-            prev_offsets = prev_offsets[:-1]
+        next_offsets = offsets[start_idx + 1:stop_idx + 1]
 
         # to make sure that the first note has zero offset
+        prev_offsets = offsets[start_idx:stop_idx].copy()
         prev_offsets[0] = 0
 
-        assert len(prevs) == len(nexts)
-
         return prevs, nexts, prev_offsets, next_offsets
+
+    def get_batch(self, starts, pin_memory=False, stream=False):
+        """
+        Gathers windows which start at `starts` positions of the flat arrays into padded tensors.
+        Windows are padded at the end, their lengths are returned as the fifth item (on CPU, for packing).
+
+        :param starts: array of start positions, see model.sampler.WindowBatchSampler
+        :param stream: windows continue windows of the previous batch (see model.sampler.StreamBatchSampler).
+            The first offset is zeroed only for windows which start files, and a BoolTensor of them is returned
+            as the last item, their hidden states should be reset.
+        """
+        file_idxs = np.searchsorted(self.starts, starts, side='right')
+        lengths = np.minimum(self.starts[file_idxs] - 1 - starts, self.seq_len)
+
+        batch_size, max_len = len(starts), lengths.max()
+
+        # inputs and targets are gathered at once as windows of `length + 1` notes,
+        # padded steps read the start of the window, so they stay in its file
+        positions = starts[:, None] + np.arange(max_len + 1)
+        positions = np.where(np.arange(max_len + 1) > lengths[:, None], starts[:, None], positions)
+        notes, offsets = self._gather(positions)
+
+        pad_mask = np.arange(max_len) >= lengths[:, None]
+
+        prevs, nexts = (torch.empty((batch_size, max_len), dtype=torch.long, pin_memory=pin_memory)
+                        for _ in range(2))
+        prev_offsets, next_offsets = (torch.empty((batch_size, max_len), dtype=torch.float, pin_memory=pin_memory)
+                                      for _ in range(2))
+
+        for out, values, shift, pad_value in ((prevs, notes, 0, self.vocab.pad_index),
+                                              (nexts, notes, 1, self.vocab.pad_index),
+                                              (prev_offsets, offsets, 0, 0),
+                                              (next_offsets, offsets, 1, 0)):
+            out_np = out.numpy()
+            out_np[:] = values[:, shift:shift + max_len]
+            out_np[pad_mask] = pad_value
+
+        if stream:
+            resets = np.isin(starts, self.starts)
+            # other windows keep the offset from the last note of the previous window
+            prev_offsets[torch.from_numpy(resets), 0] = 0
+
+            return prevs, nexts, prev_offsets, next_offsets, torch.from_numpy(lengths), torch.from_numpy(resets)
+
+        # to make sure that the first note has zero offset
+        prev_offsets[:, 0] = 0
+
+        return prevs, nexts, prev_offsets, next_offsets, torch.from_numpy(lengths)
@@ -0,0 +1,79 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+backends = ('gloo', 'nccl')
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initializes the process group from the environment of `torchrun` (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+    Returns (rank, local rank, world size), the process group is not initialized for a single process.
+
+    :param backend: 'gloo' works on CPU and GPU, 'nccl' only on GPU
+    """
+    assert backend in backends, f'Unknown backend: {backend}'
+
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+
+    dist.init_process_group(backend)
+
+    return dist.get_rank(), int(os.environ.get('LOCAL_RANK', 0)), world_size
+
+
+def destroy_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_gather(tensor):
+    """
+    Returns tensors of all processes stacked along the first dim, (1, ...) for a single process.
+    """
+    if get_world_size() == 1:
+        return tensor.unsqueeze(0)
+
+    tensors = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(tensors, tensor)
+
+    return torch.stack(tensors)
+
+
+def all_reduce_sum(tensor):
+    """
+    Returns the sum of the tensor over processes.
+    """
+    if get_world_size() == 1:
+        return tensor
+
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+
+    return tensor
+
+
+def all_reduce_mean(tensor):
+    """
+    Returns the mean of the tensor over processes.
+    """
+    return all_reduce_sum(tensor) / get_world_size()
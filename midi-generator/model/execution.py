@@ -0,0 +1,81 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+precisions = ('fp32', 'bf16', 'fp16')
+inference_modes = ('eager', 'script', 'compile')
+
+_dtypes = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device, precision):
+    """
+    Returns a context where ops run in `precision` if it is safe for them, weights and gradients stay in fp32.
+    """
+    assert precision in precisions, f'Unknown precision: {precision}'
+
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+
+    return torch.autocast(device.type, dtype=_dtypes[precision])
+
+
+def grad_scaler(device, precision):
+    """
+    Returns GradScaler which scales the loss for fp16, small fp16 gradients would underflow otherwise.
+    bf16 has the range of fp32, so the scaler is disabled for it and calls are passed through.
+    """
+    return torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+
+
+class _Step(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, offsets, h):
+        return self.model.step(x, offsets, h)
+
+
+class InferenceModel(nn.Module):
+    """
+    Wraps GRUNet for generation, `step` is traced with TorchScript and frozen ('script') or compiled
+    with torch.compile ('compile'). Other calls are passed to the model.
+
+    Weights are frozen into the traced step, so the wrapped model must not be changed after.
+    """
+
+    def __init__(self, model, mode):
+        super().__init__()
+
+        assert mode in inference_modes, f'Unknown inference mode: {mode}'
+
+        self.model = model.eval()
+        self.mode = mode
+
+        step = _Step(self.model)
+        if mode == 'script':
+            device = next(model.parameters()).device
+            example = (torch.zeros(1, dtype=torch.long, device=device),
+                       torch.zeros(1, device=device),
+                       torch.zeros((model.n_layers, 1, model.hidden_dim), device=device))
+            with torch.no_grad():
+                # the hidden state is updated in-place, so the traced graph does not depend on the batch size
+                step = torch.jit.optimize_for_inference(torch.jit.trace(step, example, check_trace=False))
+        elif mode == 'compile':
+            step = torch.compile(step)
+
+        self.compiled_step = step
+
+    def forward(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def step(self, x, offsets, h):
+        return self.compiled_step(x, offsets, h)
+
+    def init_hidden(self, batch_size, device):
+        return self.model.init_hidden(batch_size, device)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.model!r}, mode={self.mode})'
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 
@@ -16,23 +18,98 @@ class LabelSmoothingLossWithLogits(nn.Module):
 
         self.num_ignore_ixs = 1 + (0 <= self.ignore_index < self.n_classes)
 
-        self.criterion = nn.KLDivLoss(reduction='batchmean') if smoothing > 0 else nn.NLLLoss(ignore_index=ignore_index)
+        self.criterion = nn.NLLLoss(ignore_index=ignore_index)
 
     def forward(self, input_logits, targets):
 
         log_probas = torch.log_softmax(input_logits, dim=-1)
 
         if self.smoothing > 0:
-            batch_size = targets.size(0)
-            fill_value = self.smoothing / (self.n_classes - self.num_ignore_ixs)
+            return self._smoothed_loss(log_probas, targets)
+
+        return self.criterion(log_probas, targets)
 
-            with torch.no_grad():
-                target_dist = torch.full((batch_size, self.n_classes), fill_value=fill_value,
-                                         device=targets.device)
-                target_dist.scatter_(-1, targets.unsqueeze(-1), self.confidence)
-                if 0 <= self.ignore_index < self.n_classes:
-                    target_dist[:, self.ignore_index] = 0
+    def _smoothed_loss(self, log_probas, targets):
+        """
+        KL divergence with the smoothed target distribution (`confidence` for the target, `fill_value` for other
+        classes except ignore_index) which is computed from sums of log probabilities instead of the dense
+        distribution. Rows with ignore_index targets are ignored.
+        """
+        fill_value = self.smoothing / (self.n_classes - self.num_ignore_ixs)
 
-            targets = target_dist
+        target_log_probas = log_probas.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+        other_log_probas = log_probas.sum(dim=-1) - target_log_probas
+        if 0 <= self.ignore_index < self.n_classes:
+            other_log_probas = other_log_probas - log_probas[:, self.ignore_index]
 
-        return self.criterion(log_probas, targets)
+        # sum of target * log(target), 0 * log(0) is 0
+        entropy = self.smoothing * math.log(fill_value)
+        if self.confidence > 0:
+            entropy += self.confidence * math.log(self.confidence)
+
+        losses = entropy - self.confidence * target_log_probas - fill_value * other_log_probas
+
+        mask = torch.ne(targets, self.ignore_index)
+        return (losses * mask).sum() / mask.sum().clamp(min=1)
+
+
+class SampledSoftmaxLoss(nn.Module):
+    """
+    Approximates the (label smoothed) loss of the full softmax over `n_classes` for training with large
+    vocabularies. Instead of the projection to all classes, logits are computed for targets and `n_samples`
+    negative classes which are shared by the batch and drawn from `class_weights`. Logits are corrected
+    by log of the expected number of draws of a class, accidental hits of targets are masked.
+
+    :param projection: nn.Linear which gives class logits from features (GRUNet.fc_class)
+    :param class_weights: unnormalized probabilities of negative classes, e.g. counts of tokens ** 0.75
+    """
+
+    def __init__(self, projection, class_weights, *, n_samples, smoothing=0.0, ignore_index=-100):
+        super().__init__()
+
+        assert 0 <= smoothing <= 1
+
+        self.projection = projection
+        self.n_samples = n_samples
+        self.ignore_index = ignore_index
+
+        self.smoothing = smoothing
+        self.confidence = 1 - smoothing
+
+        probas = torch.as_tensor(class_weights, dtype=torch.float)
+        probas = probas / probas.sum()
+        self.register_buffer('probas', probas)
+        self.register_buffer('log_expected_counts', torch.log(n_samples * probas))
+
+    def forward(self, features, targets):
+        """
+        :param features: FloatTensor (n_tokens, hidden_dim), inputs of the projection
+        :param targets: LongTensor (n_tokens,)
+        """
+        samples = torch.multinomial(self.probas, self.n_samples, replacement=True)
+
+        weight, bias = self.projection.weight, self.projection.bias
+
+        target_logits = (features * weight[targets]).sum(dim=-1)
+        sample_logits = features @ weight[samples].t()
+        if bias is not None:
+            target_logits = target_logits + bias[targets]
+            sample_logits = sample_logits + bias[samples]
+
+        target_logits = target_logits - self.log_expected_counts[targets]
+        sample_logits = sample_logits - self.log_expected_counts[samples]
+
+        hits = torch.eq(samples.unsqueeze(0), targets.unsqueeze(-1))
+        sample_logits = sample_logits.masked_fill(hits, -float('inf'))
+
+        log_probas = torch.log_softmax(torch.cat([target_logits.unsqueeze(-1), sample_logits], dim=-1), dim=-1)
+
+        losses = -log_probas[:, 0]
+        if self.smoothing > 0:
+            # the smoothed mass is spread over the sampled negatives which are not hits
+            n_negatives = (~hits).sum(dim=-1).clamp(min=1)
+            negative_log_probas = log_probas[:, 1:].masked_fill(hits, 0).sum(dim=-1) / n_negatives
+            losses = self.confidence * losses - self.smoothing * negative_log_probas
+
+        mask = torch.ne(targets, self.ignore_index)
+        return (losses * mask).sum() / mask.sum().clamp(min=1)
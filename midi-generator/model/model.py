@@ -1,5 +1,14 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
+
+
+def pack_tokens(x, lengths):
+    """
+    Packs real tokens of x (batch_size, seq_len, ...) which is padded at the end, e.g. targets
+    for outputs of GRUNet.forward with `lengths`.
+    """
+    return pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
 
 
 class GRUNet(nn.Module):
@@ -26,20 +35,85 @@ class GRUNet(nn.Module):
         self.fc_offset = nn.Sequential(nn.Linear(hidden_dim, 1, bias=False),
                                        nn.ReLU())
 
-    def forward(self, x, offsets, h=None):
+    def forward(self, x, offsets, h=None, lengths=None, project=True):
+        """
+        :param project: if False, features (..., hidden_dim) are returned instead of class logits, they are
+            projected by the loss (see model.loss.SampledSoftmaxLoss)
+        :param lengths: LongTensor (batch_size,) on CPU with lengths of sequences which are padded at the end.
+            If given, outputs are computed only for real tokens: (n_tokens, num_embeddings) and (n_tokens, 1)
+            in the order of `pack_tokens`. On GPU, GRU also skips padded time steps. On CPU, the packed GRU
+            is several times slower than the padded one, so padded steps are computed, but h is undefined
+            for padded sequences.
+        """
         if h is None:
             h = self.init_hidden(x.size(0), x.device)
         embedded_x = self.norm(self.emb(x) + self.off(offsets.unsqueeze(-1)))
 
+        if lengths is not None and x.is_cuda:
+            embedded_x = pack_tokens(embedded_x, lengths)
+
         rnn_out, h = self.gru(embedded_x, h)
 
+        if lengths is not None:
+            rnn_out = rnn_out.data if isinstance(rnn_out, PackedSequence) else pack_tokens(rnn_out, lengths).data
+
         features = self.extract(rnn_out)
 
-        class_out = self.fc_class(features)
+        class_out = self.fc_class(features) if project else features
         offset_out = self.fc_offset(features)
 
         return class_out, offset_out, h
 
+    def step(self, x, offsets, h):
+        """
+        Inference path of forward for a single time step. GRU layers are applied with gru_cell
+        and the hidden state is updated in-place, so no new hidden state tensors are created.
+
+        :param x: LongTensor (batch_size,)
+        :param offsets: FloatTensor (batch_size,)
+        :param h: FloatTensor (n_layers, batch_size, hidden_dim)
+        :return: class logits (batch_size, num_embeddings) and offsets (batch_size,)
+        """
+        layer_input = self.norm(self.emb(x) + self.off(offsets.unsqueeze(-1)))
+
+        if isinstance(self.gru, nn.GRU):
+            for layer_i, weights in enumerate(self.gru.all_weights):
+                h[layer_i] = torch.gru_cell(layer_input, h[layer_i], *weights)
+                layer_input = h[layer_i]
+        else:
+            # the quantized GRU (see model.quantization) keeps packed weights, all layers are stepped at once
+            _, next_h = self.gru(layer_input.unsqueeze(1), h)
+            h.copy_(next_h)
+            layer_input = h[-1]
+
+        features = self.extract(layer_input)
+
+        class_out = self.fc_class(features)
+        offset_out = self.fc_offset(features).squeeze(-1)
+
+        return class_out, offset_out
+
+    def resize_vocab(self, num_embeddings):
+        """
+        Extends the embedding and the class projection with new rows for new notes, which are initialized as in
+        new layers. Rows of known notes are kept.
+        """
+        assert num_embeddings >= self.num_embeddings
+
+        emb = nn.Embedding(num_embeddings, self.hidden_dim).to(self.emb.weight.device)
+        fc_class = nn.Linear(self.hidden_dim, num_embeddings, bias=False).to(self.fc_class.weight.device)
+        with torch.no_grad():
+            emb.weight[:self.num_embeddings] = self.emb.weight
+            fc_class.weight[:self.num_embeddings] = self.fc_class.weight
+
+        self.emb, self.fc_class = emb, fc_class
+        self.num_embeddings = num_embeddings
+
+    @property
+    def config(self):
+        return {'num_embeddings': self.num_embeddings, 'hidden_dim': self.hidden_dim, 'n_layers': self.n_layers,
+                'drop_prob': self.drop_prob}
+
     def init_hidden(self, batch_size, device):
         hidden = torch.zeros((self.n_layers, batch_size, self.hidden_dim),
                              dtype=torch.float, device=device, requires_grad=True)
@@ -0,0 +1,49 @@
+import torch
+
+
+class DevicePrefetcher:
+    """
+    Wraps DataLoader and moves the next batch to the device while the current one is processed.
+
+    On CUDA the copy is issued with `non_blocking=True` on a side stream, so it overlaps with the compute
+    of the current step if the batch is in pinned memory. On CPU batches are returned as they are.
+
+    Items of the batch with indices from `host_items` (e.g. lengths of sequences which are needed
+    on the host for packing) are not moved.
+    """
+
+    def __init__(self, dataloader, device, host_items=()):
+        self.dataloader = dataloader
+        self.device = device
+        self.host_items = host_items
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch, stream):
+        if batch is None or stream is None:
+            return batch
+
+        with torch.cuda.stream(stream):
+            return tuple(t if i in self.host_items else t.to(self.device, non_blocking=True)
+                         for i, t in enumerate(batch))
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        data_iter = iter(self.dataloader)
+
+        next_batch = self._to_device(next(data_iter, None), stream)
+        while next_batch is not None:
+            batch = next_batch
+
+            if stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(stream)
+                for i, t in enumerate(batch):
+                    # memory of the batch must not be reused before the current stream is done with it
+                    if i not in self.host_items:
+                        t.record_stream(current_stream)
+
+            next_batch = self._to_device(next(data_iter, None), stream)
+
+            yield batch
@@ -0,0 +1,135 @@
+import contextlib
+import resource
+import time
+from collections import defaultdict
+
+import torch
+
+
+class StepStats:
+    """
+    Collects throughput statistics of training steps without synchronization with the device.
+
+    Data wait is the host time spent waiting for the next batch. Durations of regions (e.g. compute and
+    optimizer step) are measured with CUDA events on GPU, the events are read only in `collect`. On CPU
+    operations are synchronous, so host time is used. Counts of tokens are accumulated on the device.
+    If the stats are disabled, all methods are no-ops.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self._cuda = device.type == 'cuda'
+        self._reset()
+
+    def _reset(self):
+        self._start_time = time.perf_counter()
+        self._data_wait = 0.0
+        self._host_times = defaultdict(float)
+        self._events = defaultdict(list)
+        self._n_batches = 0
+        self._n_samples = 0
+        self._n_tokens = torch.zeros((), dtype=torch.long, device=self.device)
+
+        if self.enabled and self._cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def iterate(self, iterable):
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._data_wait += time.perf_counter() - start
+
+            yield batch
+
+    @contextlib.contextmanager
+    def region(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if self._cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events[name].append((start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self._host_times[name] += time.perf_counter() - start
+
+    def add_batch(self, n_samples, n_tokens):
+        """
+        :param n_samples: number of sequences in the batch
+        :param n_tokens: number of not padded tokens in the batch, a tensor is not read until `collect`
+        """
+        if not self.enabled:
+            return
+
+        self._n_batches += 1
+        self._n_samples += n_samples
+        self._n_tokens += n_tokens
+
+    def _peak_memory_mb(self):
+        if self._cuda:
+            return torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        # peak resident set size of the process, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def collect(self):
+        """
+        Returns statistics since the previous call and resets them. On GPU it waits for the recorded events.
+        """
+        if not self.enabled or self._n_batches == 0:
+            return {}
+
+        region_times = dict(self._host_times)
+        for name, events in self._events.items():
+            events[-1][1].synchronize()
+            region_times[name] = sum(start.elapsed_time(end) for start, end in events) / 1000
+
+        elapsed = time.perf_counter() - self._start_time
+        n_tokens = self._n_tokens.item()
+
+        stats = {'data_wait_ms': 1000 * self._data_wait / self._n_batches,
+                 'data_wait_fraction': self._data_wait / elapsed,
+                 'samples_per_s': self._n_samples / elapsed,
+                 'tokens_per_s': n_tokens / elapsed,
+                 'peak_memory_mb': self._peak_memory_mb()}
+        for name, seconds in region_times.items():
+            stats[f'{name}_ms'] = 1000 * seconds / self._n_batches
+
+        self._reset()
+
+        return stats
+
+
+def make_profiler(steps, trace_dir, device):
+    """
+    Returns torch.profiler which records batches `steps[0]:steps[1]` (counted from the start of training)
+    and writes traces for TensorBoard to `trace_dir`. The profiler should be stepped after every batch.
+    """
+    start, stop = steps
+    assert 0 <= start < stop
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    warmup = min(start, 1)
+    schedule = torch.profiler.schedule(wait=start - warmup, warmup=warmup, active=stop - start, repeat=1)
+
+    return torch.profiler.profile(activities=activities,
+                                  schedule=schedule,
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(str(trace_dir)),
+                                  record_shapes=True,
+                                  profile_memory=True)
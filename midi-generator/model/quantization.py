@@ -0,0 +1,101 @@
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+from .model import GRUNet
+
+# GRU and output layers have the most of weights and compute per token, inputs are small and stay in fp32
+quantized_modules = ('gru', 'fc_class', 'fc_offset.0')
+
+_per_channel_schemes = (torch.per_channel_affine, torch.per_channel_symmetric)
+
+
+def quantize_model(model):
+    """
+    Returns a copy of GRUNet where GRU and output layers are dynamically quantized to int8: weights are stored
+    in int8 with per-channel scales, activations are quantized on the fly. Quantized models run only on CPU.
+    """
+    model = model.cpu().eval()
+    return quantize_dynamic(model, {name: per_channel_dynamic_qconfig for name in quantized_modules},
+                            dtype=torch.qint8)
+
+
+def _quantized_weights(module):
+    if isinstance(module, nnqd.GRU):
+        return module.get_weight(), module.get_bias()
+
+    biases = {} if module.bias() is None else {'bias': module.bias()}
+    return {'weight': module.weight()}, biases
+
+
+def quantized_tensors(model):
+    """
+    Returns ({name: tensor}, {name: quantization params}) of the quantized model. Quantized weights are stored
+    as int8 tensors, per-channel scales and zero points are stored as tensors `{name}.scales`, `{name}.zero_points`.
+    """
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+
+    params = {}
+    for module_name in quantized_modules:
+        weights, biases = _quantized_weights(model.get_submodule(module_name))
+
+        for key, weight in weights.items():
+            name = f'{module_name}.{key}'
+            tensors[name] = weight.int_repr()
+
+            if weight.qscheme() in _per_channel_schemes:
+                tensors[f'{name}.scales'] = weight.q_per_channel_scales()
+                tensors[f'{name}.zero_points'] = weight.q_per_channel_zero_points()
+                params[name] = {'axis': weight.q_per_channel_axis()}
+            else:
+                params[name] = {'scale': weight.q_scale(), 'zero_point': weight.q_zero_point()}
+
+        for key, bias in biases.items():
+            tensors[f'{module_name}.{key}'] = bias
+
+    return tensors, params
+
+
+def _quantized_weight(name, tensors, params):
+    if 'axis' in params[name]:
+        return torch._make_per_channel_quantized_tensor(tensors[name], tensors[f'{name}.scales'],
+                                                        tensors[f'{name}.zero_points'], params[name]['axis'])
+
+    return torch._make_per_tensor_quantized_tensor(tensors[name], params[name]['scale'], params[name]['zero_point'])
+
+
+def load_quantized_model(config, tensors, params):
+    """
+    Builds the quantized GRUNet from `quantized_tensors`. Unquantized weights are assigned without copies,
+    quantized ones are packed for int8 kernels.
+    """
+    with torch.device('meta'):
+        model = GRUNet(**config)
+
+    state_dict = {name: tensor for name, tensor in tensors.items() if not name.startswith(quantized_modules)}
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+    for module_name in quantized_modules:
+        parent_name, _, child_name = module_name.rpartition('.')
+        float_module = model.get_submodule(module_name)
+
+        if isinstance(float_module, torch.nn.GRU):
+            module = nnqd.GRU(float_module.input_size, float_module.hidden_size, float_module.num_layers,
+                              batch_first=True, dropout=float_module.dropout, dtype=torch.qint8)
+            weights = {}
+            for name in float_module._flat_weights_names:
+                full_name = f'{module_name}.{name}'
+                weights[name] = (_quantized_weight(full_name, tensors, params) if name.startswith('weight')
+                                 else tensors[full_name])
+            module.set_weight_bias(weights)
+        else:
+            has_bias = f'{module_name}.bias' in tensors
+            module = nnqd.Linear(float_module.in_features, float_module.out_features, bias_=has_bias,
+                                 dtype=torch.qint8)
+            module.set_weight_bias(_quantized_weight(f'{module_name}.weight', tensors, params),
+                                   tensors[f'{module_name}.bias'] if has_bias else None)
+
+        setattr(model.get_submodule(parent_name), child_name, module)
+
+    return model.eval()
@@ -0,0 +1,232 @@
+from itertools import islice
+
+import numpy as np
+from torch.utils.data import Dataset, Sampler
+
+
+def consecutive_windows(file_starts, n_positions, seq_len):
+    """
+    Returns start positions of consecutive windows of `seq_len` notes of every file, in the order of files.
+
+    :param n_positions: numbers of valid start positions of files
+    """
+    n_windows = -(-n_positions // seq_len)
+    window_files = np.repeat(np.arange(len(file_starts)), n_windows)
+    first_windows = np.cumsum(n_windows) - n_windows
+    window_idxs = np.arange(len(window_files)) - first_windows[window_files]
+
+    return file_starts[window_files] + window_idxs * seq_len
+
+
+class WindowBatchSampler(Sampler):
+    """
+    Yields arrays with start positions of windows in the flat arrays of MidiDataset, one array per batch.
+
+    Like MidiDataset.__getitem__, a file is drawn uniformly and then a start position is drawn uniformly
+    inside the file, but the whole batch is drawn at once over the precomputed index of valid positions.
+
+    Windows which start near the end of a file are shorter than `seq_len` and are padded in a batch. Modes:
+    'uniform' - start positions are drawn over the whole file;
+    'full' - only windows of full length are drawn, files shorter than `seq_len` give one window from the start;
+    'bucket' - windows are drawn as in 'uniform' for `bucket_size` batches at once, sorted by length
+    and split into batches, which are yielded in random order;
+    'tokens' - start positions are drawn uniformly over all valid positions of the corpus, so files are
+    drawn proportionally to their length instead of uniformly;
+    'stratified' - every file is split into consecutive windows of `seq_len` notes and an epoch is a shuffled
+    order of all windows of the corpus, so every note is seen once per epoch. The epoch is
+    `ceil(n_windows / batch_size)` batches by default, the last batch is completed from the next order.
+
+    Batches of an epoch are defined by `seed`, it is drawn from the global state if it is None. The first
+    `start_batch` batches are skipped, so an interrupted epoch can be continued with the same seed.
+
+    For data-parallel training, every process draws the same `n_batches` batches (all processes must have
+    the same seed) and takes every `num_replicas`-th of them starting from `rank`.
+    """
+
+    modes = ('uniform', 'full', 'bucket', 'tokens', 'stratified')
+
+    def __init__(self, dataset, *, batch_size, n_batches=None, mode='uniform', bucket_size=32, num_replicas=1,
+                 rank=0):
+        assert mode in self.modes, f'Unknown sampling mode: {mode}'
+        assert 0 <= rank < num_replicas
+
+        lengths = np.diff(dataset.starts)
+        valid_files = lengths >= 3
+
+        # file `i` has valid start positions file_starts[i]:file_starts[i] + n_positions[i]
+        self.file_starts = dataset.starts[:-1][valid_files]
+        self.file_ends = dataset.starts[1:][valid_files]
+        self.n_positions = lengths[valid_files] - 1
+        if mode == 'full':
+            # a window which starts at `start` has min(end - 1 - start, seq_len) inputs
+            self.n_positions = np.maximum(lengths[valid_files] - dataset.seq_len, 1)
+
+        assert len(self.file_starts) > 0, 'There are no files with at least 3 notes.'
+
+        # index of valid positions: position `k` of the corpus is in file `searchsorted(position_ends, k, 'right')`
+        self.position_ends = np.cumsum(self.n_positions)
+
+        if mode == 'stratified':
+            self.window_starts = consecutive_windows(self.file_starts, self.n_positions, dataset.seq_len)
+
+            if n_batches is None:
+                n_batches = -(-len(self.window_starts) // batch_size)
+
+        self.seq_len = dataset.seq_len
+        self.batch_size = batch_size
+        self.n_batches = len(dataset) // batch_size if n_batches is None else n_batches
+        self.mode = mode
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        self.seed = None
+        self.start_batch = 0
+
+    def __len__(self):
+        # processes get the same number of batches, the rest of batches is dropped
+        return self.n_batches // self.num_replicas - self.start_batch
+
+    def _draw(self, rng, size):
+        if self.mode == 'tokens':
+            positions = rng.integers(0, self.position_ends[-1], size=size)
+            file_idxs = np.searchsorted(self.position_ends, positions, side='right')
+            starts = self.file_starts[file_idxs] + positions - (self.position_ends[file_idxs] -
+                                                                self.n_positions[file_idxs])
+
+            return starts, file_idxs
+
+        file_idxs = rng.integers(0, len(self.file_starts), size=size)
+        starts = self.file_starts[file_idxs] + rng.integers(0, self.n_positions[file_idxs])
+
+        return starts, file_idxs
+
+    def __iter__(self):
+        # seeded from the global state to be reproducible with utils.seed.set_seed
+        seed = np.random.randint(2 ** 31) if self.seed is None else self.seed
+        rng = np.random.default_rng(seed)
+
+        n_batches = self.n_batches // self.num_replicas * self.num_replicas
+        batches = islice(self._batches(rng), self.rank, n_batches, self.num_replicas)
+
+        return islice(batches, self.start_batch, None)
+
+    def _window_stream(self, rng):
+        while True:
+            yield from self.window_starts[rng.permutation(len(self.window_starts))]
+
+    def _batches(self, rng):
+        if self.mode == 'stratified':
+            windows = self._window_stream(rng)
+            for _ in range(self.n_batches):
+                yield np.fromiter(islice(windows, self.batch_size), dtype=np.int64, count=self.batch_size)
+            return
+
+        if self.mode != 'bucket':
+            for _ in range(self.n_batches):
+                yield self._draw(rng, self.batch_size)[0]
+            return
+
+        for first_batch in range(0, self.n_batches, self.bucket_size):
+            n_batches = min(self.bucket_size, self.n_batches - first_batch)
+
+            starts, file_idxs = self._draw(rng, n_batches * self.batch_size)
+            lengths = np.minimum(self.file_ends[file_idxs] - 1 - starts, self.seq_len)
+            batches = starts[np.argsort(lengths, kind='stable')].reshape(n_batches, self.batch_size)
+
+            yield from batches[rng.permutation(n_batches)]
+
+
+class StreamBatchSampler(WindowBatchSampler):
+    """
+    Yields start positions of consecutive windows for training with the hidden state which is carried between
+    batches (truncated BPTT). Every item of a batch is a lane which walks through a file window by window,
+    the next window starts with the last target of the previous one. When a file ends, the lane continues
+    with the next file, files are taken in random order. Only the last window of a file can be shorter
+    than `seq_len`.
+
+    Lanes of processes of data-parallel training are drawn independently, every process gets
+    `n_batches // num_replicas` batches.
+    """
+
+    def __init__(self, dataset, *, batch_size, n_batches=None, num_replicas=1, rank=0):
+        super().__init__(dataset, batch_size=batch_size, n_batches=n_batches, num_replicas=num_replicas, rank=rank)
+
+    def __iter__(self):
+        seed = np.random.randint(2 ** 31) if self.seed is None else self.seed
+        rng = np.random.default_rng([seed, self.rank])
+
+        return islice(self._batches(rng), self.start_batch, None)
+
+    def _file_stream(self, rng):
+        while True:
+            yield from rng.permutation(len(self.file_starts))
+
+    def _batches(self, rng):
+        files = self._file_stream(rng)
+
+        lane_files = np.fromiter(islice(files, self.batch_size), dtype=np.int64, count=self.batch_size)
+        positions = self.file_starts[lane_files]
+
+        for _ in range(self.n_batches // self.num_replicas):
+            yield positions
+
+            # a window needs at least two notes: an input and a target
+            positions = positions + self.seq_len
+            ended = positions >= self.file_ends[lane_files] - 1
+
+            n_ended = int(ended.sum())
+            if n_ended > 0:
+                lane_files[ended] = np.fromiter(islice(files, n_ended), dtype=np.int64, count=n_ended)
+                positions[ended] = self.file_starts[lane_files[ended]]
+
+
+class EvalBatchSampler(Sampler):
+    """
+    Yields start positions of the fixed windows of a held-out dataset, the same batches on every pass.
+    Every file is split into consecutive windows of `seq_len` notes, so every note is scored once.
+    Windows are sorted by length before they are split into batches, so only a few batches are padded.
+
+    :param max_windows: if there are more windows, a fixed random subset of them is evaluated
+    For data-parallel training, every process takes every `num_replicas`-th batch starting from `rank`.
+    """
+
+    def __init__(self, dataset, *, batch_size, max_windows=None, num_replicas=1, rank=0, seed=0):
+        assert 0 <= rank < num_replicas
+
+        lengths = np.diff(dataset.starts)
+        file_starts, file_ends = dataset.starts[:-1][lengths >= 3], dataset.starts[1:][lengths >= 3]
+
+        window_starts = consecutive_windows(file_starts, file_ends - file_starts - 1, dataset.seq_len)
+        if max_windows is not None and len(window_starts) > max_windows:
+            window_starts = np.sort(np.random.default_rng(seed).choice(window_starts, max_windows, replace=False))
+
+        file_idxs = np.searchsorted(file_ends, window_starts, side='right')
+        window_lengths = np.minimum(file_ends[file_idxs] - 1 - window_starts, dataset.seq_len)
+        window_starts = window_starts[np.argsort(-window_lengths, kind='stable')]
+
+        batches = np.split(window_starts, np.arange(batch_size, len(window_starts), batch_size))
+        self.batches = batches[rank::num_replicas]
+        self.n_windows = len(window_starts)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+class WindowBatchDataset(Dataset):
+    """
+    Adapts MidiDataset to DataLoader with `batch_size=None`: an item is a whole batch of windows.
+
+    :param stream: windows are consecutive windows of StreamBatchSampler, see MidiDataset.get_batch
+    """
+
+    def __init__(self, dataset, *, pin_memory=False, stream=False):
+        self.dataset = dataset
+        self.pin_memory = pin_memory
+        self.stream = stream
+
+    def __getitem__(self, starts):
+        return self.dataset.get_batch(starts, pin_memory=self.pin_memory, stream=self.stream)
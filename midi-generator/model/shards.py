@@ -0,0 +1,296 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from .dataset import MidiDataset, Vocab
+
+logger = logging.getLogger(__file__)
+
+_version = 1
+_manifest_name = 'manifest.json'
+_vocab_name = 'vocab.json'
+_splits = ('train', 'valid')
+
+# notes are remapped in chunks, so rewriting a shard does not read it into memory
+_remap_chunk = 1 << 22
+
+
+def _shard_paths(shard_dir, name):
+    return {key: os.path.join(shard_dir, f'{name}.{key}.npy') for key in ('notes', 'offsets', 'starts')}
+
+
+def _save_array(path, array):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class _ShardWriter:
+    """
+    Collects files of a split and writes them to shards of about `shard_size` notes. A file is never split
+    between shards, a file which is longer than `shard_size` gets its own shard.
+    """
+
+    def __init__(self, shard_dir, split, shard_size):
+        self.shard_dir = shard_dir
+        self.split = split
+        self.shard_size = shard_size
+
+        self.shards = []
+        self._notes, self._offsets, self._lengths = [], [], []
+        self._n_notes = 0
+
+    @property
+    def n_files(self):
+        return sum(shard['n_files'] for shard in self.shards) + len(self._lengths)
+
+    def add(self, ids, offsets):
+        if self._n_notes > 0 and self._n_notes + len(ids) > self.shard_size:
+            self.flush()
+
+        self._notes.append(ids)
+        self._offsets.append(offsets)
+        self._lengths.append(len(ids))
+        self._n_notes += len(ids)
+
+    def flush(self):
+        if self._n_notes == 0:
+            return
+
+        name = f'{self.split}-{len(self.shards):05d}'
+        paths = _shard_paths(self.shard_dir, name)
+
+        starts = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+        np.cumsum(self._lengths, out=starts[1:])
+
+        _save_array(paths['notes'], np.concatenate(self._notes))
+        _save_array(paths['offsets'], np.concatenate(self._offsets))
+        _save_array(paths['starts'], starts)
+
+        self.shards.append({'name': name, 'n_files': len(self._lengths), 'n_notes': self._n_notes})
+        self._notes, self._offsets, self._lengths = [], [], []
+        self._n_notes = 0
+
+
+def build_shards(encoded_files, shard_dir, *, shard_size=1 << 24, vocab=None, deduplicate=False, valid_ratio=0):
+    """
+    Writes a corpus to memory-mapped shards which are read by ShardedMidiDataset. Files are encoded and written
+    one by one, so memory is bounded by the size of a shard and does not depend on the size of the corpus.
+
+    Every shard is a set of .npy files: `{split}-{i}.notes.npy` (int32 token ids), `.offsets.npy` (float32)
+    and `.starts.npy` (int64 start positions of files in the shard). The vocab is written to `vocab.json`
+    and shards with counts of tokens to `manifest.json`, which is written last.
+
+    Files are selected and split as in MidiDataset: files with less than 3 notes are skipped (their notes are in
+    the vocab), duplicates are skipped if `deduplicate` and files are held out to the 'valid' split by the hash
+    of their content. If no file falls below `valid_ratio`, the file with the lowest point is held out, so
+    train files with the lowest point are kept in memory until the first validation file is seen.
+
+    :param encoded_files: iterable of (note_seq, offset_seq), e.g. MidiDataset.iter_files
+    :param shard_size: number of notes in a shard, 16M notes are 128 MB of notes and offsets
+    :param vocab: base Vocab, ids of its notes are kept and new notes are appended as in MidiDataset
+    """
+    assert 0 <= valid_ratio < 1
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # ids are given to new notes in the order of appearance and are remapped to ids of sorted notes at the end
+    base_notes = list(vocab.unique_notes) if vocab is not None else []
+    note2id = {n: i for i, n in enumerate(base_notes, start=1)}
+    new_notes = []
+
+    writers = {split: _ShardWriter(shard_dir, split, shard_size) for split in _splits}
+    counts = np.zeros(len(note2id) + 1, dtype=np.int64)
+    seen = set()
+    n_short, n_duplicates = 0, 0
+
+    # train files with the lowest point, which are held out if no file falls below `valid_ratio`
+    candidates, min_point = [], 1
+
+    def add_train(ids, offsets):
+        nonlocal counts
+        writers['train'].add(ids, offsets)
+        file_counts = np.bincount(ids, minlength=len(counts))
+        counts = np.pad(counts, (0, len(file_counts) - len(counts))) + file_counts
+
+    for note_seq, offset_seq in encoded_files:
+        for n in note_seq:
+            if n not in note2id:
+                note2id[n] = len(note2id) + 1
+                new_notes.append(n)
+
+        if len(note_seq) < 3:
+            n_short += 1
+            continue
+
+        content_hash = MidiDataset._content_hash(note_seq, offset_seq)
+        if deduplicate:
+            if content_hash in seen:
+                n_duplicates += 1
+                continue
+            seen.add(content_hash)
+
+        ids = np.array([note2id[n] for n in note_seq], dtype=np.int32)
+        offsets = np.asarray(offset_seq, dtype=np.float32)
+        point = MidiDataset._split_point(content_hash)
+
+        if point < valid_ratio:
+            writers['valid'].add(ids, offsets)
+            for candidate in candidates:
+                add_train(*candidate)
+            candidates = []
+        elif valid_ratio > 0 and writers['valid'].n_files == 0 and point <= min_point:
+            if point < min_point:
+                for candidate in candidates:
+                    add_train(*candidate)
+                candidates, min_point = [], point
+            candidates.append((ids, offsets))
+        else:
+            add_train(ids, offsets)
+
+    if candidates:
+        if writers['train'].n_files > 0:
+            for candidate in candidates:
+                writers['valid'].add(*candidate)
+        else:
+            for candidate in candidates:
+                add_train(*candidate)
+
+    for writer in writers.values():
+        writer.flush()
+
+    if n_short > 0:
+        logger.info(f'{n_short} files with less than 3 notes were skipped.')
+    if n_duplicates > 0:
+        logger.info(f'{n_duplicates} duplicate files were skipped.')
+    assert writers['train'].shards, 'There are no files with at least 3 notes.'
+    assert valid_ratio == 0 or writers['valid'].shards, 'At least two files are needed to hold out validation files.'
+
+    unique_notes = base_notes + sorted(new_notes)
+    mapping = np.zeros(len(note2id) + 1, dtype=np.int32)
+    mapping[[note2id[n] for n in unique_notes]] = np.arange(1, len(unique_notes) + 1)
+
+    if not np.array_equal(mapping, np.arange(len(mapping))):
+        for writer in writers.values():
+            for shard in writer.shards:
+                notes = np.load(_shard_paths(shard_dir, shard['name'])['notes'], mmap_mode='r+')
+                for i in range(0, len(notes), _remap_chunk):
+                    notes[i:i + _remap_chunk] = mapping[notes[i:i + _remap_chunk]]
+                notes.flush()
+                del notes
+
+    token_counts = np.zeros(len(mapping), dtype=np.int64)
+    token_counts[mapping] = np.pad(counts, (0, len(mapping) - len(counts)))
+
+    with open(os.path.join(shard_dir, _vocab_name), 'w') as f:
+        json.dump({'unique_notes': unique_notes}, f)
+
+    manifest = {'version': _version,
+                'shard_size': shard_size,
+                'splits': {split: writer.shards for split, writer in writers.items() if writer.shards},
+                'token_counts': token_counts.tolist()}
+
+    tmp_path = os.path.join(shard_dir, f'{_manifest_name}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(shard_dir, _manifest_name))
+
+    logger.info(f'{sum(writer.n_files for writer in writers.values())} files were written to shards in {shard_dir}: ' +
+                ', '.join(f'{split} - {sum(s["n_files"] for s in shards)} files in {len(shards)} shards'
+                          for split, shards in manifest['splits'].items()) + '.')
+
+    return manifest
+
+
+def load_vocab(shard_dir):
+    with open(os.path.join(shard_dir, _vocab_name)) as f:
+        return Vocab(json.load(f)['unique_notes'])
+
+
+class ShardedMidiDataset(MidiDataset):
+    """
+    MidiDataset which reads windows from shards of `build_shards` by memory maps, so notes are not loaded into
+    the memory of the process and pages of shards are shared by DataLoader workers and processes of
+    data-parallel training. Only start positions of files are kept in memory.
+
+    Positions of the flat arrays are positions of the concatenation of shards, so samplers of model.sampler
+    are used as with MidiDataset. Held-out files of the 'valid' split are `valid_dataset`.
+    """
+
+    def __init__(self, shard_dir, *, seq_len, expand_coef, split='train'):
+        with open(os.path.join(shard_dir, _manifest_name)) as f:
+            manifest = json.load(f)
+        assert manifest['version'] == _version, f'{shard_dir} has unsupported version {manifest["version"]}.'
+        assert split in manifest['splits'], f'{shard_dir} has no {split} split.'
+
+        self.shard_dir = shard_dir
+        self.split = split
+        self.seq_len = seq_len
+        self.expand_coef = expand_coef
+
+        self.vocab = load_vocab(shard_dir)
+        self._token_counts = np.array(manifest['token_counts'], dtype=np.int64)
+
+        shards = manifest['splits'][split]
+        self.shard_names = [shard['name'] for shard in shards]
+
+        # shard `i` occupies shard_starts[i]:shard_starts[i + 1] of the flat arrays
+        self.shard_starts = np.zeros(len(shards) + 1, dtype=np.int64)
+        np.cumsum([shard['n_notes'] for shard in shards], out=self.shard_starts[1:])
+
+        file_starts = [np.load(_shard_paths(shard_dir, name)['starts'])[:-1] + shard_start
+                       for name, shard_start in zip(self.shard_names, self.shard_starts)]
+        self.starts = np.concatenate(file_starts + [self.shard_starts[-1:]])
+
+        self.__open_shards()
+
+        self.valid_dataset = None
+        if split == 'train' and 'valid' in manifest['splits']:
+            self.valid_dataset = ShardedMidiDataset(shard_dir, seq_len=seq_len, expand_coef=expand_coef,
+                                                    split='valid')
+
+        logger.info(f'{self.n_files} {split} files in {len(self.shard_names)} shards were mapped from {shard_dir}.')
+
+    def __open_shards(self):
+        self._shards = []
+        for name in self.shard_names:
+            paths = _shard_paths(self.shard_dir, name)
+            self._shards.append((np.load(paths['notes'], mmap_mode='r'), np.load(paths['offsets'], mmap_mode='r')))
+
+    def __getstate__(self):
+        # memory maps are opened again instead of pickling their data to spawned workers
+        state = self.__dict__.copy()
+        del state['_shards']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open_shards()
+
+    @property
+    def n_notes(self):
+        return int(self.shard_starts[-1])
+
+    def token_counts(self):
+        return self._token_counts
+
+    def _arrays(self, position):
+        shard = np.searchsorted(self.shard_starts, position, side='right') - 1
+        return (*self._shards[shard], self.shard_starts[shard])
+
+    def _gather(self, positions):
+        notes = np.empty(positions.shape, dtype=np.int32)
+        offsets = np.empty(positions.shape, dtype=np.float32)
+
+        # rows are windows, a window is in one shard
+        shards = np.searchsorted(self.shard_starts, positions[:, 0], side='right') - 1
+        for shard in np.unique(shards):
+            rows = shards == shard
+            shard_positions = positions[rows] - self.shard_starts[shard]
+            shard_notes, shard_offsets = self._shards[shard]
+            notes[rows] = shard_notes[shard_positions]
+            offsets[rows] = shard_offsets[shard_positions]
+
+        return notes, offsets
@@ -0,0 +1,461 @@
+"""
+Reads Standard MIDI Files at the event level and encodes them into the same tokens and offsets as
+MidiDataset.encode_notes(MidiDataset.load_raw_notes(...)) does with music21 5.7.1 (the version from requirements.txt),
+but without building music21 streams. Newer music21 versions parse some files differently.
+
+The music21 path is followed step by step: tracks with note-ons become parts, note-ons are paired with
+the next event of the same pitch and channel, notes which start and stop together become chords, offsets and
+durations are quantized to quarters divided by 4 or 3, and only notes of the first instrument are kept
+(see music21.instrument.partitionByInstrument). The only known difference is that music21 can lose a note
+while it splits overlapping notes into voices, such notes are kept here.
+"""
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from math import floor
+
+_NOTE_OFF = 0x80
+_NOTE_ON = 0x90
+_PROGRAM_CHANGE = 0xC0
+_CHANNEL_PRESSURE = 0xD0
+
+_SET_TEMPO = 0x51
+_TIME_SIGNATURE = 0x58
+_KEY_SIGNATURE = 0x59
+_META_EVENTS = {0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x20, 0x21, 0x2F, 0x51, 0x54, 0x58,
+                0x59, 0x7F}
+
+_DEFAULT_TICKS_PER_QUARTER = 1024
+_QUANTIZATION_DIVISORS = (4, 3)
+
+# quantized offsets and durations are stored as integer numbers of twelfths of a quarter
+_UNITS_PER_QUARTER = 12
+
+_PITCH_NAMES = ('C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B')
+
+_STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_ACCIDENTALS = {'#': 1, '-': -1}
+_PITCH_RE = re.compile(r'^([A-G])([#-]*)(-?\d+)$')
+
+# names which music21.instrument.instrumentFromMidiProgram gives to General MIDI programs, notes are grouped
+# by these names, so all programs without a name are treated as one instrument
+_PROGRAM_NAMES = (
+    'Piano', None, None, None, None, None, 'Harpsichord', 'Clavichord', 'Celesta', 'Glockenspiel', None,
+    'Vibraphone', 'Marimba', 'Xylophone', 'Church Bells', 'Dulcimer', 'Electric Organ', None, None, 'Organ',
+    'Reed Organ', 'Accordion', 'Harmonica', None, 'Guitar', None, 'Electric Guitar', None, None, None, None, None,
+    'Acoustic Bass', 'Electric Bass', None, 'Fretless Bass', None, None, None, None, 'Violin', 'Viola',
+    'Violoncello', 'Contrabass', None, None, 'Harp', 'Timpani', 'StringInstrument', None, None, None, 'Voice',
+    None, None, None, 'Trumpet', 'Trombone', 'Tuba', None, 'Horn', 'Brass', None, None, 'Soprano Saxophone',
+    'Saxophone', 'Tenor Saxophone', 'Baritone Saxophone', 'Oboe', 'English Horn', 'Bassoon', 'Clarinet',
+    'Piccolo', 'Flute', 'Recorder', 'Pan Flute', None, 'Shakuhachi', 'Whistle', 'Ocarina', None, None, None,
+    None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
+    None, None, None, 'Sitar', 'Banjo', 'Shamisen', 'Koto', 'Kalimba', 'Bagpipes', None, 'Shehnai', None,
+    'Agogo', 'Steel Drum', 'Woodblock', 'Taiko', None, None, None, None, None, None, None, None, None, None, None
+)
+
+
+class MidiFileError(ValueError):
+    pass
+
+
+class Track(object):
+    """
+    Events of a track which are needed for encoding, events are numbered in the order of the file.
+
+    :ivar note_ons: [(event index, tick, pitch, channel)] of note-ons with non zero velocity
+    :ivar notes: {(pitch, channel): ([event index, ...], [tick, ...])} of all note-ons and note-offs
+    :ivar programs: [(tick, program)]
+    :ivar tempo_ticks: ticks of tempo events
+    :ivar signature_ticks: ticks of time and key signature events
+    """
+
+    def __init__(self):
+        self.n_events = 0
+        self.note_ons = []
+        self.notes = {}
+        self.programs = []
+        self.tempo_ticks = []
+        self.signature_ticks = []
+
+
+def _read_var_len(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def _read_track(data):
+    """
+    Parses track events like music21.midi.MidiTrack.read, including the way it handles running status
+    and skips events which it does not know.
+    """
+    track = Track()
+
+    pos, time = 0, 0
+    last_status = None
+
+    while pos < len(data):
+        delta, pos = _read_var_len(data, pos)
+
+        if len(data) - pos < 2:
+            # music21 stores an empty event and stops
+            track.n_events += 1
+            break
+
+        running = data[pos] < 0x80
+        if running:
+            # the last status byte is virtually prepended to the data bytes
+            status = 0x90 if last_status is None else last_status
+            body = pos
+        else:
+            status = data[pos]
+            body = pos + 1
+
+        tick = time + delta
+        kind = status & 0xF0
+
+        if 0x80 <= kind <= 0xE0:
+            channel = status & 0x0F
+            if kind in (_PROGRAM_CHANGE, _CHANNEL_PRESSURE):
+                if kind == _PROGRAM_CHANGE:
+                    track.programs.append((tick, data[body]))
+                next_pos = body + 1
+            else:
+                if kind in (_NOTE_OFF, _NOTE_ON):
+                    pitch, velocity = data[body], data[body + 1]
+                    indexes, ticks = track.notes.setdefault((pitch, channel), ([], []))
+                    indexes.append(track.n_events)
+                    ticks.append(tick)
+                    if kind == _NOTE_ON and velocity != 0:
+                        track.note_ons.append((track.n_events, tick, pitch, channel))
+                next_pos = body + 2
+        elif status in (0xF0, 0xF7):
+            length, next_pos = _read_var_len(data, body)
+            next_pos += length
+        elif status == 0xFF and data[body] in _META_EVENTS:
+            meta_type = data[body]
+            length, next_pos = _read_var_len(data, body + 1)
+            next_pos += length
+
+            if meta_type == _SET_TEMPO:
+                track.tempo_ticks.append(tick)
+            elif meta_type in (_TIME_SIGNATURE, _KEY_SIGNATURE):
+                track.signature_ticks.append(tick)
+        else:
+            # music21 skips such events, but the rest of their bytes is read as the next delta time
+            continue
+
+        if not running:
+            last_status = status
+        time = tick
+        pos = next_pos
+        track.n_events += 1
+
+    return track
+
+
+def read_midi(data):
+    """
+    :param data: bytes of a Standard MIDI File
+    :return: ticks per quarter, list of tracks
+    """
+    if data[:4] != b'MThd' or int.from_bytes(data[4:8], 'big') != 6:
+        raise MidiFileError('Badly formatted header.')
+
+    midi_format = int.from_bytes(data[8:10], 'big')
+    if midi_format not in (0, 1):
+        raise MidiFileError(f'Can not handle midi file format: {midi_format}.')
+
+    n_tracks = int.from_bytes(data[10:12], 'big')
+    division = int.from_bytes(data[12:14], 'big')
+    # like music21, timecode based files are read with the default resolution
+    ticks_per_quarter = _DEFAULT_TICKS_PER_QUARTER if division & 0x8000 else division & 0x7FFF
+
+    tracks = []
+    pos = 14
+    for _ in range(n_tracks):
+        if data[pos:pos + 4] != b'MTrk':
+            raise MidiFileError('Badly formatted track.')
+
+        length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        tracks.append(_read_track(data[pos + 8:pos + 8 + length]))
+        pos += 8 + length
+
+    if not tracks:
+        raise MidiFileError('No tracks are defined.')
+
+    return ticks_per_quarter, tracks
+
+
+def _nearest_multiple(value, unit):
+    # the same float arithmetic as in music21.common.nearestMultiple
+    mult = floor(value / unit)
+    match_low = unit * mult
+    match_high = unit * (mult + 1)
+
+    if match_low <= value <= match_low + unit / 2.0:
+        return round(value - match_low, 7), match_low
+    return round(match_high - value, 7), match_high
+
+
+class _Quantizer(object):
+    """
+    Quantizes tick values like music21.stream.Stream.quantize.
+    """
+
+    def __init__(self, ticks_per_quarter):
+        self.ticks_per_quarter = ticks_per_quarter
+        self._memo = {}
+
+    def __call__(self, ticks):
+        units = self._memo.get(ticks)
+        if units is None:
+            value = max(ticks / self.ticks_per_quarter, 0.0)
+            _, match = min(_nearest_multiple(value, 1.0 / d) for d in _QUANTIZATION_DIVISORS)
+            units = self._memo[ticks] = int(round(match * _UNITS_PER_QUARTER))
+
+        return units
+
+    def duration(self, ticks):
+        # music21 replaces zero durations with a quarter
+        return _UNITS_PER_QUARTER if ticks == 0 else self(ticks)
+
+
+def pitch_name(midi):
+    """
+    The same as str(music21.pitch.Pitch(midi=midi)), e.g. 'C4', 'E-5'.
+    """
+    return f'{_PITCH_NAMES[midi % 12]}{midi // 12 - 1}'
+
+
+def pitch_to_midi(name):
+    """
+    Converts music21 pitch name with octave (e.g. 'C#4', 'E-5') into MIDI note number.
+    """
+    match = _PITCH_RE.match(name)
+    if match is None:
+        raise ValueError(f'Unsupported pitch name: {name}')
+
+    step, accidentals, octave = match.groups()
+    return 12 * (int(octave) + 1) + _STEPS[step] + sum(_ACCIDENTALS[a] for a in accidentals)
+
+
+def is_chord_token(token):
+    """
+    Chords (and single pitch classes) are encoded as normal orders of pitch classes, e.g. '0.4.7', '5'.
+    """
+    return ('.' in token) or token.isdigit()
+
+
+def token_pitches(token):
+    """
+    Returns MIDI note numbers of a token. Like in MidiDataset.decode_notes, a chord is a normal order
+    of pitch classes (e.g. '0.4.7') which are placed in the 4th octave.
+    """
+    if is_chord_token(token):
+        return [60 + int(pitch_class) for pitch_class in token.split('.')]
+
+    return [pitch_to_midi(token)]
+
+
+def _packed(pcs):
+    """
+    Normal form of sorted pitch classes transposed to 0: the rotation with the smallest span, ties are broken by
+    intervals from the first pitch class to the second, third, etc. (Forte).
+    """
+    n = len(pcs)
+    rotations = [pcs[i:] + [pc + 12 for pc in pcs[:i]] for i in range(n)]
+    best = min(rotations, key=lambda r: [r[-1] - r[0]] + [r[k] - r[0] for k in range(1, n)])
+
+    return [pc - best[0] for pc in best]
+
+
+def normal_order(pitch_classes):
+    """
+    The same as music21.chord.Chord.normalOrder. music21 takes the prime form of the set class from Forte's
+    tables (or its inversion if the chord is inverted) and transposes it to the lowest pitch class which gives
+    the pitch classes of the chord.
+    """
+    pcs = sorted(set(pitch_classes))
+    if len(pcs) == 1:
+        return pcs
+
+    prime = min(_packed(pcs), _packed(sorted(-pc % 12 for pc in pcs)), key=lambda r: [r[-1]] + r[1:])
+    inversion = [(prime[-1] - pc) % 12 for pc in reversed(prime)]
+
+    pcs_set = set(pcs)
+    for form in (prime, inversion):
+        for pc in pcs:
+            candidate = [(x + pc) % 12 for x in form]
+            if set(candidate) == pcs_set:
+                return candidate
+
+
+@lru_cache(maxsize=None)
+def _chord_token(pitch_classes):
+    return '.'.join(str(pc) for pc in normal_order(pitch_classes))
+
+
+def _pair_notes(track):
+    """
+    Pairs every note-on with the next not yet paired note-on or note-off of the same pitch and channel,
+    music21 does not check that it is a note-off. Note-ons which were paired as ends of other notes do not
+    start notes.
+
+    :return: [(on tick, off tick, pitch)]
+    """
+    pointers = {}
+    paired = set()
+
+    notes = []
+    for index, tick, pitch, channel in track.note_ons:
+        if index in paired:
+            continue
+
+        key = (pitch, channel)
+        indexes, ticks = track.notes[key]
+
+        # messages before the pointer are either paired or precede the current note-on
+        k = max(pointers.get(key, 0), bisect_right(indexes, index))
+        while k < len(indexes) and indexes[k] in paired:
+            k += 1
+        if k == len(indexes):
+            continue
+
+        paired.add(indexes[k])
+        pointers[key] = k + 1
+        notes.append((tick, ticks[k], pitch))
+
+    return notes
+
+
+def _part_elements(track, ticks_per_quarter, quantize):
+    """
+    Groups notes into chords like music21.midi.translate.midiTrackToStream.
+
+    :return: [(offset, duration, pitches)] in order of insertion into the part, offsets and durations are
+        quantized, pitches is an int for a note and a list for a chord
+    """
+    notes = _pair_notes(track)
+    tolerance = ticks_per_quarter / 16
+
+    elements = []
+    gathered = set()
+    for i, (on, off, pitch) in enumerate(notes):
+        if i in gathered:
+            continue
+
+        chord = None
+        for j in range(i + 1, len(notes)):
+            on_sub, off_sub, _ = notes[j]
+            if abs(on_sub - on) > tolerance:
+                break
+            if abs(off_sub - off) > tolerance:
+                continue
+
+            # like in music21, a note can be gathered into several chords
+            if chord is None:
+                chord = [i]
+                gathered.add(i)
+            chord.append(j)
+            gathered.add(j)
+
+        if chord is None:
+            elements.append((quantize(on), quantize.duration(off - on), pitch))
+        else:
+            # music21 measures a chord from the start of its last note to the end of its first one
+            elements.append((quantize(on), quantize.duration(off - notes[chord[-1]][0]),
+                             [notes[j][2] for j in chord]))
+
+    return elements
+
+
+def _select_notes(parts):
+    """
+    Keeps elements of the first instrument like music21.instrument.partitionByInstrument or all elements
+    if there are no instruments.
+
+    :param parts: [(elements, instruments, highest time)], instruments are [(offset, name)]
+    :return: elements in the order of the result stream
+    """
+    first_name = next((instruments[0][1] for _, instruments, _ in parts if instruments), False)
+    if first_name is False:
+        selected = [e for elements, _, _ in parts for e in elements]
+    else:
+        selected = []
+        for elements, instruments, highest_time in parts:
+            ends = [offset for offset, _ in instruments[1:]] + [highest_time]
+            taken = set()
+            for (start, name), end in zip(instruments, ends):
+                if name != first_name:
+                    continue
+
+                for i, (offset, duration, _) in enumerate(elements):
+                    in_span = start <= offset < end if start < end else offset == start and duration == 0
+                    if in_span and i not in taken:
+                        taken.add(i)
+                        selected.append(elements[i])
+
+    # the sort is stable, so elements with the same offset keep the order of insertion
+    return sorted(selected, key=lambda e: e[0])
+
+
+def encode_tracks(ticks_per_quarter, tracks):
+    """
+    :return: note_seq, offset_seq like MidiDataset.encode_notes
+    """
+    quantize = _Quantizer(ticks_per_quarter)
+
+    note_tracks = [track for track in tracks if track.note_ons]
+    if not note_tracks:
+        raise MidiFileError('No tracks with notes.')
+
+    # time and key signatures of tracks without notes are copied to every part, tempos to the first one
+    conductor_signatures = [quantize(t) for track in tracks if not track.note_ons for t in track.signature_ticks]
+    conductor_tempos = [quantize(t) for track in tracks if not track.note_ons for t in track.tempo_ticks]
+
+    parts = []
+    for i, track in enumerate(note_tracks):
+        elements = sorted(_part_elements(track, ticks_per_quarter, quantize), key=lambda e: e[0])
+        instruments = sorted(((quantize(tick), _PROGRAM_NAMES[program]) for tick, program in track.programs),
+                             key=lambda x: x[0])
+
+        zero_length_offsets = [quantize(t) for t in track.tempo_ticks + track.signature_ticks]
+        zero_length_offsets += [offset for offset, _ in instruments] + conductor_signatures
+        if i == 0:
+            zero_length_offsets += conductor_tempos
+
+        highest_time = max([offset + duration for offset, duration, _ in elements] + zero_length_offsets,
+                           default=0)
+
+        parts.append((elements, instruments, highest_time))
+
+    note_seq = []
+    offset_seq = []
+
+    prev_time = 0
+    for offset, _, pitches in _select_notes(parts):
+        if isinstance(pitches, int):
+            note_seq.append(pitch_name(pitches))
+        else:
+            note_seq.append(_chord_token(frozenset(p % 12 for p in pitches)))
+
+        time = offset / _UNITS_PER_QUARTER
+        offset_seq.append(time - prev_time)
+        prev_time = time
+
+    return note_seq, offset_seq
+
+
+def encode_file(file_path):
+    """
+    Lightweight replacement of MidiDataset.encode_notes(MidiDataset.load_raw_notes(file_path)).
+    """
+    with open(file_path, 'rb') as f:
+        ticks_per_quarter, tracks = read_midi(f.read())
+
+    return encode_tracks(ticks_per_quarter, tracks)
@@ -1,55 +1,130 @@
+import contextlib
 import logging
-from collections import defaultdict
+import math
+import random
 
+import numpy as np
 import torch
 import torch.nn as nn
-from .loss import LabelSmoothingLossWithLogits
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, RandomSampler
+import torch.nn.functional as F
+from .checkpoint import AsyncCheckpointWriter, load_checkpoint, save_checkpoint
+from .distributed import all_gather, all_reduce_mean, all_reduce_sum, get_rank, get_world_size, is_main_process
+from .execution import autocast, grad_scaler
+from .loss import LabelSmoothingLossWithLogits, SampledSoftmaxLoss
+from .model import pack_tokens
+from .prefetcher import DevicePrefetcher
+from .profiling import StepStats, make_profiler
+from .sampler import EvalBatchSampler, StreamBatchSampler, WindowBatchDataset, WindowBatchSampler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
 logger = logging.getLogger(__file__)
 
 
-class AverageMeter:
-    def __init__(self):
-        self._counter = 0
-        self._avg_value = 0
-
-    def __call__(self):
-        return self._avg_value
-
-    def update(self, value):
-        self._counter += 1
-        self._avg_value = (self._avg_value * (self._counter - 1) + value) / self._counter
-
-
 class Trainer:
     def __init__(self,
                  model,
                  vocab, train_dataset, writer, *, device=torch.device('cuda'),
                  train_batch_size=32, batch_split=1, n_jobs=4, n_epochs=0, lr=1e-3,
-                 weight_decay=5e-4, w_cls=1, w_off=10, smoothing=0) -> None:
-
-        logger.info(f'Used device: {device}.')
+                 weight_decay=5e-4, w_cls=1, w_off=10, smoothing=0, sampled_softmax=0, sampling='uniform',
+                 precision='fp32', log_interval=10, instrument=False, profile_steps=None, profile_dir=None,
+                 checkpoint_path=None, checkpoint_interval=0, stateful=False, valid_dataset=None,
+                 valid_batch_size=None, valid_max_windows=None, eval_interval=0, early_stopping=0,
+                 best_checkpoint_path=None) -> None:
+        """
+        :param precision: 'fp32', 'bf16' or 'fp16' (GPU) autocast of forward and losses, see model.execution
+        :param sampled_softmax: number of negative classes of the sampled softmax, the full softmax is used if 0.
+            Negatives are drawn proportionally to counts of tokens in the train dataset ** 0.75
+        :param sampling: mode of WindowBatchSampler, 'full' and 'bucket' reduce padding
+        :param stateful: truncated BPTT, lanes of batches walk through files in consecutive windows
+            (see StreamBatchSampler) and the detached hidden state is carried between batches, `sampling` is
+            not used. The context is longer than windows, memory is the same
+        :param log_interval: losses (and performance stats) are logged every `log_interval` optimizer steps,
+            they are read from the device only then
+        :param instrument: log data wait, compute and optimizer step times, throughput and peak memory
+        :param profile_steps: (start, stop) batches which are traced with torch.profiler
+        :param profile_dir: directory of profiler traces, log dir of the writer by default
+        :param checkpoint_path: path of the training state (weights, optimizer, random states and the position
+            in the data) which is written on a background thread after every epoch, see load_training_state
+        :param checkpoint_interval: the training state is also written every `checkpoint_interval` optimizer steps
+        :param valid_dataset: held-out MidiDataset (see MidiDataset.valid_ratio) which is evaluated after every
+            epoch, see evaluate
+        :param valid_batch_size: batch size of evaluation, 4 times the size of split training batches by default.
+            Evaluation keeps no activations for the backward pass, so larger batches fit into memory
+        :param valid_max_windows: only a fixed subset of validation windows is evaluated if there are more
+        :param eval_interval: the validation dataset is also evaluated every `eval_interval` optimizer steps
+        :param early_stopping: training is stopped when the validation loss has not improved for `early_stopping`
+            evaluations, 0 disables it
+        :param best_checkpoint_path: weights with the lowest validation loss are written there in the format of
+            save_state_dict
+
+        If the process group is initialized (see model.distributed), the model is trained with
+        DistributedDataParallel: every process trains on its share of batches of an epoch and gradients are
+        averaged over processes on optimizer steps. Only the main process writes logs and checkpoints, `writer`
+        of other processes may be None.
+        """
+
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
+        logger.info(f'Used device: {device}' + (f', process {self.rank} / {self.world_size}.'
+                                                if self.world_size > 1 else '.'))
 
         self.vocab = vocab
         self.model = model.to(device)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=lr, weight_decay=weight_decay)
 
-        self.cls_criteria = LabelSmoothingLossWithLogits(n_classes=len(vocab), smoothing=smoothing,
-                                                         ignore_index=vocab.pad_index).to(device)
+        # weights of the main process are broadcast to other processes here, lengths of windows are kept on CPU,
+        # so inputs are not moved by DDP
+        self.train_model = DistributedDataParallel(self.model) if self.world_size > 1 else self.model
+
+        if sampled_softmax > 0:
+            class_weights = train_dataset.token_counts() ** 0.75
+            self.cls_criteria = SampledSoftmaxLoss(self.model.fc_class, class_weights, n_samples=sampled_softmax,
+                                                   smoothing=smoothing, ignore_index=vocab.pad_index).to(device)
+        else:
+            self.cls_criteria = LabelSmoothingLossWithLogits(n_classes=len(vocab), smoothing=smoothing,
+                                                             ignore_index=vocab.pad_index).to(device)
+        self.sampled_softmax = sampled_softmax
+
+        self.precision = precision
+        self.scaler = grad_scaler(device, precision)
         self.off_criteria = nn.SmoothL1Loss().to(device)
 
         logger.info(f'Train Dataset len: {len(train_dataset)}.')
 
-        train_sampler = RandomSampler(train_dataset)
-        self.train_dataloader = torch.utils.data.DataLoader(train_dataset,
-                                                            batch_size=int(train_batch_size // batch_split),
-                                                            num_workers=n_jobs,
-                                                            sampler=train_sampler,
-                                                            drop_last=True,
-                                                            collate_fn=self.collate_fun)
+        # batches are gathered by the dataset at once, so auto-batching of DataLoader is disabled
+        if stateful:
+            self.train_sampler = StreamBatchSampler(train_dataset, batch_size=int(train_batch_size // batch_split),
+                                                    num_replicas=self.world_size, rank=self.rank)
+        else:
+            self.train_sampler = WindowBatchSampler(train_dataset, batch_size=int(train_batch_size // batch_split),
+                                                    mode=sampling, num_replicas=self.world_size, rank=self.rank)
+        # batches stay on CPU in workers, they are moved to the device by DevicePrefetcher
+        pin_memory = device.type == 'cuda'
+        # seeds of workers are drawn from the own generator, so the global random state is not changed by
+        # the creation of iterators and training is resumed with the same state
+        self.train_dataloader = DataLoader(WindowBatchDataset(train_dataset, pin_memory=pin_memory and n_jobs == 0,
+                                                              stream=stateful),
+                                           batch_size=None,
+                                           num_workers=n_jobs,
+                                           sampler=self.train_sampler,
+                                           pin_memory=pin_memory,
+                                           generator=torch.Generator())
+
+        self.valid_dataloader = None
+        if valid_dataset is not None:
+            logger.info(f'Valid Dataset files: {valid_dataset.n_files}.')
+            if valid_batch_size is None:
+                valid_batch_size = 4 * int(train_batch_size // batch_split)
+            valid_sampler = EvalBatchSampler(valid_dataset, batch_size=valid_batch_size,
+                                             max_windows=valid_max_windows, num_replicas=self.world_size,
+                                             rank=self.rank)
+            # batches are gathered in the main process, workers would be started on every evaluation
+            self.valid_dataloader = DataLoader(WindowBatchDataset(valid_dataset, pin_memory=pin_memory),
+                                               batch_size=None,
+                                               sampler=valid_sampler)
 
         self.device = device
         self.batch_split = batch_split
@@ -60,72 +135,332 @@ class Trainer:
         self.w_cls = w_cls
         self.w_off = w_off
 
-    def collate_fun(self, data):
-        prevs = [torch.LongTensor(d[0]) for d in data]
-        nexts = [torch.LongTensor(d[1]) for d in data]
-        prev_offsets = [torch.FloatTensor(d[2]) for d in data]
-        next_offsets = [torch.FloatTensor(d[3]) for d in data]
+        self.log_interval = log_interval
+        self.instrument = instrument
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self._profiler = None
 
-        prevs = pad_sequence(prevs, batch_first=True, padding_value=self.vocab.pad_index).to(self.device)
-        nexts = pad_sequence(nexts, batch_first=True, padding_value=self.vocab.pad_index).to(self.device)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpoint_writer = None
 
-        prev_offsets = pad_sequence(prev_offsets, batch_first=True, padding_value=0).to(self.device)
-        next_offsets = pad_sequence(next_offsets, batch_first=True, padding_value=0).to(self.device)
+        # position in the data which training is started (or resumed) from
+        self._start_epoch = 1
+        self._start_batch = 0
+        self._epoch_seed = None
 
-        return prevs, nexts, prev_offsets, next_offsets
+        # hidden state of lanes which is carried between batches in the stateful mode
+        self.stateful = stateful
+        self._hidden = None
+
+        # the lowest validation loss and the number of evaluations since it was reached
+        self.eval_interval = eval_interval
+        self.early_stopping = early_stopping
+        self.best_checkpoint_path = best_checkpoint_path
+        self._best_valid_loss = float('inf')
+        self._n_bad_evals = 0
 
     def train(self):
-        for epoch_i in range(1, self.n_epochs+1):
-            self._train(epoch_i)
+        if self.profile_steps is not None and is_main_process():
+            trace_dir = self.profile_dir if self.profile_dir is not None else self.writer.log_dir
+            self._profiler = make_profiler(self.profile_steps, trace_dir, self.device)
+
+        if (self.checkpoint_path is not None or self.best_checkpoint_path is not None) and is_main_process():
+            self._checkpoint_writer = AsyncCheckpointWriter()
+
+        try:
+            with self._profiler if self._profiler is not None else contextlib.nullcontext():
+                for epoch_i in range(self._start_epoch, self.n_epochs+1):
+                    if self._stopped:
+                        break
+                    self._train(epoch_i)
+        finally:
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.close()
+                self._checkpoint_writer = None
+
+        self._profiler = None
 
     def _train(self, epoch_i):
         self.model.train()
         self.optimizer.zero_grad()
 
-        avg_losses = defaultdict(AverageMeter)
-
-        tqdm_data = tqdm(self.train_dataloader, desc=f'Train (epoch #{epoch_i} / {self.n_epochs})')
-
-        for i, batch in enumerate(tqdm_data):
-            prevs, nexts, prev_offsets, next_offsets = batch
-            model_nexts, model_offsets, _ = self.model(prevs, prev_offsets)
-
-            class_loss = self.cls_criteria(model_nexts.view(-1, model_nexts.size(-1)),
-                                           nexts.view(-1))
-
-            content_mask = torch.ne(prevs, self.vocab.pad_index)
-            offset_loss = self.off_criteria(content_mask.float() * model_offsets.squeeze(-1), next_offsets)
-
-            loss = self.w_cls * class_loss + self.w_off * offset_loss
-
-            avg_losses['class_loss'].update(class_loss.item())
-            avg_losses['offset_loss'].update(offset_loss.item())
-            avg_losses['loss'].update(loss.item())
-
-            loss = loss / self.batch_split
-            loss.backward()
-
-            if (i + 1) % self.batch_split == 0:
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), 10.0)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-                for k, v in avg_losses.items():
-                    self.writer.add_scalar(f'training/{k}', v(), global_step=self.global_step)
+        # losses are summed on the device and read only when they are logged, so steps do not wait for the device
+        loss_names = ('class_loss', 'offset_loss', 'loss')
+        loss_sums = torch.zeros(len(loss_names), device=self.device)
+        n_losses = 0
+
+        stats = StepStats(self.device, enabled=self.instrument)
+
+        # batches of the epoch are defined by the seed, a resumed epoch skips batches which were trained on
+        if self._epoch_seed is None:
+            self._epoch_seed = int(np.random.randint(2 ** 31))
+        self.train_sampler.seed = self._epoch_seed
+        self.train_sampler.start_batch = self._start_batch
+
+        # lengths of windows stay on the host to pack batches without synchronization
+        prefetcher = DevicePrefetcher(self.train_dataloader, self.device, host_items=(4,))
+        tqdm_data = tqdm(prefetcher, desc=f'Train (epoch #{epoch_i} / {self.n_epochs})', disable=not is_main_process())
+
+        for i, batch in enumerate(stats.iterate(tqdm_data), start=self._start_batch):
+            if self.stateful:
+                *batch, resets = batch
+                if self._hidden is None:
+                    self._hidden = self.model.init_hidden(resets.size(0), self.device)
+                # lanes which start new files begin with the zero state
+                self._hidden = self._hidden.masked_fill(resets.view(1, -1, 1), 0)
+
+            prevs, nexts, prev_offsets, next_offsets, lengths = batch
+            is_step = (i + 1) % self.batch_split == 0
+
+            # gradients of split batches are accumulated locally and averaged over processes only on steps
+            no_sync = self.train_model.no_sync() if self.world_size > 1 and not is_step else contextlib.nullcontext()
+
+            with stats.region('compute'), no_sync:
+                # autocast keeps softmax and losses in fp32
+                with autocast(self.device, self.precision):
+                    # padded time steps are skipped, so outputs and targets are real tokens only
+                    # with the sampled softmax the model gives features which are projected by the loss
+                    model_nexts, model_offsets, hidden = self.train_model(prevs, prev_offsets, h=self._hidden,
+                                                                          lengths=lengths,
+                                                                          project=self.sampled_softmax == 0)
+                    nexts, next_offsets = (pack_tokens(t, lengths).data for t in (nexts, next_offsets))
+
+                    class_loss = self.cls_criteria(model_nexts, nexts)
+                    offset_loss = self.off_criteria(model_offsets.squeeze(-1), next_offsets)
+
+                    loss = self.w_cls * class_loss + self.w_off * offset_loss
+
+                loss_sums += torch.stack([class_loss, offset_loss, loss]).detach().float()
+                n_losses += 1
+
+                if self.stateful:
+                    # gradients are truncated at windows. Only last windows of files are padded,
+                    # so undefined states of padded lanes (see GRUNet.forward) are reset on the next batch
+                    self._hidden = hidden.detach().float()
+
+                loss = loss / self.batch_split
+                self.scaler.scale(loss).backward()
+
+            stats.add_batch(prevs.size(0), int(lengths.sum()))
+
+            if is_step:
+                with stats.region('optimizer'):
+                    # gradients are unscaled before clipping, the step is skipped if they are not finite
+                    self.scaler.unscale_(self.optimizer)
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), 10.0)
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad()
+
+                if self.global_step % self.log_interval == 0:
+                    # losses are averaged over processes, performance stats are of the main process
+                    avg_losses = dict(zip(loss_names, all_reduce_mean(loss_sums / n_losses).tolist()))
+                    performance = stats.collect()
+                    if is_main_process():
+                        for k, v in avg_losses.items():
+                            self.writer.add_scalar(f'training/{k}', v, global_step=self.global_step)
+                        for k, v in performance.items():
+                            self.writer.add_scalar(f'performance/{k}', v, global_step=self.global_step)
+
+                    tqdm_data.set_postfix(avg_losses)
 
                 self.global_step += 1
 
-            tqdm_data.set_postfix({k: v() for k, v in avg_losses.items()})
+                if self._is_eval_step():
+                    self._validate()
+
+                if self._stopped or (self.checkpoint_interval > 0 and self.global_step % self.checkpoint_interval == 0):
+                    self._write_training_state(epoch_i, i + 1)
+
+            if self._profiler is not None:
+                self._profiler.step()
+
+            if self._stopped:
+                return
+
+        if n_losses > 0:
+            tqdm_data.set_postfix(dict(zip(loss_names, (loss_sums / n_losses).tolist())))
+
+        self._start_batch = 0
+        self._epoch_seed = None
+        self._hidden = None
+
+        if self.valid_dataloader is not None and not self._is_eval_step():
+            self._validate()
+
+        self._write_training_state(epoch_i + 1, 0)
+
+    @property
+    def _stopped(self):
+        return self.early_stopping > 0 and self._n_bad_evals >= self.early_stopping
+
+    def _is_eval_step(self):
+        return self.valid_dataloader is not None and self.eval_interval > 0 and \
+            self.global_step % self.eval_interval == 0
+
+    def evaluate(self):
+        """
+        Returns mean losses per target of the validation dataset: the class loss (cross-entropy of the full
+        softmax without smoothing), its perplexity, the offset loss and the weighted loss. Sums of losses are reduced
+        over processes, so all processes get the same values.
+        """
+        was_training = self.model.training
+        self.model.eval()
+
+        # losses are summed on the device and read once
+        loss_sums = torch.zeros(2, dtype=torch.float64, device=self.device)
+        n_targets = 0
+
+        prefetcher = DevicePrefetcher(self.valid_dataloader, self.device, host_items=(4,))
+        with torch.inference_mode():
+            for prevs, nexts, prev_offsets, next_offsets, lengths in prefetcher:
+                with autocast(self.device, self.precision):
+                    model_nexts, model_offsets, _ = self.model(prevs, prev_offsets, lengths=lengths)
+                nexts, next_offsets = (pack_tokens(t, lengths).data for t in (nexts, next_offsets))
+
+                class_loss = F.cross_entropy(model_nexts.float(), nexts, reduction='sum')
+                offset_loss = F.smooth_l1_loss(model_offsets.squeeze(-1).float(), next_offsets, reduction='sum')
+                loss_sums += torch.stack([class_loss, offset_loss]).double()
+                n_targets += int(lengths.sum())
+
+        self.model.train(was_training)
+
+        n_targets = torch.tensor([n_targets], dtype=torch.float64, device=self.device)
+        sums = all_reduce_sum(torch.cat([loss_sums, n_targets]))
+        class_loss, offset_loss = (sums[:2] / sums[2]).tolist()
+
+        return {'class_loss': class_loss,
+                'perplexity': math.exp(class_loss),
+                'offset_loss': offset_loss,
+                'loss': self.w_cls * class_loss + self.w_off * offset_loss}
+
+    def _validate(self):
+        """
+        Evaluates the validation dataset, logs losses and updates the best checkpoint and the early stopping counter.
+        """
+        losses = self.evaluate()
+        if is_main_process():
+            for k, v in losses.items():
+                self.writer.add_scalar(f'validation/{k}', v, global_step=self.global_step)
+            logger.info(f'Validation (step {self.global_step}): ' +
+                        ', '.join(f'{k}={v:.4f}' for k, v in losses.items()))
+
+        if losses['loss'] < self._best_valid_loss:
+            self._best_valid_loss = losses['loss']
+            self._n_bad_evals = 0
+
+            if self.best_checkpoint_path is not None and self._checkpoint_writer is not None:
+                self._checkpoint_writer.write(self.best_checkpoint_path, self.model.state_dict(),
+                                              **self._checkpoint_meta())
+        else:
+            self._n_bad_evals += 1
+
+            if self._stopped:
+                logger.info(f'Training was stopped: the validation loss has not improved for {self._n_bad_evals} '
+                            f'evaluations, the best loss is {self._best_valid_loss:.4f}.')
+
+    def _checkpoint_meta(self):
+        return {'model': self.model.config,
+                'unique_notes': self.vocab.unique_notes,
+                'model_repr': repr(self.model),
+                'global_step': self.global_step}
+
+    def _write_training_state(self, epoch, batch):
+        """
+        Submits the training state to the background writer, training is continued after tensors are copied.
+        It is called by all processes, random states of torch are gathered from them to the main process.
+        """
+        if self.checkpoint_path is None:
+            return
+
+        torch_rng = all_gather(torch.get_rng_state().to(self.device)).cpu()
+        cuda_rng = (all_gather(torch.cuda.get_rng_state(self.device).to(self.device)).cpu()
+                    if self.device.type == 'cuda' else None)
+        hidden = all_gather(self._hidden).cpu() if self._hidden is not None else None
+
+        if self._checkpoint_writer is None:
+            return
+
+        tensors = {f'model.{k}': v for k, v in self.model.state_dict().items()}
+
+        optimizer_state = self.optimizer.state_dict()
+        for param_id, param_state in optimizer_state['state'].items():
+            for k, v in param_state.items():
+                tensors[f'optimizer.{param_id}.{k}'] = torch.as_tensor(v)
+
+        # states of numpy and python are the same in all processes, they are not used by workers
+        np_state = np.random.get_state()
+        tensors['rng.torch'] = torch_rng
+        tensors['rng.numpy'] = torch.from_numpy(np_state[1].astype(np.int64))
+        if cuda_rng is not None:
+            tensors['rng.cuda'] = cuda_rng
+        if hidden is not None:
+            tensors['hidden'] = hidden
+
+        training = {'epoch': epoch,
+                    'batch': batch,
+                    'epoch_seed': self._epoch_seed,
+                    'optimizer_param_groups': optimizer_state['param_groups'],
+                    'scaler': self.scaler.state_dict(),
+                    'python_rng': random.getstate(),
+                    'numpy_rng': [np_state[0], *np_state[2:]],
+                    'best_valid_loss': self._best_valid_loss if math.isfinite(self._best_valid_loss) else None,
+                    'n_bad_evals': self._n_bad_evals}
+
+        self._checkpoint_writer.write(self.checkpoint_path, tensors, **self._checkpoint_meta(), training=training)
+
+    def load_training_state(self, path_):
+        """
+        Restores the training state which was written with `checkpoint_path`. Training is continued from the next
+        batch after the state was written and gives the same weights as the training which was not interrupted.
+        The vocab, the model and the number of processes must be the same as in the state.
+        """
+        meta, tensors = load_checkpoint(path_)
+        training = meta['training']
+
+        assert meta['unique_notes'] == self.vocab.unique_notes, 'Vocab differs from the vocab of the training state.'
+        assert len(tensors['rng.torch']) == self.world_size, \
+            f'The training state was written by {len(tensors["rng.torch"])} processes.'
+
+        self.model.load_state_dict({k[len('model.'):]: v for k, v in tensors.items() if k.startswith('model.')})
+
+        optimizer_state = {'state': {}, 'param_groups': training['optimizer_param_groups']}
+        for name, tensor in tensors.items():
+            if name.startswith('optimizer.'):
+                _, param_id, k = name.split('.', 2)
+                # tensors are copied from the file, the optimizer updates them in-place
+                optimizer_state['state'].setdefault(int(param_id), {})[k] = tensor.clone()
+        self.optimizer.load_state_dict(optimizer_state)
+
+        self.scaler.load_state_dict(training['scaler'])
+
+        version, state, gauss_next = training['python_rng']
+        random.setstate((version, tuple(state), gauss_next))
+        np_name, *np_extra = training['numpy_rng']
+        np.random.set_state((np_name, tensors['rng.numpy'].numpy().astype(np.uint32), *np_extra))
+        torch.set_rng_state(tensors['rng.torch'][self.rank].clone())
+        if 'rng.cuda' in tensors and self.device.type == 'cuda':
+            torch.cuda.set_rng_state(tensors['rng.cuda'][self.rank].clone(), self.device)
+
+        self.global_step = meta['global_step']
+        self._start_epoch = training['epoch']
+        self._start_batch = training['batch']
+        if 'hidden' in tensors:
+            self._hidden = tensors['hidden'][self.rank].to(self.device, copy=True)
+        self._epoch_seed = training['epoch_seed']
+        if training.get('best_valid_loss') is not None:
+            self._best_valid_loss = training['best_valid_loss']
+        self._n_bad_evals = training.get('n_bad_evals', 0)
+
+        logger.info(f'Training state was loaded from {path_}: epoch {self._start_epoch}, batch {self._start_batch}, '
+                    f'step {self.global_step}.')
 
     def save_state_dict(self, path_):
-        model_dict = self.model.state_dict()
-        unique_notes = self.vocab.unique_notes
-
-        state_dict = {'model': model_dict,
-                      'unique_notes': unique_notes,
-                      'model_repr': repr(self.model),
-                      'global_step': self.global_step}
-
-        torch.save(state_dict, path_)
+        """
+        Saves weights with the model config and the vocab, see model.checkpoint and utils.load_model.
+        """
+        save_checkpoint(path_, self.model.state_dict(), **self._checkpoint_meta())
 
         logger.info(f'State dict was saved to {path_}.')
@@ -0,0 +1,42 @@
+import logging
+
+import configargparse
+
+from model.checkpoint import save_checkpoint
+from model.quantization import quantize_model, quantized_tensors
+from utils.load_model import load_model
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator int8 quantization of checkpoints.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument('--checkpoint_path', type=str, required=True, help='Model checkpoint path.')
+    parser.add_argument('--out', type=str, required=True, help='Path of the quantized checkpoint.')
+
+    return parser
+
+
+def main():
+    params = get_parser().parse_args()
+
+    model, vocab = load_model(params.checkpoint_path)
+    model = quantize_model(model)
+
+    tensors, quantization = quantized_tensors(model)
+    save_checkpoint(params.out, tensors,
+                    model=model.config,
+                    unique_notes=vocab.unique_notes,
+                    model_repr=repr(model),
+                    quantization=quantization)
+
+    logger.info(f'Quantized model was saved to {params.out}.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import configargparse
+import torch
+
+from model.dataset import MidiDataset
+from model.execution import inference_modes
+from utils.serving import MicroBatcher, ModelCache
+from utils.write_notes import notes_to_bytes, tokens_to_bytes
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator server.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Directory with model checkpoints which can be requested.')
+    parser.add_argument('--default_checkpoint', type=str, default=None,
+                        help='Checkpoint name which is used if a request does not specify it.')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+
+    parser.add_argument('--cache_size', type=int, default=4, help='Number of models which are kept loaded.')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Max number of requests in a batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help='Time to wait for other requests to be batched with the first one.')
+    parser.add_argument('--max_seq_len', type=int, default=4096, help='Max output sequence length of a request.')
+
+    parser.add_argument('--backend', type=str, default='music21', choices=('music21', 'smf'),
+                        help='Backend which writes responses. "smf" writes MIDI events directly without music21.')
+
+    parser.add_argument('--gpu', action='store_true', help='Use gpu to generate.')
+    parser.add_argument('--execution_mode', type=str, default='eager', choices=inference_modes,
+                        help='Execution of generation steps, see generate.py.')
+
+    return parser
+
+
+class GenerationServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, batcher, *, checkpoint_dir, default_checkpoint=None, max_seq_len=4096,
+                 backend='music21'):
+        super().__init__(address, GenerationHandler)
+
+        self.batcher = batcher
+        self.checkpoint_dir = os.path.realpath(checkpoint_dir)
+        self.default_checkpoint = default_checkpoint
+        self.max_seq_len = max_seq_len
+        self.backend = backend
+
+    def to_bytes(self, note_seq, offset_seq, vocab):
+        """
+        :param note_seq: token ids, pitches are taken from the pitch table of the vocab
+        """
+        if self.backend == 'smf':
+            return tokens_to_bytes(note_seq, offset_seq, vocab=vocab)
+        return notes_to_bytes(MidiDataset.decode_notes(note_seq, offset_seq, vocab=vocab))
+
+    def checkpoint_path(self, name):
+        if name is None:
+            name = self.default_checkpoint
+        if name is None:
+            raise ValueError('Checkpoint is not specified.')
+
+        path = os.path.realpath(os.path.join(self.checkpoint_dir, name))
+        if os.path.commonpath([path, self.checkpoint_dir]) != self.checkpoint_dir or not os.path.isfile(path):
+            raise ValueError(f'Unknown checkpoint: {name}.')
+
+        return path
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    """
+    POST /generate with JSON body {"checkpoint": str, "seq_len": int, "top_p": float, "temperature": float,
+    "seed": int}, all fields are optional. The response is a MIDI file.
+    """
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+
+            checkpoint_path = self.server.checkpoint_path(params.get('checkpoint'))
+            seq_len = int(params.get('seq_len', 256))
+            top_p = float(params.get('top_p', 0.6))
+            temperature = float(params.get('temperature', 1.0))
+            seed = params.get('seed')
+            seed = None if seed is None else int(seed)
+
+            if not 0 < seq_len <= self.server.max_seq_len:
+                raise ValueError(f'seq_len must be in (0, {self.server.max_seq_len}].')
+            if not (0 <= top_p <= 1 and temperature > 0):
+                raise ValueError('top_p must be in [0, 1] and temperature must be positive.')
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        future = self.server.batcher.submit(checkpoint_path, seq_len=seq_len, top_p=top_p,
+                                            temperature=temperature, seed=seed)
+        try:
+            data = self.server.to_bytes(*future.result())
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/midi')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    params = get_parser().parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
+    logger.info(f'Used device: {device}')
+
+    batcher = MicroBatcher(ModelCache(params.cache_size, device=device, execution_mode=params.execution_mode),
+                           max_batch_size=params.max_batch_size,
+                           max_wait=params.max_wait_ms / 1000,
+                           max_seq_len=params.max_seq_len)
+
+    server = GenerationServer((params.host, params.port), batcher,
+                              checkpoint_dir=params.checkpoint_dir,
+                              default_checkpoint=params.default_checkpoint,
+                              max_seq_len=params.max_seq_len,
+                              backend=params.backend)
+
+    logger.info(f'Server is listening on http://{params.host}:{params.port}/generate')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+
+import configargparse
+import numpy as np
+
+
+def get_parser() -> configargparse.ArgumentParser:
+    parser = configargparse.ArgumentParser(description='Midi-generator load test client of serve.py.')
+
+    parser.add_argument('-c', '--config_file', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080/generate', help='Generation endpoint.')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Checkpoint name, the default checkpoint of the server is used if it is not set.')
+
+    parser.add_argument('--n_requests', type=int, default=64, help='Number of requests.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of requests which are sent at once.')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[256],
+                        help='Lengths of requested sequences, they are taken in turn.')
+    parser.add_argument('--top_p', type=float, default=0.6, help='Top-p of requests.')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Temperature of requests.')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout of a request in seconds.')
+
+    parser.add_argument('--out_dir', type=str, default=None, help='Directory where responses are written.')
+
+    return parser
+
+
+def _request(params, i, seq_len):
+    """
+    Returns (seq_len, seconds, error), the response is written to `out_dir` if it is set.
+    """
+    body = {'seq_len': seq_len, 'top_p': params.top_p, 'temperature': params.temperature, 'seed': i}
+    if params.checkpoint is not None:
+        body['checkpoint'] = params.checkpoint
+
+    request = urllib.request.Request(params.url, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=params.timeout) as response:
+            data = response.read()
+    except (urllib.error.URLError, OSError) as e:
+        return seq_len, time.perf_counter() - start, str(e)
+    seconds = time.perf_counter() - start
+
+    if not data.startswith(b'MThd'):
+        return seq_len, seconds, 'response is not a MIDI file'
+
+    if params.out_dir is not None:
+        with open(os.path.join(params.out_dir, f'out_{i}.mid'), 'wb') as f:
+            f.write(data)
+
+    return seq_len, seconds, None
+
+
+def main():
+    params = get_parser().parse_args()
+    if params.out_dir is not None:
+        os.makedirs(params.out_dir, exist_ok=True)
+
+    seq_lens = list(islice(cycle(params.seq_lens), params.n_requests))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=params.concurrency) as executor:
+        results = list(executor.map(lambda args: _request(params, *args), enumerate(seq_lens)))
+    seconds = time.perf_counter() - start
+
+    errors = [error for _, _, error in results if error is not None]
+    for error in errors[:10]:
+        logger.warning(f'Request failed: {error}')
+
+    logger.info(f'{len(results) - len(errors)} of {len(results)} requests succeeded in {seconds:.2f}s, '
+                f'{len(results) / seconds:.2f} requests/s.')
+    for seq_len in sorted(set(seq_lens)):
+        latencies = np.array([s for n, s, error in results if n == seq_len and error is None])
+        if len(latencies) > 0:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            logger.info(f'seq_len {seq_len}: latency p50 {p50:.3f}s, p90 {p90:.3f}s, p99 {p99:.3f}s.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger(__file__)
+
+    main()
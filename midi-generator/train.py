@@ -6,9 +6,15 @@ import configargparse
 import torch
 from torch.utils.tensorboard import SummaryWriter
 
-from model.dataset import MidiDataset
+from model.checkpoint import load_checkpoint
+from model.dataset import MidiDataset, Vocab
+from model.distributed import backends, barrier, destroy_distributed, init_distributed
+from model.execution import precisions
 from model.model import GRUNet
+from model.sampler import WindowBatchSampler
+from model.shards import ShardedMidiDataset
 from model.trainer import Trainer
+from utils.load_model import load_model
 from utils.seed import set_seed
 
 
@@ -25,6 +31,12 @@ def get_parser() -> configargparse.ArgumentParser:
     parser.add_argument('--m_drop_prob', type=float, default=.2, help='Dropout proba.')
 
     parser.add_argument('--gpu', action='store_true', help='Use gpu to train model.')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=backends,
+                        help='Backend of data-parallel training which is used if the script is started by torchrun '
+                             'with several processes. "gloo" works on CPU.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=precisions,
+                        help='Precision of forward and losses, weights stay in fp32. "bf16" is supported on CPU '
+                             'and GPU, "fp16" on GPU with loss scaling.')
 
     parser.add_argument('--seed', type=int, default=0, help='Seed for random state.')
 
@@ -38,16 +50,73 @@ def get_parser() -> configargparse.ArgumentParser:
     parser.add_argument('--lr', type=float, default=6.25e-5, help='Learning rate for optimizer.')
     parser.add_argument('--weight_decay', type=float, default=0.01, help='Weight decay for optimizer.')
     parser.add_argument('--smoothing', type=float, default=0, help='Smooth coefficient.')
+    parser.add_argument('--sampled_softmax', type=int, default=0,
+                        help='Number of negative classes of the sampled softmax which replaces the full softmax '
+                             'during training with large vocabularies. The full softmax is used if 0.')
 
     parser.add_argument('--w_cls', type=float, default=1, help='Class criteria weight.')
     parser.add_argument('--w_off', type=float, default=10., help='Offset criteria weight.')
 
-    parser.add_argument('--data_prefix', type=str, required=True, help='Prefix of train *.mid files.')
+    parser.add_argument('--log_interval', type=int, default=10,
+                        help='Losses are logged every this number of optimizer steps.')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Log data wait, compute and optimizer step times, throughput and peak memory.')
+    parser.add_argument('--profile_steps', type=int, nargs=2, default=None,
+                        help='Start and stop batches which are traced with torch.profiler. Traces are written to '
+                             'the TensorBoard log dir.')
+
+    parser.add_argument('--checkpoint_interval', type=int, default=0,
+                        help='The training state is written to `{dump_dir}/{experiment_name}.state` every this '
+                             'number of optimizer steps and after every epoch. Only after epochs if 0.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume training from the training state of the experiment if it exists.')
+    parser.add_argument('--init_checkpoint', type=str, default=None,
+                        help='Checkpoint which is fine-tuned. New notes of the data are added to its vocab, '
+                             'the embedding and the output layer are extended for them.')
+
+    parser.add_argument('--valid_batch_size', type=int, default=None,
+                        help='Number of items in validation batch, 4 times the size of split training batch by '
+                             'default.')
+    parser.add_argument('--valid_max_windows', type=int, default=None,
+                        help='Only a fixed subset of this number of validation windows is evaluated if there are more.')
+    parser.add_argument('--eval_interval', type=int, default=0,
+                        help='Validation files are evaluated every this number of optimizer steps and after every '
+                             'epoch. Only after epochs if 0.')
+    parser.add_argument('--early_stopping', type=int, default=0,
+                        help='Training is stopped if the validation loss has not improved for this number of '
+                             'evaluations. It is disabled if 0.')
+
+    parser.add_argument('--data_prefix', type=str, default=None, help='Prefix of train *.mid files.')
+    parser.add_argument('--data_shards', type=str, default=None,
+                        help='Directory of shards of build_shards.py which are read by memory maps instead of *.mid '
+                             'files. Files are selected and split when shards are built.')
+    parser.add_argument('--data_valid_ratio', type=float, default=0,
+                        help='Share of files which are held out for validation. Weights with the lowest validation '
+                             'loss are written to `{dump_dir}/{experiment_name}.best.ch`.')
     parser.add_argument('--data_coef', type=int, default=100,
                         help='Expand dataset coefficient. The number of real elements will be multiplied by this '
                              'coefficient to expand length of the dataset.')
     parser.add_argument('--data_seq_len', type=int, default=256,
                         help='Lenght of sequences which are used to train the model.')
+    parser.add_argument('--data_sampling', type=str, default='uniform', choices=WindowBatchSampler.modes,
+                        help='Sampling of training windows. "full" draws only windows of full length, "bucket" '
+                             'groups windows of similar length into batches. Both reduce padding. "tokens" draws '
+                             'files proportionally to their length, "stratified" makes an epoch of all consecutive '
+                             'windows of files in shuffled order (--data_coef is not used).')
+    parser.add_argument('--data_dedup', action='store_true',
+                        help='Skip files with the same notes and offsets as another file.')
+    parser.add_argument('--stateful', action='store_true',
+                        help='Truncated BPTT: every item of a batch walks through a file in consecutive windows of '
+                             '--data_seq_len notes and the hidden state is carried between batches, so the context '
+                             'is longer than windows. --data_sampling is not used.')
+    parser.add_argument('--ingest_workers', type=int, default=0,
+                        help='Number of processes which parse *.mid files. Files are parsed in the main process if 0.')
+    parser.add_argument('--data_cache', type=str, default=None,
+                        help='Path to the cache of encoded *.mid files. Only new or changed files are parsed '
+                             'if the cache exists, files which do not match the prefix are dropped from it.')
+    parser.add_argument('--data_backend', type=str, default='music21', choices=MidiDataset.backends,
+                        help='Backend which parses *.mid files. "smf" reads MIDI events directly and gives the same '
+                             'notes as "music21" much faster.')
 
     return parser
 
@@ -60,22 +129,64 @@ def show_params(params: configargparse.Namespace) -> None:
 
 def main() -> None:
     params = get_parser().parse_args()
-    show_params(params)
+    rank, local_rank, world_size = init_distributed(params.dist_backend)
+    if rank == 0:
+        show_params(params)
     os.makedirs(params.dump_dir, exist_ok=True)
 
     set_seed(params.seed)
-
-    device = torch.device('cuda') if torch.cuda.is_available() and params.gpu else torch.device('cpu')
-
-    dataset = MidiDataset(data_prefix=params.data_prefix, seq_len=params.data_seq_len, expand_coef=params.data_coef)
+    if world_size > 1:
+        # batches are drawn from the same numpy state in all processes, dropout masks differ
+        torch.manual_seed(params.seed + rank)
+
+    if torch.cuda.is_available() and params.gpu:
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    state_path = params.dump_dir / f'{params.experiment_name}.state'
+    resume = params.resume and state_path.exists()
+
+    base_model, base_vocab = None, None
+    if resume:
+        # the model and the vocab are restored from the training state
+        meta, _ = load_checkpoint(state_path)
+        base_model, base_vocab = GRUNet(**meta['model']), Vocab(meta['unique_notes'])
+    elif params.init_checkpoint is not None:
+        base_model, base_vocab = load_model(params.init_checkpoint)
+
+    if params.data_shards is not None:
+        dataset = ShardedMidiDataset(params.data_shards, seq_len=params.data_seq_len, expand_coef=params.data_coef)
+        if base_vocab is not None:
+            assert dataset.vocab.unique_notes[:len(base_vocab.unique_notes)] == base_vocab.unique_notes, \
+                'Shards were not built with the vocab of the checkpoint, see --init_checkpoint of build_shards.py.'
+    else:
+        assert params.data_prefix is not None, 'One of --data_prefix and --data_shards is required.'
+
+        # other processes wait until the main process parses files and writes the cache
+        if rank > 0:
+            barrier()
+        dataset = MidiDataset(data_prefix=params.data_prefix, seq_len=params.data_seq_len,
+                              expand_coef=params.data_coef, cache_path=params.data_cache,
+                              ingest_workers=params.ingest_workers, backend=params.data_backend, vocab=base_vocab,
+                              deduplicate=params.data_dedup, valid_ratio=params.data_valid_ratio)
+        if rank == 0:
+            barrier()
     vocab = dataset.vocab
 
-    model = GRUNet(num_embeddings=len(vocab),
-                   hidden_dim=params.m_hidden_dim,
-                   n_layers=params.m_n_layers,
-                   drop_prob=params.m_drop_prob)
+    if base_model is not None:
+        model = base_model
+        if len(vocab) > model.num_embeddings:
+            logger.info(f'{len(vocab) - model.num_embeddings} new notes were added to the vocab.')
+            model.resize_vocab(len(vocab))
+    else:
+        model = GRUNet(num_embeddings=len(vocab),
+                       hidden_dim=params.m_hidden_dim,
+                       n_layers=params.m_n_layers,
+                       drop_prob=params.m_drop_prob)
 
-    writer = SummaryWriter(log_dir=params.dump_dir / f'board/{params.experiment_name}')
+    writer = SummaryWriter(log_dir=params.dump_dir / f'board/{params.experiment_name}') if rank == 0 else None
 
     trainer = Trainer(model, vocab, dataset,
                       writer=writer,
@@ -88,10 +199,32 @@ def main() -> None:
                       weight_decay=params.weight_decay,
                       w_cls=params.w_cls,
                       w_off=params.w_off,
-                      smoothing=params.smoothing)
+                      smoothing=params.smoothing,
+                      sampled_softmax=params.sampled_softmax,
+                      precision=params.precision,
+                      sampling=params.data_sampling,
+                      log_interval=params.log_interval,
+                      instrument=params.instrument,
+                      profile_steps=params.profile_steps,
+                      checkpoint_path=state_path,
+                      checkpoint_interval=params.checkpoint_interval,
+                      stateful=params.stateful,
+                      valid_dataset=dataset.valid_dataset,
+                      valid_batch_size=params.valid_batch_size,
+                      valid_max_windows=params.valid_max_windows,
+                      eval_interval=params.eval_interval,
+                      early_stopping=params.early_stopping,
+                      best_checkpoint_path=(params.dump_dir / f'{params.experiment_name}.best.ch'
+                                            if dataset.valid_dataset is not None else None))
+
+    if resume:
+        trainer.load_training_state(state_path)
 
     trainer.train()
-    trainer.save_state_dict(params.dump_dir / f'{params.experiment_name}.ch')
+    if rank == 0:
+        trainer.save_state_dict(params.dump_dir / f'{params.experiment_name}.ch')
+
+    destroy_distributed()
 
 
 if __name__ == '__main__':
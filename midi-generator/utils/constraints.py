@@ -0,0 +1,115 @@
+import torch
+
+from model.smf import pitch_to_midi
+
+_SCALES = {'major': (0, 2, 4, 5, 7, 9, 11), 'minor': (0, 2, 3, 5, 7, 8, 10)}
+
+
+def key_pitch_classes(key):
+    """
+    Returns pitch classes of the scale of a key, e.g. 'C major', 'F# minor', 'E-' (major).
+    """
+    tonic, _, scale = key.strip().partition(' ')
+    scale = scale.strip() or 'major'
+    if scale not in _SCALES:
+        raise ValueError(f'Unknown scale: {scale}')
+
+    tonic = pitch_to_midi(f'{tonic}4') % 12
+    return [(tonic + step) % 12 for step in _SCALES[scale]]
+
+
+class Constraints:
+    """
+    Constraints of generated tokens which are applied to logits of a batch of sequences.
+
+    Masks of allowed tokens are computed once from the pitch table of the vocab. Repetitions are tracked
+    by the state of sequences (`init_state`, `update`) which is reordered with beams.
+
+    :param pitch_classes: allowed pitch classes (e.g. `key_pitch_classes('C major')`), all pitch classes of
+        a token must be allowed
+    :param pitch_range: (low, high) allowed MIDI note numbers, chords are placed in the 4th octave (60-71)
+    :param repetition_penalty: logits of tokens which are in the last `repetition_window` tokens are divided
+        by the penalty if they are positive and multiplied otherwise, 1 disables the penalty
+    :param max_repeats: a token can not be repeated more than `max_repeats` times in a row
+    """
+
+    def __init__(self, vocab, *, pitch_classes=None, pitch_range=None, repetition_penalty=1.0,
+                 repetition_window=16, max_repeats=None, device=torch.device('cpu')):
+        assert repetition_penalty >= 1
+        assert max_repeats is None or max_repeats > 0
+
+        allowed = torch.ones(len(vocab), dtype=torch.bool)
+        allowed[vocab.pad_index] = False
+        if pitch_classes is not None:
+            other_classes = ~sum(1 << pc for pc in set(pitch_classes)) & 0xFFF
+            allowed &= torch.from_numpy(vocab.pitch_class_masks & other_classes == 0)
+        if pitch_range is not None:
+            low, high = pitch_range
+            allowed &= torch.from_numpy((vocab.lowest_pitches >= low) & (vocab.highest_pitches <= high))
+
+        if not allowed.any():
+            raise ValueError('There are no tokens which satisfy constraints.')
+        if max_repeats is not None and allowed.sum() < 2:
+            raise ValueError('At least two tokens have to satisfy constraints to limit repeats.')
+
+        self.allowed = allowed.to(device)
+        self.allowed_ids = allowed.nonzero().squeeze(-1).tolist()
+        self.mask = torch.zeros(len(vocab), device=device).masked_fill(~self.allowed, -float('inf'))
+
+        self.pad_index = vocab.pad_index
+        self.repetition_penalty = repetition_penalty
+        self.repetition_window = repetition_window
+        self.max_repeats = max_repeats
+        self.device = device
+
+    def init_state(self, seqs):
+        """
+        Returns the state of sequences: the last `repetition_window` tokens (padded with the pad token)
+        and the number of repeats of the last token.
+
+        :param seqs: list of token ids per sequence
+        """
+        recent = [([self.pad_index] * self.repetition_window + seq)[-self.repetition_window:] for seq in seqs]
+
+        repeats = []
+        for seq in seqs:
+            n = 1
+            while n < len(seq) and seq[-n - 1] == seq[-1]:
+                n += 1
+            repeats.append(n)
+
+        return (torch.LongTensor(recent).to(self.device).view(len(seqs), self.repetition_window),
+                torch.LongTensor(repeats).to(self.device))
+
+    def update(self, state, next_ids, parents=None):
+        """
+        :param parents: indexes of sequences which are continued by `next_ids`, e.g. beams
+        """
+        recent, repeats = state
+        if parents is not None:
+            recent, repeats = recent[parents], repeats[parents]
+
+        repeats = torch.where(torch.eq(recent[:, -1], next_ids), repeats + 1, torch.ones_like(repeats))
+        recent = torch.cat([recent[:, 1:], next_ids.unsqueeze(-1)], dim=-1)
+
+        return recent, repeats
+
+    def __call__(self, logits, state):
+        """
+        Returns logits (batch_size, n_tokens) where tokens which are not allowed have -inf.
+        """
+        recent, repeats = state
+
+        logits = logits + self.mask
+
+        if self.repetition_penalty > 1 and self.repetition_window > 0:
+            seen = torch.zeros_like(logits, dtype=torch.bool).scatter_(-1, recent, True)
+            penalized = torch.where(logits > 0, logits / self.repetition_penalty, logits * self.repetition_penalty)
+            logits = torch.where(seen, penalized, logits)
+
+        if self.max_repeats is not None:
+            last = recent[:, -1:]
+            values = logits.gather(-1, last).masked_fill(repeats.unsqueeze(-1) >= self.max_repeats, -float('inf'))
+            logits = logits.scatter(-1, last, values)
+
+        return logits
@@ -3,51 +3,329 @@ import torch
 from tqdm.auto import trange
 
 
+def _per_sample(value, num_samples):
+    values = list(value) if isinstance(value, (list, tuple)) else num_samples * [value]
+    assert len(values) == num_samples
+
+    return values
+
+
+_init_top_k = 64
+
+# the fit of nuclei into `top_k` is checked on the host, so it is checked only every few steps of a batch
+_top_k_check_interval = 16
+
+
+def _nucleus_sample(probas, top_p, top_k, generators=None, check=True):
+    """
+    Samples from the smallest set of the most probable tokens which sum of probabilities gives `top_p`.
+
+    Instead of sorting the whole distribution only `top_k` most probable tokens are selected, `top_k` is doubled
+    until the nucleus of every sequence fits into it.
+
+    :param check: check that nuclei fit into `top_k`, which needs a sync with the device. If it is False,
+        the nucleus is cut by `top_k` most probable tokens
+    :return: sampled ids (batch_size,) and `top_k` which is enough for the current distribution
+    """
+    n_classes = probas.size(-1)
+
+    while True:
+        top_probas, top_indexes = torch.topk(probas, min(top_k, n_classes), dim=-1)
+        cumulative_probas = torch.cumsum(top_probas, dim=-1)
+
+        mask_to_remove = cumulative_probas > top_p
+        if not check or top_k >= n_classes or mask_to_remove[:, -1].all():
+            break
+
+        top_k *= 2
+
+    mask_to_remove[:, 0] = 0
+    top_probas.masked_fill_(mask_to_remove, 0)
+
+    if generators is None:
+        choices = torch.multinomial(top_probas, num_samples=1)
+    else:
+        choices = torch.cat([torch.multinomial(p, num_samples=1, generator=generator)
+                             for p, generator in zip(top_probas, generators)]).unsqueeze(-1)
+
+    return top_indexes.gather(-1, choices).squeeze(-1), top_k
+
+
+def _start_sequences(model, vocab, histories, generators, device, constraints=None):
+    """
+    Returns starts of the sequences and the hidden state after histories. A sequence without history starts
+    with a random note (which is allowed by constraints).
+    """
+    start_ids = list(range(len(vocab))) if constraints is None else constraints.allowed_ids
+
+    predicted_seqs, offset_seqs, hs = [], [], []
+    for i, history in enumerate(histories):
+        if history is None:
+            if generators is None:
+                start_i = random.randint(0, len(start_ids) - 1)
+            else:
+                start_i = torch.randint(len(start_ids), (1,), generator=generators[i], device=device).item()
+            predicted_seqs.append([start_ids[start_i]])
+            offset_seqs.append([0])
+        else:
+            predicted_seqs.append([h[0] for h in history])
+            offset_seqs.append([h[1] for h in history])
+
+        if len(predicted_seqs[-1]) > 1:
+            inputs = torch.LongTensor(predicted_seqs[-1][:-1]).unsqueeze(0).to(device)
+            input_offsets = torch.FloatTensor(offset_seqs[-1][:-1]).unsqueeze(0).to(device)
+
+            _, _, h = model(inputs, input_offsets)
+        else:
+            h = model.init_hidden(1, device)
+        hs.append(h)
+
+    return predicted_seqs, offset_seqs, torch.cat(hs, dim=1)
+
+
+@torch.no_grad()
+def generate_midi_batch(model, vocab, *, num_samples=1, seq_len=1024, top_p=0.6, temperature=1.0,
+                        device=torch.device('cpu'), histories=None, seeds=None, constraints=None, progress=True,
+                        callback=None):
+    """
+    Generates `num_samples` independent sequences which are stepped through the model together.
+
+    :param seq_len: number of generated notes, a single value or a list with a value per sequence. Sequences
+        which reach their length are dropped from the batch, the rest is stepped further
+    :param top_p: nucleus sampling probability, a single value or a list with a value per sequence
+    :param temperature: sampling temperature, a single value or a list with a value per sequence
+    :param histories: list with a history [(note_id, offset), ....] or None per sequence
+    :param seeds: list with a seed of the random generator per sequence, the global random state is used if None
+    :param constraints: utils.constraints.Constraints which are applied to logits before sampling
+    :param progress: show progress bar
+    :param callback: called with (index, note_seq, offset_seq) as soon as a sequence reaches its length
+    :return: list of (note_seq, offset_seq) per sequence
+    """
+    seq_lens = _per_sample(seq_len, num_samples)
+    top_p = _per_sample(top_p, num_samples)
+    temperature = _per_sample(temperature, num_samples)
+    histories = _per_sample(histories, num_samples)
+
+    assert all(0 < n for n in seq_lens)
+    assert all(0 <= p <= 1 for p in top_p)
+    assert all(0 < t for t in temperature)
+
+    generators = None if seeds is None else [torch.Generator(device=device).manual_seed(seed)
+                                             for seed in _per_sample(seeds, num_samples)]
+
+    model.eval()
+
+    predicted_seqs, offset_seqs, h = _start_sequences(model, vocab, histories, generators, device, constraints)
+    state = constraints.init_state(predicted_seqs) if constraints is not None else None
+
+    top_p = torch.FloatTensor(top_p).unsqueeze(-1).to(device)
+    temperature = torch.FloatTensor(temperature).unsqueeze(-1).to(device)
+
+    # outputs are written to preallocated buffers and kept on the device until the end of generation,
+    # the row of the current step is used as input of the next step
+    out_ids = torch.empty((max(seq_lens) + 1, num_samples), dtype=torch.long, device=device)
+    out_offsets = torch.empty((max(seq_lens) + 1, num_samples), dtype=torch.float, device=device)
+
+    out_ids[0] = torch.LongTensor([seq[-1] for seq in predicted_seqs])
+    out_offsets[0] = torch.FloatTensor([seq[-1] for seq in offset_seqs])
+
+    # sequences of the batch, rows of h, top_p, temperature, generators and the state of constraints
+    rows = list(range(num_samples))
+    all_rows = True
+    results = [None] * num_samples
+
+    top_k = _init_top_k
+
+    tqdm_data = trange(max(seq_lens), desc=f'Sound generation', disable=not progress)
+    for i in tqdm_data:
+        index = slice(None) if all_rows else torch.LongTensor(rows).to(device)
+
+        output_logits, output_offsets = model.step(out_ids[i, index], out_offsets[i, index], h)
+        if constraints is not None:
+            output_logits = constraints(output_logits, state)
+        output_probas = torch.softmax(output_logits / temperature, -1)
+
+        next_ids, top_k = _nucleus_sample(output_probas, top_p, top_k, generators,
+                                          check=i % _top_k_check_interval == 0)
+        out_ids[i + 1, index] = next_ids
+        out_offsets[i + 1, index] = output_offsets
+
+        if constraints is not None:
+            state = constraints.update(state, next_ids)
+
+        keep = [j for j, row in enumerate(rows) if seq_lens[row] > i + 1]
+        if len(keep) == len(rows):
+            continue
+
+        for row in rows:
+            if seq_lens[row] == i + 1:
+                results[row] = (predicted_seqs[row] + out_ids[1:i + 2, row].tolist(),
+                                offset_seqs[row] + out_offsets[1:i + 2, row].tolist())
+                if callback is not None:
+                    callback(row, *results[row])
+
+        if not keep:
+            break
+
+        # finished sequences are dropped from the batch
+        rows = [rows[j] for j in keep]
+        all_rows = False
+        keep = torch.LongTensor(keep).to(device)
+        h = h[:, keep].contiguous()
+        top_p, temperature = top_p[keep], temperature[keep]
+        if generators is not None:
+            generators = [generators[j] for j in keep.tolist()]
+        if constraints is not None:
+            state = tuple(s[keep] for s in state)
+
+    return results
+
+
 @torch.no_grad()
+def beam_search_midi(model, vocab, *, seq_len=1024, beam_size=4, num_groups=1, diversity=0.5, temperature=1.0,
+                     device=torch.device('cpu'), history=None, seed=None, constraints=None, progress=True):
+    """
+    Beam search of the most probable continuations of a sequence. Hypotheses are stepped through the model
+    together as a batch, the hidden state is reordered after every step.
+
+    With `num_groups` > 1, diverse beam search is used: beams are split into groups which are expanded in turn,
+    and tokens which were chosen by previous groups at the step are penalized by `diversity`.
+
+    :param history: [(note_id, offset), ....], a random note is the start if it is None
+    :param seed: seed of the random start note
+    :param constraints: utils.constraints.Constraints which are applied to logits
+    :return: list of (note_seq, offset_seq) per beam, the most probable first, beams which could not be continued
+        by allowed tokens are dropped
+    """
+    assert beam_size % num_groups == 0
+    assert 0 < temperature
+    assert constraints is None or beam_size // num_groups <= len(constraints.allowed_ids), \
+        'Number of beams in a group is greater than the number of allowed tokens.'
+
+    generators = None if seed is None else [torch.Generator(device=device).manual_seed(seed)]
+    group_size = beam_size // num_groups
+
+    model.eval()
+
+    predicted_seqs, offset_seqs, h = _start_sequences(model, vocab, [history], generators, device, constraints)
+    h = h.repeat(1, beam_size, 1)
+    state = constraints.init_state(beam_size * predicted_seqs) if constraints is not None else None
+
+    # only the first beam of a group is expanded on the first step, other beams would give the same hypotheses
+    scores = torch.full((num_groups, group_size), -float('inf'), device=device)
+    scores[:, 0] = 0
+    scores = scores.view(-1)
+
+    # tokens of beams are restored from parents of beams at every step after generation
+    out_ids = torch.empty((seq_len + 1, beam_size), dtype=torch.long, device=device)
+    out_offsets = torch.empty((seq_len + 1, beam_size), dtype=torch.float, device=device)
+    out_parents = torch.empty((seq_len, beam_size), dtype=torch.long, device=device)
+
+    out_ids[0] = predicted_seqs[0][-1]
+    out_offsets[0] = offset_seqs[0][-1]
+
+    tqdm_data = trange(seq_len, desc='Beam search', disable=not progress)
+    for i in tqdm_data:
+        output_logits, output_offsets = model.step(out_ids[i], out_offsets[i], h)
+        if constraints is not None:
+            output_logits = constraints(output_logits, state)
+
+        log_probas = torch.log_softmax(output_logits / temperature, -1)
+        candidates = scores.unsqueeze(-1) + log_probas
+        n_tokens = candidates.size(-1)
+
+        # counts of tokens which were chosen by previous groups at this step
+        counts = torch.zeros(n_tokens, device=device)
+        for group_i in range(num_groups):
+            first = group_i * group_size
+            group_candidates = candidates[first:first + group_size]
+            if group_i > 0 and diversity > 0:
+                group_candidates = group_candidates - diversity * counts
+
+            _, top_indexes = torch.topk(group_candidates.view(-1), group_size)
+            parents, next_ids = first + top_indexes // n_tokens, top_indexes % n_tokens
+
+            out_parents[i, first:first + group_size] = parents
+            out_ids[i + 1, first:first + group_size] = next_ids
+            counts.index_add_(0, next_ids, torch.ones_like(next_ids, dtype=torch.float))
+
+        parents = out_parents[i]
+        scores = candidates[parents, out_ids[i + 1]]
+        out_offsets[i + 1] = output_offsets[parents]
+        h.copy_(h.index_select(1, parents))
+
+        if constraints is not None:
+            state = constraints.update(state, out_ids[i + 1], parents)
+
+    # beams with -inf scores were filled with tokens which are not allowed
+    order = torch.argsort(scores, descending=True)
+    order = order[torch.isfinite(scores[order])]
+
+    beam_ids = torch.empty((seq_len, len(order)), dtype=torch.long, device=device)
+    beam_offsets = torch.empty((seq_len, len(order)), dtype=torch.float, device=device)
+    beams = order
+    for i in reversed(range(seq_len)):
+        beam_ids[i], beam_offsets[i] = out_ids[i + 1, beams], out_offsets[i + 1, beams]
+        beams = out_parents[i, beams]
+
+    return [(predicted_seqs[0] + next_ids, offset_seqs[0] + next_offsets)
+            for next_ids, next_offsets in zip(beam_ids.t().tolist(), beam_offsets.t().tolist())]
+
+
 def generate_midi(model, vocab, *, seq_len=1024, top_p=0.6, temperature=1.0, device=torch.device('cpu'),
-                  history=None):
+                  history=None, seed=None):
+    """
+    :param history: [(note_id, offset), ....]
     """
+    return generate_midi_batch(model, vocab, num_samples=1, seq_len=seq_len, top_p=top_p, temperature=temperature,
+                               device=device, histories=[history], seeds=None if seed is None else [seed])[0]
+
+
+def iter_generate_midi(model, vocab, *, seq_len=None, top_p=0.6, temperature=1.0, device=torch.device('cpu'),
+                       history=None, seed=None, constraints=None):
+    """
+    Yields (note_id, offset) as soon as it is sampled. The history is not yielded, but if it is None,
+    the random first note is yielded first. Generation does not stop if `seq_len` is None.
+
     :param history: [(note_id, offset), ....]
+    :param constraints: utils.constraints.Constraints which are applied to logits before sampling
     """
     assert 0 <= top_p <= 1
     assert 0 < temperature
 
-    model.eval()
+    generators = None if seed is None else [torch.Generator(device=device).manual_seed(seed)]
 
-    if history is None:
-        predicted_seq = [random.randint(0, len(vocab) - 1)]
-        offsets = [0]
-        h = None
-    else:
-        predicted_seq = [h[0] for h in history]
-        offsets = [h[1] for h in history]
-
-        inputs = torch.LongTensor(predicted_seq[:-1]).unsqueeze(0).to(device)
-        input_offsets = torch.FloatTensor(offsets[:-1]).unsqueeze(0).to(device)
+    model.eval()
 
-        _, _, h = model(inputs, input_offsets)
+    with torch.no_grad():
+        predicted_seqs, offset_seqs, h = _start_sequences(model, vocab, [history], generators, device, constraints)
+        state = constraints.init_state(predicted_seqs) if constraints is not None else None
 
-    tqdm_data = trange(seq_len, desc=f'Sound generation')
-    for _ in tqdm_data:
-        inputs = torch.LongTensor(predicted_seq[-1:]).unsqueeze(0).to(device)
-        input_offsets = torch.FloatTensor(offsets[-1:]).unsqueeze(0).to(device)
+    if history is None:
+        yield predicted_seqs[0][0], offset_seqs[0][0]
 
-        output_logits, output_offsets, h = model(inputs, input_offsets, h)
-        output_logits = output_logits / temperature
+    input_ids = torch.LongTensor(predicted_seqs[0][-1:]).to(device)
+    input_offsets = torch.FloatTensor(offset_seqs[0][-1:]).to(device)
+    del predicted_seqs, offset_seqs
 
-        output_probas = torch.softmax(output_logits, -1)
+    top_k = _init_top_k
 
-        sorted_probas, sorted_indexes = torch.sort(output_probas, dim=-1, descending=True)
-        cumulative_probas = torch.cumsum(sorted_probas, dim=-1)
+    i = 0
+    while seq_len is None or i < seq_len:
+        with torch.no_grad():
+            output_logits, output_offsets = model.step(input_ids, input_offsets, h)
+            if constraints is not None:
+                output_logits = constraints(output_logits, state)
+            output_probas = torch.softmax(output_logits / temperature, -1)
 
-        mask_to_remove = cumulative_probas > top_p
-        mask_to_remove[:, :, 0] = 0
+            # tokens are read on the host at every step anyway, so nuclei are checked at every step
+            next_ids, top_k = _nucleus_sample(output_probas, top_p, top_k, generators)
 
-        sorted_probas.masked_fill_(mask_to_remove, 0)
-        output_probas.scatter_(-1, sorted_indexes, sorted_probas)
+            if constraints is not None:
+                state = constraints.update(state, next_ids)
 
-        next_ids = torch.multinomial(output_probas[0], num_samples=1).item()
-        predicted_seq.append(next_ids)
-        offsets.append(output_offsets.item())
+        input_ids.copy_(next_ids)
+        input_offsets.copy_(output_offsets)
 
-    return predicted_seq, offsets
+        yield input_ids.item(), input_offsets.item()
+        i += 1
@@ -1,19 +1,71 @@
+import ast
 import logging
+import re
+
 import torch
 
+from model.checkpoint import is_checkpoint, load_checkpoint
 from model.dataset import Vocab
 from model.model import GRUNet
+from model.quantization import load_quantized_model, quantize_model
 
 logger = logging.getLogger(__file__)
 
 
-def load_model(checkpoint_path, device=torch.device('cpu')):
-    state_dict = torch.load(checkpoint_path, map_location='cpu')
+def _parse_model_repr(model_repr):
+    """
+    Returns kwargs of GRUNet from its repr, e.g. 'GRUNet(num_embeddings=10, hidden_dim=8, ...)', without eval.
+    """
+    match = re.fullmatch(r'GRUNet\((.*)\)', model_repr.strip())
+    if match is None:
+        raise ValueError(f'Unknown model: {model_repr}')
+
+    call = ast.parse(f'f({match.group(1)})', mode='eval').body
+    return {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+
+
+def _load_legacy(checkpoint_path):
+    # checkpoints which were saved with torch.save, only tensors and plain values are unpickled
+    state_dict = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+
+    return _parse_model_repr(state_dict['model_repr']), state_dict['model'], state_dict['unique_notes']
+
+
+def load_model(checkpoint_path, device=torch.device('cpu'), quantize=False):
+    """
+    Weights of checkpoints which were saved by Trainer.save_state_dict are not copied on CPU, they are
+    memory-mapped from the file (see model.checkpoint). Checkpoints which were saved with torch.save and
+    training states of Trainer are also loaded.
+
+    :param quantize: quantize the model to int8 (see model.quantization), quantized checkpoints which were saved
+        by quantize.py are always loaded quantized. Quantized models run only on CPU.
+    """
+    if is_checkpoint(checkpoint_path):
+        meta, model_dict = load_checkpoint(checkpoint_path)
+        config, unique_notes = meta['model'], meta['unique_notes']
+
+        if 'training' in meta:
+            # training states (see Trainer.load_training_state) also have optimizer and random states
+            model_dict = {k[len('model.'):]: v for k, v in model_dict.items() if k.startswith('model.')}
+    else:
+        meta = {}
+        config, model_dict, unique_notes = _load_legacy(checkpoint_path)
+
+    if 'quantization' in meta:
+        model = load_quantized_model(config, model_dict, meta['quantization'])
+    else:
+        # weights are not initialized, parameters are replaced with loaded tensors
+        with torch.device('meta'):
+            model = GRUNet(**config)
+        model.load_state_dict(model_dict, assign=True)
+
+        if quantize:
+            model = quantize_model(model)
 
-    model = eval(state_dict['model_repr'])
-    model.load_state_dict(state_dict['model'])
+    if 'quantization' in meta or quantize:
+        assert device.type == 'cpu', 'Quantized models run only on CPU.'
 
-    vocab = Vocab(state_dict['unique_notes'])
+    vocab = Vocab(unique_notes)
 
     model.to(device)
     model.eval()
@@ -0,0 +1,104 @@
+import heapq
+import struct
+
+from model.smf import token_pitches
+
+
+def _var_len(value):
+    buffer = [value & 0x7F]
+    value >>= 7
+    while value:
+        buffer.append(0x80 | (value & 0x7F))
+        value >>= 7
+
+    return bytes(reversed(buffer))
+
+
+class StreamingMidiWriter:
+    """
+    Writes notes to a single track Standard MIDI File as they come.
+
+    Offsets have the same meaning as in MidiDataset.decode_notes: the delay before a note, clipped to [0, 1].
+    Every note lasts `duration` quarters. Only note-offs of notes which are still sounding are kept in memory.
+
+    The track length is written when the writer is closed. If the output is not seekable (e.g. a pipe or
+    a socket) the length can not be patched, so it is written as 0xFFFFFFFF and readers have to rely
+    on the End of Track event.
+    """
+    _unknown_length = 0xFFFFFFFF
+
+    def __init__(self, fp, *, ticks_per_quarter=1024, tempo=500000, velocity=90, duration=1.0, channel=0):
+        self.fp = fp
+        self.ticks_per_quarter = ticks_per_quarter
+        self.velocity = velocity
+        self.duration = duration
+        self.channel = channel
+
+        self._time = 0.0
+        self._last_tick = 0
+        self._pending_offs = []
+        self._track_length = 0
+        self._closed = False
+
+        self._seekable = fp.seekable() if hasattr(fp, 'seekable') else False
+
+        self.fp.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, ticks_per_quarter))
+        self._length_pos = self.fp.tell() + 4 if self._seekable else None
+        self.fp.write(b'MTrk' + struct.pack('>I', self._unknown_length))
+
+        self._write_event(0, b'\xFF\x51\x03' + tempo.to_bytes(3, 'big'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_event(self, tick, data):
+        event = _var_len(tick - self._last_tick) + data
+        self._last_tick = tick
+        self._track_length += len(event)
+        self.fp.write(event)
+
+    def _tick(self, time):
+        return int(round(time * self.ticks_per_quarter))
+
+    def _flush_offs(self, time):
+        while self._pending_offs and self._pending_offs[0][0] <= time:
+            off_time, pitch = heapq.heappop(self._pending_offs)
+            self._write_event(self._tick(off_time), bytes((0x80 | self.channel, pitch, 0)))
+
+    def write(self, token, offset=0.5):
+        self.write_pitches(token_pitches(token), offset)
+
+    def write_pitches(self, pitches, offset=0.5):
+        """
+        Writes MIDI note numbers of a token, e.g. from the pitch table of Vocab.
+        """
+        self._time += min(max(offset, 0), 1)
+        self._flush_offs(self._time)
+
+        tick = self._tick(self._time)
+        for pitch in pitches:
+            self._write_event(tick, bytes((0x90 | self.channel, pitch, self.velocity)))
+            heapq.heappush(self._pending_offs, (self._time + self.duration, pitch))
+
+    def flush(self):
+        if hasattr(self.fp, 'flush'):
+            self.fp.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._flush_offs(float('inf'))
+        self._write_event(self._last_tick, b'\xFF\x2F\x00')
+
+        if self._seekable:
+            end_pos = self.fp.tell()
+            self.fp.seek(self._length_pos)
+            self.fp.write(struct.pack('>I', self._track_length))
+            self.fp.seek(end_pos)
+
+        self.flush()
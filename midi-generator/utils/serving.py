@@ -0,0 +1,157 @@
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+
+import torch
+
+from model.execution import InferenceModel
+from utils.generate_midi import generate_midi_batch
+from utils.load_model import load_model
+
+logger = logging.getLogger(__file__)
+
+
+class ModelCache:
+    """
+    LRU cache of loaded checkpoints.
+
+    :param execution_mode: inference mode of loaded models, see model.execution.InferenceModel
+    """
+
+    def __init__(self, max_size=4, device=torch.device('cpu'), execution_mode='eager'):
+        assert max_size > 0
+
+        self.max_size = max_size
+        self.device = device
+        self.execution_mode = execution_mode
+
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, checkpoint_path):
+        with self._lock:
+            if checkpoint_path in self._models:
+                self._models.move_to_end(checkpoint_path)
+                return self._models[checkpoint_path]
+
+            model, vocab = load_model(checkpoint_path, device=self.device)
+            if self.execution_mode != 'eager':
+                model = InferenceModel(model, self.execution_mode)
+            self._models[checkpoint_path] = model, vocab
+            if len(self._models) > self.max_size:
+                evicted_path, _ = self._models.popitem(last=False)
+                logger.info(f'Model {evicted_path} was evicted from cache.')
+
+            return self._models[checkpoint_path]
+
+
+class GenerationRequest:
+    def __init__(self, checkpoint_path, *, seq_len, top_p, temperature, seed):
+        self.checkpoint_path = checkpoint_path
+        self.seq_len = seq_len
+        self.top_p = top_p
+        self.temperature = temperature
+        self.seed = seed
+
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    Merges concurrent generation requests into batches which are stepped through the model together.
+
+    A batch is collected until `max_batch_size` requests are queued or `max_wait` seconds are passed since
+    the first request. Requests are grouped by checkpoint and every request has its own random generator.
+    A request is resolved as soon as its sequence reaches its length, it is dropped from the batch and does not
+    wait for longer requests.
+
+    :param max_seq_len: requests of longer sequences are rejected
+    """
+
+    def __init__(self, model_cache, *, max_batch_size=32, max_wait=0.01, max_seq_len=4096):
+        self.model_cache = model_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_seq_len = max_seq_len
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, checkpoint_path, *, seq_len, top_p=0.6, temperature=1.0, seed=None):
+        """
+        :return: Future with (note_seq, offset_seq, vocab), where note_seq contains token ids of the vocab
+        """
+        if not 0 < seq_len <= self.max_seq_len:
+            raise ValueError(f'seq_len must be in (0, {self.max_seq_len}].')
+
+        seed = random.randrange(2 ** 31) if seed is None else seed
+        request = GenerationRequest(checkpoint_path, seq_len=seq_len, top_p=top_p, temperature=temperature, seed=seed)
+        self._queue.put(request)
+
+        return request.future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            stop = batch[-1] is None
+            if stop:
+                batch = batch[:-1]
+
+            groups = defaultdict(list)
+            for request in batch:
+                groups[request.checkpoint_path].append(request)
+
+            for checkpoint_path, requests in groups.items():
+                try:
+                    self._generate(checkpoint_path, requests)
+                except Exception as e:
+                    logger.exception(f'Generation with {checkpoint_path} failed.')
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+
+            if stop:
+                break
+
+    def _generate(self, checkpoint_path, requests):
+        model, vocab = self.model_cache.get(checkpoint_path)
+
+        def resolve(i, note_seq, offset_seq):
+            requests[i].future.set_result((note_seq, offset_seq, vocab))
+
+        generate_midi_batch(model, vocab,
+                            num_samples=len(requests),
+                            seq_len=[r.seq_len for r in requests],
+                            top_p=[r.top_p for r in requests],
+                            temperature=[r.temperature for r in requests],
+                            device=self.model_cache.device,
+                            seeds=[r.seed for r in requests],
+                            progress=False,
+                            callback=resolve)
+
+        logger.info(f'Batch of {len(requests)} requests was generated with {checkpoint_path}.')
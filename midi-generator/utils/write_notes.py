@@ -1,6 +1,41 @@
+import io
+from itertools import cycle
+
 from music21 import stream
+from music21.midi import translate
+
+from utils.midi_stream import StreamingMidiWriter
 
 
 def write_notes(out_file, notes):
     midi_stream = stream.Stream(notes)
     midi_stream.write('midi', fp=out_file)
+
+
+def notes_to_bytes(notes):
+    midi_stream = stream.Stream(notes)
+    return translate.streamToMidiFile(midi_stream).writestr()
+
+
+def write_tokens(fp, note_seq, offset_seq=None, vocab=None):
+    """
+    Writes decoded tokens to a file object without music21, notes are the same as
+    MidiDataset.decode_notes(note_seq, offset_seq) gives.
+
+    :param vocab: if it is given, `note_seq` are ids and pitches are taken from the pitch table of the vocab
+    """
+    offset_seq = cycle([0.5]) if offset_seq is None else offset_seq
+
+    with StreamingMidiWriter(fp) as writer:
+        for token, offset in zip(note_seq, offset_seq):
+            if vocab is not None:
+                writer.write_pitches(vocab.id2pitches[token], offset)
+            else:
+                writer.write(token, offset)
+
+
+def tokens_to_bytes(note_seq, offset_seq=None, vocab=None):
+    buffer = io.BytesIO()
+    write_tokens(buffer, note_seq, offset_seq, vocab=vocab)
+
+    return buffer.getvalue()